@@ -0,0 +1,419 @@
+"""Performance benchmarks of the acquisition, display and correlation code.
+
+Every benchmark runs on synthetic images at the real image sizes, and the
+acquisition benchmarks run `GUIMainWindow` on the simulated hardware (see
+`piescope_gui.simulation`). By default the simulated hardware has no
+latency, so the results measure our own code rather than the hardware.
+
+Results are saved as JSON, and `compare_results` reports any benchmark
+slower than a previous run. See the `piescope benchmark` command line
+interface.
+"""
+import collections
+import contextlib
+import json
+import os
+import platform
+import statistics
+import tempfile
+import threading
+import time
+
+import mock
+import numpy as np
+import skimage.io
+
+from piescope_gui import simulation
+from piescope_gui._version import __version__
+
+FLUORESCENCE_SHAPE = simulation.BASLER_SHAPE
+FIBSEM_RESOLUTION = '3072x2048'
+FIBSEM_SHAPE = (2048, 3072)
+
+# name: (setup function, whether it needs the main window, items per call)
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, gui=False, items=1):
+    """Register a benchmark setup function.
+
+    The setup function is called with a `BenchmarkContext`, and returns
+    the function to time, which takes no arguments.
+
+    Parameters
+    ----------
+    name : str
+    gui : bool, optional
+        Whether the benchmark needs the main window, and so the piescope
+        package. By default False.
+    items : int, optional
+        Number of images or frames processed per call, used to report the
+        throughput. By default 1.
+    """
+    def decorator(function):
+        BENCHMARKS[name] = (function, gui, items)
+        return function
+    return decorator
+
+
+class BenchmarkContext:
+    """Synthetic data, simulated hardware and the main window for benchmarks.
+
+    Parameters
+    ----------
+    directory : str
+        Directory for temporary files.
+    settings : SimulationSettings, optional
+        By default, the simulated hardware has no latency.
+    """
+    def __init__(self, directory, settings=None):
+        self.directory = directory
+        self.settings = settings or simulation.SimulationSettings(time_scale=0)
+        self.hardware = simulation.SimulatedHardware(
+            simulation.SimulationSettings(time_scale=0, seed=0))
+        self._window = None
+        self._stack = contextlib.ExitStack()
+        self._fluorescence_image = None
+        self._fibsem_image = None
+
+    @property
+    def fluorescence_image(self):
+        """Basler camera image."""
+        if self._fluorescence_image is None:
+            laser = self.hardware.lasers['laser640']
+            laser.laser_power = 5
+            laser.emission_on()
+            self._fluorescence_image = self.hardware.detector.camera_grab(1e5)
+            laser.emission_off()
+        return self._fluorescence_image
+
+    @property
+    def fibsem_image(self):
+        """Ion beam Adorned Image."""
+        if self._fibsem_image is None:
+            self._fibsem_image = simulation.new_ion_image(
+                self.hardware.microscope,
+                simulation.update_camera_settings(1e-7, FIBSEM_RESOLUTION))
+        return self._fibsem_image
+
+    @property
+    def window(self):
+        """`GUIMainWindow` running offline on the simulated hardware."""
+        if self._window is None:
+            os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+            from PyQt5 import QtWidgets
+            import piescope_gui.main
+
+            self.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+            self._stack.enter_context(simulation.simulated_backend(self.settings))
+            # an error dialog would wait forever for a click, fail instead
+            self._stack.enter_context(mock.patch.object(
+                piescope_gui.main, 'display_error_message', _raise_error))
+            self._window = piescope_gui.main.GUIMainWindow(
+                ip_address='localhost', offline=True)
+            self._stack.callback(self._window.disconnect)
+        return self._window
+
+    def close(self):
+        self._stack.close()
+        self._window = None
+
+
+def _raise_error(message):
+    raise RuntimeError(message)
+
+
+############## Display ##############
+@benchmark('update_display FM', gui=True)
+def update_display_fm(context):
+    window = context.window
+    image = context.fluorescence_image
+    window.string_list_FM = ['F_image.tif']
+
+    def run():
+        window.array_list_FM = image  # replaced by the RGB display image
+        window.update_display('FM')
+    return run
+
+
+@benchmark('update_display FIBSEM', gui=True)
+def update_display_fibsem(context):
+    window = context.window
+    window.string_list_FIBSEM = ['I_image.tif']
+    window.array_list_FIBSEM = context.fibsem_image.data
+    return lambda: window.update_display('FIBSEM')
+
+
+############## Opening images ##############
+def _save_images(context, count):
+    filenames = []
+    for i in range(count):
+        filename = os.path.join(context.directory, 'F_{}.tif'.format(i))
+        if not os.path.exists(filename):
+            skimage.io.imsave(filename, np.roll(context.fluorescence_image, i),
+                              check_contrast=False)
+        filenames.append(filename)
+    return filenames
+
+
+@benchmark('_create_array_list FM', gui=True)
+def create_array_list(context):
+    from piescope_gui.main import _create_array_list
+
+    filenames = _save_images(context, 1)
+    return lambda: _create_array_list(filenames, 'FM')
+
+
+@benchmark('_create_array_list FM stack', gui=True, items=10)
+def create_array_list_stack(context):
+    from piescope_gui.main import _create_array_list
+
+    filenames = _save_images(context, 10)
+
+    def run():
+        # images in a collection are only read when used
+        return [image for image in _create_array_list(filenames, 'FM')]
+    return run
+
+
+############## Correlation ##############
+def _transformation():
+    angle = 0.05
+    return np.array([[np.cos(angle), -np.sin(angle), 30],
+                     [np.sin(angle), np.cos(angle), -20],
+                     [0, 0, 1]])
+
+
+def _rgb_images(context):
+    """Fluorescence and FIBSEM RGB images, both with the FIBSEM shape."""
+    import skimage.color
+    import skimage.transform
+
+    fluorescence = skimage.transform.resize(
+        context.fluorescence_image, FIBSEM_SHAPE, preserve_range=True)
+    fluorescence = skimage.color.gray2rgb(fluorescence.astype(np.uint8))
+    fibsem = skimage.color.gray2rgb(context.fibsem_image.data)
+    return fluorescence, fibsem
+
+
+@benchmark('apply_transform')
+def apply_transform(context):
+    from piescope_gui.correlation.transform import apply_transform
+
+    fluorescence, _ = _rgb_images(context)
+    transformation = _transformation()
+    return lambda: apply_transform(fluorescence, transformation)
+
+
+@benchmark('warp_image')
+def warp_image(context):
+    from piescope_gui.correlation.transform import warp_image
+
+    fluorescence, _ = _rgb_images(context)
+    transformation = _transformation()
+    warp_image(fluorescence, transformation)  # the warp map is cached
+    return lambda: warp_image(fluorescence, transformation)
+
+
+@benchmark('overlay_images')
+def overlay_images(context):
+    from piescope_gui.correlation.transform import overlay_images
+
+    fluorescence, fibsem = _rgb_images(context)
+    return lambda: overlay_images(fluorescence, fibsem)
+
+
+############## Acquisition ##############
+VOLUME_SLICES = 10
+
+
+@benchmark('acquire_volume', gui=True, items=VOLUME_SLICES)
+def acquire_volume(context):
+    window = context.window
+    window.laser_dict = {'laser640': (5, 100000), 'laser488': (5, 100000)}
+    window.lineEdit_slice_number.setText(str(VOLUME_SLICES))
+    window.lineEdit_slice_distance.setText('500')
+    return lambda: window.acquire_volume(autosave=False)
+
+
+MULTICHANNEL_LASERS = {'laser640': (5, 100000), 'laser561': (5, 100000),
+                       'laser488': (5, 100000)}
+
+
+@benchmark('multichannel_image', gui=True, items=len(MULTICHANNEL_LASERS))
+def multichannel_image(context):
+    window = context.window
+    window.laser_dict = dict(MULTICHANNEL_LASERS)
+    return lambda: window.multichannel_image(autosave=False)
+
+
+LIVE_FRAMES = 20
+
+
+@benchmark('live_imaging_worker', gui=True, items=LIVE_FRAMES)
+def live_imaging_worker(context):
+    window = context.window
+    detector = window.detector
+    camera_grab = type(detector).camera_grab
+
+    def run():
+        stop_event = threading.Event()
+        frames = [0]
+
+        def counting_grab(*args, **kwargs):
+            image = camera_grab(detector, *args, **kwargs)
+            frames[0] += 1
+            if frames[0] >= LIVE_FRAMES:
+                stop_event.set()
+            return image
+
+        # the worker loop runs here, rather than in its own thread
+        with mock.patch.object(detector, 'camera_grab', counting_grab):
+            window.live_imaging_worker(stop_event, 'laser640', 5, 100)
+    return run
+
+
+def time_function(function, repeat=5, warmup=1):
+    """Seconds taken by each call of a function with no arguments."""
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmarks(names=None, repeat=5, warmup=1, settings=None,
+                   progress=None):
+    """Run benchmarks and summarize their timings.
+
+    Parameters
+    ----------
+    names : list of str, optional
+        Benchmarks to run, by default all of `BENCHMARKS`.
+    repeat : int, optional
+        Number of timed calls of each benchmark, by default 5.
+    warmup : int, optional
+        Number of untimed calls first, by default 1.
+    settings : SimulationSettings, optional
+        Simulated hardware settings, by default without latency.
+    progress : callable, optional
+        Called with each benchmark name before it runs.
+
+    Returns
+    -------
+    dict
+        Results, with the 'timestamp', 'version', 'platform', run 'settings'
+        and a dict of 'benchmarks'. Each benchmark has its 'times' in
+        seconds, their 'min', 'median' and 'mean', and its 'throughput' in
+        items per second. Benchmarks missing a dependency are 'skipped',
+        and benchmarks that failed have an 'error'.
+    """
+    names = list(BENCHMARKS) if names is None else names
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError("Unknown benchmarks {}, expected some of {}".format(
+            sorted(unknown), list(BENCHMARKS)))
+    results = collections.OrderedDict()
+    with tempfile.TemporaryDirectory() as directory:
+        context = BenchmarkContext(directory, settings)
+        try:
+            for name in names:
+                if progress is not None:
+                    progress(name)
+                setup, gui, items = BENCHMARKS[name]
+                try:
+                    times = time_function(setup(context), repeat, warmup)
+                except ImportError as e:
+                    # the main window needs the piescope package
+                    results[name] = {'skipped': str(e)}
+                    continue
+                except Exception as e:
+                    results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+                    continue
+                median = statistics.median(times)
+                results[name] = {
+                    'times': times,
+                    'min': min(times),
+                    'median': median,
+                    'mean': statistics.mean(times),
+                    'items': items,
+                    'throughput': items / median if median > 0 else None,
+                }
+        finally:
+            context.close()
+    settings = context.settings
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'version': __version__,
+        'platform': {
+            'python': platform.python_version(),
+            'system': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+        },
+        'settings': {'repeat': repeat, 'warmup': warmup,
+                     'time_scale': settings.time_scale},
+        'benchmarks': results,
+    }
+
+
+def save_results(results, filename):
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2)
+    return filename
+
+
+def load_results(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Compare benchmark medians against a baseline run.
+
+    Parameters
+    ----------
+    results, baseline : dict
+        Results returned by `run_benchmarks`.
+    tolerance : float, optional
+        Fraction slower than the baseline counted as a regression,
+        by default 0.2.
+
+    Returns
+    -------
+    list of dict
+        For each benchmark timed in the baseline, its 'name', 'baseline' and
+        'median' seconds, their 'ratio' and whether it 'regressed'. A
+        benchmark which now fails, or is missing from the results, has
+        regressed, with a None 'median' and 'ratio' and the 'error'.
+    """
+    comparison = []
+    for name, previous in baseline['benchmarks'].items():
+        if 'median' not in previous:
+            continue  # not timed in the baseline
+        result = results['benchmarks'].get(name, {'error': 'missing'})
+        if 'skipped' in result:
+            continue
+        if 'median' not in result:
+            comparison.append({
+                'name': name,
+                'baseline': previous['median'],
+                'median': None,
+                'ratio': None,
+                'regressed': True,
+                'error': result.get('error'),
+            })
+            continue
+        ratio = result['median'] / previous['median'] if previous['median'] else None
+        comparison.append({
+            'name': name,
+            'baseline': previous['median'],
+            'median': result['median'],
+            'ratio': ratio,
+            'regressed': ratio is not None and ratio > 1 + tolerance,
+        })
+    return comparison
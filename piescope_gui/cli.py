@@ -0,0 +1,225 @@
+"""Command line interface for `piescope_gui`.
+
+Running `piescope` with no subcommand launches the graphical user interface.
+Subcommands such as `piescope correlate` run headless, without importing Qt.
+"""
+import os
+
+import click
+
+
+@click.group(invoke_without_command=True)
+@click.option('--offline', default='False')
+@click.pass_context
+def main(ctx, offline):
+    """PIEScope controls. With no subcommand, start the graphical interface.
+
+    See `piescope_gui.main.main` for details of the `--offline` option.
+    """
+    if ctx.invoked_subcommand is None:
+        import piescope_gui.main  # Qt is only imported to launch the GUI
+        ctx.invoke(piescope_gui.main.main, offline=offline)
+
+
+@main.command()
+@click.argument('transform', type=click.Path(exists=True, dir_okay=False))
+@click.argument('fluorescence', type=click.Path(exists=True))
+@click.argument('fibsem', type=click.Path(exists=True))
+@click.option('--output', '-o', required=True, type=click.Path(file_okay=False),
+              help='Directory to save overlay images and summary.json.')
+@click.option('--workers', '-j', default=None, type=int,
+              help='Number of worker processes (default: number of CPUs).')
+@click.option('--max-pending', default=None, type=int,
+              help='Maximum number of images in memory at once '
+                   '(default: twice the number of workers).')
+@click.option('--transparency', default=0.5, type=float,
+              help='Fluorescence image transparency in the overlay.')
+def correlate(transform, fluorescence, fibsem, output, workers, max_pending,
+              transparency):
+    """Warp and overlay fluorescence images with a saved transform.
+
+    TRANSFORM is a JSON file saved by the correlation window.
+    FLUORESCENCE and FIBSEM are image files or directories of images.
+    A single FIBSEM image is overlaid with every fluorescence image,
+    otherwise the images are paired in sorted filename order.
+    """
+    from piescope_gui.correlation.batch import correlate_batch
+
+    results = correlate_batch(transform, fluorescence, fibsem, output,
+                              workers=workers, max_pending=max_pending,
+                              transparency=transparency)
+    failed = [result for result in results if result['error'] is not None]
+    for result in failed:
+        click.echo('Failed: {} ({})'.format(result['fluorescence'],
+                                            result['error']), err=True)
+    click.echo('Correlated {} of {} images, summary saved to {}'.format(
+        len(results) - len(failed), len(results),
+        os.path.join(output, 'summary.json')))
+    if failed:
+        raise SystemExit(1)
+
+
+@main.command('correlate-volume')
+@click.argument('transform', type=click.Path(exists=True, dir_okay=False))
+@click.argument('volume', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', required=True, type=click.Path(dir_okay=False),
+              help='Filename of the warped volume TIFF file.')
+@click.option('--fibsem-shape', default=None, type=(int, int),
+              help='FIBSEM image rows and columns '
+                   '(default: the resolution saved in the transform file).')
+@click.option('--workers', '-j', default=None, type=int,
+              help='Number of worker threads (default: number of CPUs).')
+@click.option('--max-pending', default=None, type=int,
+              help='Maximum number of slices in memory at once '
+                   '(default: twice the number of workers).')
+def correlate_volume(transform, volume, output, fibsem_shape, workers,
+                     max_pending):
+    """Warp every slice and channel of a volume into FIBSEM pixel space.
+
+    TRANSFORM is a JSON file saved by the correlation window.
+    VOLUME is a fluorescence volume TIFF file saved by the GUI.
+    """
+    from piescope_gui.correlation.volume import correlate_volume
+
+    shape = correlate_volume(volume, transform, output,
+                             fibsem_shape=fibsem_shape, workers=workers,
+                             max_pending=max_pending)
+    click.echo('Saved warped volume with shape {} to {}'.format(shape, output))
+
+
+@main.command('run-sites')
+@click.argument('sites', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', required=True, type=click.Path(file_okay=False),
+              help='Directory to save the images of each site.')
+@click.option('--transform', default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help='JSON transform file to correlate the images of each site.')
+@click.option('--laser', 'lasers', multiple=True, required=True,
+              type=(str, int, int),
+              help='Laser name, power and exposure time in milliseconds, '
+                   'e.g. "--laser laser640 5 200". Can be repeated.')
+@click.option('--slices', default=1, type=int,
+              help='Number of slices in each fluorescence volume.')
+@click.option('--slice-distance', default=0, type=int,
+              help='Distance between volume slices in nanometres.')
+@click.option('--resolution', default='3072x2048',
+              help='Ion beam image resolution.')
+@click.option('--dwell-time', default=1., type=float,
+              help='Ion beam image dwell time in microseconds.')
+@click.option('--ip-address', default='10.0.0.1',
+              help='IP address of the FIBSEM microscope.')
+@click.option('--workers', '-j', default=1, type=int,
+              help='Number of threads for background correlation.')
+@click.option('--restart', is_flag=True,
+              help='Start again from the first site, '
+                   'ignoring any saved progress.')
+def run_sites(sites, output, transform, lasers, slices, slice_distance,
+              resolution, dwell_time, ip_address, workers, restart):
+    """Image, mill and correlate at every stored site, unattended.
+
+    SITES is a JSON file of stage positions, see
+    `piescope_gui.workflow.load_sites`. Progress is saved to
+    workflow_checkpoint.json in the output directory, and running the
+    same command again resumes after a failure.
+    """
+    import piescope.fibsem
+    import piescope.lm
+    from piescope_gui.workflow import Workflow, load_sites, piescope_steps
+
+    microscope = piescope.fibsem.initialize(ip_address=ip_address)
+    laser_objects = piescope.lm.laser.initialize_lasers()
+    detector = piescope.lm.detector.Basler()
+    objective_stage = piescope.lm.objective.StageController()
+    objective_stage.initialise_system_parameters()
+    camera_settings = piescope.fibsem.update_camera_settings(
+        dwell_time * 1e-6, resolution)
+    laser_dict = {name: (power, exposure * 1000)  # ms -> us
+                  for name, power, exposure in lasers}
+    steps = piescope_steps(microscope, laser_objects, detector,
+                           objective_stage, laser_dict, slices,
+                           slice_distance, camera_settings, output,
+                           transform_filename=transform)
+    workflow = Workflow(load_sites(sites), steps,
+                        os.path.join(output, 'workflow_checkpoint.json'),
+                        workers=workers)
+    try:
+        results = workflow.run(resume=not restart)
+    except KeyboardInterrupt:
+        raise SystemExit("Stopped, run the same command again to resume.")
+    finally:
+        microscope.disconnect()
+    failed = [site for site in results if site['status'] == 'failed']
+    for site in failed:
+        click.echo('Failed: site {} at step {}'.format(
+            site['name'], site['failed_step']), err=True)
+    click.echo('Finished {} of {} sites'.format(
+        sum(site['status'] == 'done' for site in results), len(results)))
+    if failed:
+        raise SystemExit(1)
+
+
+@main.command()
+@click.option('--output', '-o', default=None, type=click.Path(dir_okay=False),
+              help='JSON file to save the results '
+                   '(default: benchmark_<timestamp>.json).')
+@click.option('--compare', 'baseline', default=None,
+              type=click.Path(exists=True, dir_okay=False),
+              help='JSON results of a previous run to compare against.')
+@click.option('--tolerance', default=0.2, type=float,
+              help='Fraction slower than the baseline counted as a regression.')
+@click.option('--repeat', '-n', default=5, type=int,
+              help='Number of timed runs of each benchmark.')
+@click.option('--only', multiple=True,
+              help='Only run benchmarks with names containing this text. '
+                   'Can be repeated.')
+@click.option('--time-scale', default=0., type=float,
+              help='Simulated hardware latency scale '
+                   '(default: 0, no hardware latency).')
+def benchmark(output, baseline, tolerance, repeat, only, time_scale):
+    """Time image display, correlation and acquisition on simulated hardware.
+
+    Exits with an error if any benchmark is slower than the baseline.
+    """
+    import time
+
+    from piescope_gui import benchmark
+    from piescope_gui.simulation import SimulationSettings
+
+    names = [name for name in benchmark.BENCHMARKS
+             if not only or any(text in name for text in only)]
+    results = benchmark.run_benchmarks(
+        names, repeat=repeat, settings=SimulationSettings(time_scale=time_scale),
+        progress=lambda name: click.echo('Running {}'.format(name), err=True))
+    if output is None:
+        output = time.strftime('benchmark_%Y%m%d_%H%M%S.json')
+    benchmark.save_results(results, output)
+
+    for name, result in results['benchmarks'].items():
+        if 'median' in result:
+            click.echo('{:<32}{:>10.4f} s{:>10.1f} /s'.format(
+                name, result['median'], result['throughput'] or float('inf')))
+        else:
+            click.echo('{:<32}{}'.format(
+                name, result.get('skipped') or result.get('error')))
+    click.echo('Results saved to {}'.format(output))
+    if baseline is None:
+        return
+    baseline = benchmark.load_results(baseline)
+    baseline['benchmarks'] = {name: result for name, result
+                              in baseline['benchmarks'].items()
+                              if name in names}  # only those run now
+    comparison = benchmark.compare_results(results, baseline,
+                                           tolerance=tolerance)
+    for row in comparison:
+        if row['median'] is None:
+            click.echo('{:<32}  FAILED {}'.format(row['name'], row['error']))
+            continue
+        click.echo('{:<32}{:>8.2f}x{}'.format(
+            row['name'], row['ratio'] or float('nan'),
+            '  SLOWER' if row['regressed'] else ''))
+    if any(row['regressed'] for row in comparison):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
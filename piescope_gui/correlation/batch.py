@@ -0,0 +1,343 @@
+"""Headless batch correlation of many images with one known transform.
+
+Nothing in this module imports Qt, so it can run on machines without a
+display (see the `piescope correlate` command line interface).
+"""
+import collections
+import concurrent.futures
+import json
+import os
+import time
+
+import numpy as np
+import skimage.color
+import skimage.io
+import skimage.transform
+import skimage.util
+
+from piescope_gui.correlation.transform import (calculate_transform,
+                                                get_point_warp_map,
+                                                get_warp_map,
+                                                load_transform,
+                                                overlay_images,
+                                                point_coords,
+                                                _timestamp,
+                                                )
+
+IMAGE_EXTENSIONS = ('.bmp', '.jpg', '.png', '.tif', '.tiff')
+
+
+def find_images(path):
+    """List image files in a directory, or a single image filename.
+
+    Parameters
+    ----------
+    path : str
+        Directory or image filename.
+
+    Returns
+    -------
+    list of str
+        Sorted image filenames.
+    """
+    if os.path.isfile(path):
+        return [path]
+    if not os.path.isdir(path):
+        raise ValueError("No such file or directory: {}".format(path))
+    filenames = [os.path.join(path, f) for f in sorted(os.listdir(path))
+                 if f.lower().endswith(IMAGE_EXTENSIONS)]
+    return filenames
+
+
+def read_transformation(transform_filename):
+    """Read the transformation matrix from a saved transform file.
+
+    If the file has no transformation matrix, it is calculated
+    from the saved control points instead.
+
+    Parameters
+    ----------
+    transform_filename : str
+        JSON file written by `save_transform`.
+
+    Returns
+    -------
+    ndarray
+        Transformation matrix.
+    """
+    contents = load_transform(transform_filename)
+    transformation = contents.get('transformation')
+    if transformation is None or np.size(transformation) == 0:
+        src, dst = point_coords(contents['control_points'])
+        transformation = calculate_transform(src, dst)
+    return transformation
+
+
+def read_warp(transform_filename):
+    """Read how to warp images from a saved transform file.
+
+    Parameters
+    ----------
+    transform_filename : str
+        JSON file written by `save_transform`.
+
+    Returns
+    -------
+    (method, parameters)
+        The transform method, and the transformation matrix for affine
+        transforms, or the (src, dst) control point coordinates otherwise.
+    """
+    contents = load_transform(transform_filename)
+    if contents['method'] == 'affine':
+        return 'affine', read_transformation(transform_filename)
+    return contents['method'], point_coords(contents['control_points'])
+
+
+def get_warp_map_for(warp, input_shape, output_shape=None):
+    """Get the cached warp map for a warp returned by `read_warp`.
+
+    Parameters
+    ----------
+    warp : (method, parameters)
+        Transform method and parameters, as returned by `read_warp`.
+    input_shape : tuple
+        Shape of the images to be warped (any channel axes are ignored).
+    output_shape : tuple, optional
+        Shape of the warped images. By default, the same as `input_shape`.
+
+    Returns
+    -------
+    WarpMap
+    """
+    method, parameters = warp
+    if method == 'affine':
+        return get_warp_map(parameters, input_shape, output_shape)
+    src, dst = parameters
+    return get_point_warp_map(src, dst, input_shape, output_shape,
+                              method=method)
+
+
+def apply_warp(image, warp, output_shape=None):
+    """Warp an image with a warp returned by `read_warp`."""
+    return get_warp_map_for(warp, image.shape, output_shape).warp(image)
+
+
+def pair_images(fluorescence_filenames, fibsem_filenames):
+    """Match each fluorescence image with a FIBSEM image.
+
+    A single FIBSEM image is used for every fluorescence image,
+    otherwise images are paired in sorted filename order.
+
+    Parameters
+    ----------
+    fluorescence_filenames : list of str
+    fibsem_filenames : list of str
+
+    Returns
+    -------
+    list of tuple
+        (fluorescence_filename, fibsem_filename) pairs.
+    """
+    if len(fibsem_filenames) == 1:
+        fibsem_filenames = fibsem_filenames * len(fluorescence_filenames)
+    if len(fibsem_filenames) != len(fluorescence_filenames):
+        raise ValueError(
+            "Expected one FIBSEM image, or one FIBSEM image per fluorescence "
+            "image. Found {} FIBSEM and {} fluorescence images.".format(
+                len(fibsem_filenames), len(fluorescence_filenames)))
+    return list(zip(fluorescence_filenames, fibsem_filenames))
+
+
+def output_filenames(fluorescence_filenames, output_directory):
+    """Overlay filenames for fluorescence images, one per image.
+
+    The overlay of "a.tif" is "correlated_a.tiff". Images with the same
+    name but different extensions keep their extension in the overlay
+    name, e.g. "correlated_a_tif.tiff" and "correlated_a_png.tiff",
+    so they don't overwrite each other.
+
+    Parameters
+    ----------
+    fluorescence_filenames : list of str
+    output_directory : str
+
+    Returns
+    -------
+    list of str
+    """
+    stems = [os.path.splitext(os.path.basename(filename))
+             for filename in fluorescence_filenames]
+    counts = collections.Counter(stem.lower() for stem, _ in stems)
+    names = []
+    for stem, extension in stems:
+        if counts[stem.lower()] > 1:
+            stem += '_' + extension.lstrip('.')
+        names.append(os.path.join(output_directory,
+                                  'correlated_' + stem + '.tiff'))
+    if len(set(name.lower() for name in names)) < len(names):
+        raise ValueError("Fluorescence images would overwrite each other's "
+                         "overlays: {}".format(fluorescence_filenames))
+    return names
+
+
+def correlate_batch(transform_filename, fluorescence_path, fibsem_path,
+                    output_directory, workers=None, max_pending=None,
+                    transparency=0.5):
+    """Warp and overlay many fluorescence images with one known transform.
+
+    Images are processed in parallel across processes. Each worker reads
+    its own input files and writes its own overlay, and no more than
+    `max_pending` images are in flight at once, which bounds memory use.
+
+    Parameters
+    ----------
+    transform_filename : str
+        JSON transform file written by `save_transform`.
+    fluorescence_path : str
+        Directory of fluorescence images, or a single image filename.
+    fibsem_path : str
+        Directory of FIBSEM images, or a single image filename.
+    output_directory : str
+        Directory for the overlay images and summary file.
+    workers : int, optional
+        Number of worker processes. By default, the number of CPUs.
+    max_pending : int, optional
+        Maximum number of images in flight. By default, twice the workers.
+    transparency : float, optional
+        Transparency of the fluorescence image in the overlay, by default 0.5
+
+    Returns
+    -------
+    list of dict
+        Summary of each processed image, in input order.
+    """
+    warp = read_warp(transform_filename)
+    pairs = pair_images(find_images(fluorescence_path),
+                        find_images(fibsem_path))
+    os.makedirs(output_directory, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+
+    tasks = []
+    overlays = output_filenames([fluorescence_filename
+                                 for fluorescence_filename, _ in pairs],
+                                output_directory)
+    for (fluorescence_filename, fibsem_filename), output_filename in zip(
+            pairs, overlays):
+        tasks.append((fluorescence_filename, fibsem_filename, output_filename,
+                      warp, transparency))
+
+    results = [None] * len(tasks)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        task_iter = iter(enumerate(tasks))
+        while True:
+            for index, task in task_iter:
+                pending[executor.submit(correlate_file, *task)] = index
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+
+    write_summary(results, output_directory, transform_filename)
+    return results
+
+
+def write_summary(results, output_directory, transform_filename=None):
+    """Write a JSON summary of a batch correlation.
+
+    Parameters
+    ----------
+    results : list of dict
+        Summary of each image, as returned by `correlate_batch`.
+    output_directory : str
+    transform_filename : str, optional
+
+    Returns
+    -------
+    str
+        Summary filename.
+    """
+    summary_filename = os.path.join(output_directory, 'summary.json')
+    summary = {
+        'timestamp': _timestamp(),
+        'transform': transform_filename,
+        'succeeded': sum(result['error'] is None for result in results),
+        'failed': sum(result['error'] is not None for result in results),
+        'images': results,
+    }
+    with open(summary_filename, 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary_filename
+
+
+def as_rgb(image):
+    """Convert a grayscale or channel-first image to a 2D RGB image."""
+    image = np.asarray(image)
+    if image.ndim == 2:
+        return skimage.color.gray2rgb(image)
+    if image.ndim == 3:
+        if image.shape[-1] > 3 and image.shape[0] <= 3:
+            image = np.moveaxis(image, 0, -1)
+        if image.shape[-1] == 1:
+            return skimage.color.gray2rgb(image[..., 0])
+        if image.shape[-1] == 2:
+            return np.dstack([image, np.zeros_like(image[..., 0])])
+        if image.shape[-1] == 3:
+            return image
+        if image.shape[-1] == 4:
+            return image[..., :3]  # drop alpha channel
+    raise ValueError("Expected a 2D grayscale or RGB image, "
+                     "got shape {}".format(image.shape))
+
+
+def correlate_file(fluorescence_filename, fibsem_filename, output_filename,
+                   warp, transparency=0.5):
+    """Warp, overlay and save one fluorescence image.
+
+    Used by `correlate_batch` for each image, in a worker process.
+
+    Parameters
+    ----------
+    fluorescence_filename, fibsem_filename : str
+        Images to correlate.
+    output_filename : str
+        Overlay image to save.
+    warp : (method, parameters)
+        Transform method and parameters, as returned by `read_warp`.
+    transparency : float, optional
+        Transparency of the overlay, by default 0.5.
+
+    Returns
+    -------
+    dict
+        The 'fluorescence', 'fibsem' and 'output' filenames, the 'seconds'
+        taken, and the 'error' message, None if the image was saved.
+    """
+    start = time.time()
+    result = {'fluorescence': fluorescence_filename,
+              'fibsem': fibsem_filename,
+              'output': output_filename,
+              'seconds': None,
+              'error': None}
+    try:
+        fibsem_image = as_rgb(skimage.io.imread(fibsem_filename))
+        fluorescence_image = as_rgb(skimage.io.imread(fluorescence_filename))
+        # Correlation transforms are picked on the fluorescence image
+        # resized to the FIBSEM image shape, see `open_correlation_window`
+        if fluorescence_image.shape != fibsem_image.shape:
+            fluorescence_image = skimage.transform.resize(
+                fluorescence_image, fibsem_image.shape)
+        # Every image in a batch shares one transform and image shape, so
+        # each worker process computes the coordinate mapping only once
+        aligned = apply_warp(fluorescence_image, warp)
+        overlay = overlay_images(aligned, fibsem_image, transparency)
+        skimage.io.imsave(output_filename, skimage.util.img_as_ubyte(overlay))
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    return result
@@ -1,10 +1,9 @@
+import logging
 import os
 import os.path as p
-import time
 
 import skimage.util
 import numpy as np
-import scipy.ndimage as ndi
 import skimage
 import skimage.color
 import skimage.io
@@ -20,11 +19,39 @@ from matplotlib.backends.backend_qt5agg import \
 from matplotlib.backends.backend_qt5agg import \
     NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
-from skimage.transform import AffineTransform
-from piescope_gui._version import __version__
-
-
-def open_correlation_window(main_gui, fluorescence_image, fibsem_image, output_path):
+from matplotlib.patches import Ellipse
+from piescope_gui import tracing
+from piescope_gui.correlation.refine import (ellipse_parameters,
+                                             predict_point,
+                                             refine_cross_correlation,
+                                             refine_point,
+                                             )
+from piescope_gui.correlation.transform import (MINIMUM_POINTS,
+                                                apply_transform,
+                                                calculate_transform,
+                                                complete_points,
+                                                find_cached_transform,
+                                                get_point_warp_map,
+                                                image_geometry,
+                                                overlay_images,
+                                                point_coords,
+                                                preview_overlay,
+                                                release_warp_maps,
+                                                save_text,
+                                                save_transform,
+                                                )
+
+logger = logging.getLogger(__name__)
+
+# Predicted partner points are drawn with an ellipse of this many standard
+# deviations, which also bounds the cross-correlation search around them.
+PREDICTION_N_SIGMA = 2.0
+# Smallest half width in pixels of the view zoomed to a predicted point.
+PREDICTION_MINIMUM_ZOOM = 50
+
+
+def open_correlation_window(main_gui, fluorescence_image, fibsem_image, output_path,
+                            adorned_fibsem_image=None):
     """Opens a new window to perform correlation
 
     Parameters
@@ -37,44 +64,20 @@ def open_correlation_window(main_gui, fluorescence_image, fibsem_image, output_p
     fibsem_image : expecting Adorned Image or path to Adorned image
 
     output_path : path to save location
+
+    adorned_fibsem_image : Adorned Image, optional
+        Source of the FIBSEM metadata used to look up and store cached
+        transforms. By default, `fibsem_image` is used if it has metadata.
     """
-    global img1
-    global img2
-    global img1_path
-    global img2_path
-    global gui
-    global output
-    global fluorescence_original
-
-    gui = main_gui
-    fluorescence_original = fluorescence_image
-
-    if type(fluorescence_image) == str:
-        print("Image 1 given as path")
-        fluorescence_image_rgb = skimage.color.gray2rgb(plt.imread(fluorescence_image))
-    else:
-        print("Image 1 given as array")
-        fluorescence_image_rgb = np.copy(fluorescence_image)
-
-    if type(fibsem_image) == str:
-        print("Image 2 given as path")
-        fibsem_image = skimage.color.gray2rgb(plt.imread(fibsem_image))
-    else:
-        fibsem_data = np.copy(fibsem_image.data)
-        print("Image 2 given as array")
-        fibsem_image = skimage.color.gray2rgb(fibsem_data)
-
-        fluorescence_image_rgb = skimage.transform.resize(fluorescence_image_rgb, fibsem_image.shape)
-
-    img1 = fluorescence_image_rgb
-    img2 = fibsem_image
-    output = output_path
-
-    window = _CorrelationWindow(parent=gui)
+    session = CorrelationSession(fluorescence_image, fibsem_image, output_path,
+                                 adorned_fibsem_image=adorned_fibsem_image)
+    window = _CorrelationWindow(session, parent=main_gui)
     return window
 
 
-def correlate_images(fluorescence_image_rgb, fibsem_image, output, matched_points_dict):
+@tracing.traced('correlation', arguments=('method',))
+def correlate_images(fluorescence_image_rgb, fibsem_image, output, matched_points_dict,
+                     geometry=None, method='affine', warp_maps=None):
     """Correlates two images using points chosen by the user
 
     Parameters
@@ -88,6 +91,18 @@ def correlate_images(fluorescence_image_rgb, fibsem_image, output, matched_point
 
     matched_points_dict : dict
     Dictionary of points selected in the correlation window
+
+    geometry : dict, optional
+        Image geometry from `image_geometry`, stored with the transform so
+        it can be reused for new images with the same geometry.
+
+    method : str, optional
+        'affine', 'polynomial' or 'tps' (thin-plate spline).
+        By default 'affine'.
+
+    warp_maps : list, optional
+        The cached warp map used is appended to it, see
+        `CorrelationSession.warp_maps`.
     """
     if matched_points_dict == []:
         print('No control points selected, exiting.')
@@ -95,25 +110,136 @@ def correlate_images(fluorescence_image_rgb, fibsem_image, output, matched_point
 
     src, dst = point_coords(matched_points_dict)
     transformation = calculate_transform(src, dst)
-    fluorescence_image_aligned = apply_transform(fluorescence_image_rgb, transformation)
-    result = overlay_images(fluorescence_image_aligned, fibsem_image.data)
-    result = skimage.util.img_as_ubyte(result)
+    with tracing.span('warp', 'correlation', method=method,
+                      shape=fluorescence_image_rgb.shape):
+        if method == 'affine':
+            fluorescence_image_aligned = apply_transform(fluorescence_image_rgb,
+                                                         transformation)
+        else:
+            warp_map = get_point_warp_map(src, dst,
+                                          fluorescence_image_rgb.shape,
+                                          method=method)
+            if warp_maps is not None:
+                warp_maps.append(warp_map)
+            fluorescence_image_aligned = warp_map.warp(fluorescence_image_rgb)
+    with tracing.span('overlay_images', 'correlation'):
+        result = overlay_images(fluorescence_image_aligned, fibsem_image.data)
+        result = skimage.util.img_as_ubyte(result)
 
     # TODO: the only imports here should be numpy arrays, not AdornedImagE
     # TODO: get rid of this, saving should happen outside the function
     # overlay_adorned_image = AdornedImage(result)
     # overlay_adorned_image.metadata = gui.fibsem_image.metadata
-    # save_text(output, transformation, matched_points_dict)
-    # plt.imsave(output, result)
     # overlay_adorned_image.save(output)
+    if output:
+        with tracing.span('save_image', 'save', filename=output):
+            skimage.io.imsave(output, result)
+            save_text(output, transformation, matched_points_dict)
+            save_transform(output, transformation, matched_points_dict,
+                           geometry, method=method)
 
     return result#, overlay_adorned_image, fluorescence_image_rgb, fluorescence_original
 
 
+class CorrelationSession:
+    """Input images and output location of one correlation.
+
+    The session keeps references to the images it is given, and derives the
+    RGB and resized images needed for display and correlation only when
+    they are first used. Call `close` to release all of them.
+
+    Parameters
+    ----------
+    fluorescence_image : numpy.array with shape: (rows, columns) or path
+        to numpy.array with shape: (rows, columns)
+    fibsem_image : expecting Adorned Image or path to Adorned image
+    output_path : path to save location
+    adorned_fibsem_image : Adorned Image, optional
+        Source of the FIBSEM metadata used to look up and store cached
+        transforms. By default, `fibsem_image` is used if it has metadata.
+    """
+    def __init__(self, fluorescence_image, fibsem_image, output_path,
+                 adorned_fibsem_image=None):
+        if adorned_fibsem_image is None and hasattr(fibsem_image, 'metadata'):
+            adorned_fibsem_image = fibsem_image
+        self.fluorescence_image = fluorescence_image
+        self.fibsem_image = fibsem_image
+        self.adorned_fibsem_image = adorned_fibsem_image
+        self.output_path = output_path
+        self._fluorescence_rgb = None
+        self._fibsem_rgb = None
+        self._geometry = None
+        # full size warp maps computed for this session, released on close
+        self.warp_maps = []
+
+    @property
+    def fibsem_rgb(self):
+        """FIBSEM image as a 2D RGB array."""
+        if self._fibsem_rgb is None:
+            if isinstance(self.fibsem_image, str):
+                image = plt.imread(self.fibsem_image)
+            elif isinstance(self.fibsem_image, np.ndarray):
+                image = self.fibsem_image
+            else:
+                image = np.asarray(self.fibsem_image.data)
+            if image.ndim == 2:
+                image = skimage.color.gray2rgb(image)
+            self._fibsem_rgb = image
+        return self._fibsem_rgb
+
+    @property
+    def fluorescence_rgb(self):
+        """Fluorescence image as a 2D RGB array, resized to the FIBSEM image."""
+        if self._fluorescence_rgb is None:
+            if isinstance(self.fluorescence_image, str):
+                image = plt.imread(self.fluorescence_image)
+            else:
+                image = self.fluorescence_image
+            if image.ndim == 2:
+                image = skimage.color.gray2rgb(image)
+            if image.shape != self.fibsem_rgb.shape:
+                image = skimage.transform.resize(image, self.fibsem_rgb.shape)
+            elif image.dtype != np.uint8:
+                image = skimage.img_as_float(image)
+            self._fluorescence_rgb = image
+        return self._fluorescence_rgb
+
+    @property
+    def geometry(self):
+        """Image geometry for transform caching, or None without metadata."""
+        if self._geometry is None and self.adorned_fibsem_image is not None:
+            self._geometry = image_geometry(self.adorned_fibsem_image,
+                                            self.fluorescence_rgb.shape)
+        return self._geometry
+
+    @property
+    def closed(self):
+        return self.fibsem_image is None
+
+    def close(self):
+        """Release the input images and everything derived from them,
+        including the full size warp maps computed for them. Warp maps
+        cached for other sessions are kept."""
+        self.fluorescence_image = None
+        self.fibsem_image = None
+        self.adorned_fibsem_image = None
+        self._fluorescence_rgb = None
+        self._fibsem_rgb = None
+        release_warp_maps(self.warp_maps)
+        self.warp_maps = []
+
+
 class _CorrelationWindow(QMainWindow):
     """Main correlation window"""
-    def __init__(self, parent=None):
+    def __init__(self, session, parent=None):
         super().__init__(parent=parent)
+        self.session = session
+        self.cached_transform = None
+        if session.geometry is not None and session.output_path:
+            self.cached_transform = find_cached_transform(
+                os.path.dirname(session.output_path), session.geometry)
+        self._preview_worker = None
+        self._preview_pending = False
         self.create_window()
         self.create_conn()
 
@@ -141,13 +267,13 @@ class _CorrelationWindow(QMainWindow):
         hlay.addLayout(vlay)
         hlay.addLayout(vlay2)
 
-        self.wp = _WidgetPlot(self)
+        self.wp = _WidgetPlot(self.session, self)
         vlay.addWidget(self.wp)
 
         self.help = QTextEdit()
         self.help.setReadOnly(True)
         self.help.setMaximumWidth(400)
-        self.help.setMinimumHeight(540)
+        self.help.setMinimumHeight(300)
 
         help_header = '<!DOCTYPE html><html lang="de" ' \
                       'id="main"><head><meta charset="UTF-8"><title>' \
@@ -189,6 +315,11 @@ class _CorrelationWindow(QMainWindow):
             os.path.join(os.path.dirname(__file__), "img/zoomboxbutton.png"),
         )
         self.help.insertHtml(help_html)
+
+        self.preview = _PreviewCanvas(self)
+        self.preview.setMaximumWidth(400)
+        self.preview.setFixedHeight(300)
+
         self.cpTabelModel = QStandardItemModel(self)
         self.cpTable = QTableView(self)
         self.cpTable.setModel(self.cpTabelModel)
@@ -197,6 +328,30 @@ class _CorrelationWindow(QMainWindow):
         self.delButton = QPushButton("Delete selected Control Point")
         self.delButton.setStyleSheet("font-size: 16px")
 
+        hlay_refine = QHBoxLayout()
+        refineLabel = QLabel("Point refinement:")
+        refineLabel.setStyleSheet("font-size: 14px")
+        self.refineCombo = QComboBox()
+        self.refineCombo.addItem("None", None)
+        self.refineCombo.addItem("Intensity centroid", "centroid")
+        self.refineCombo.addItem("Gaussian fit", "gaussian")
+        hlay_refine.addWidget(refineLabel)
+        hlay_refine.addWidget(self.refineCombo)
+        hlay_method = QHBoxLayout()
+        methodLabel = QLabel("Transform:")
+        methodLabel.setStyleSheet("font-size: 14px")
+        self.methodCombo = QComboBox()
+        self.methodCombo.addItem("Affine", "affine")
+        self.methodCombo.addItem("Polynomial (6+ points)", "polynomial")
+        self.methodCombo.addItem("Thin-plate spline", "tps")
+        hlay_method.addWidget(methodLabel)
+        hlay_method.addWidget(self.methodCombo)
+        self.crossCorrelationCheck = QCheckBox(
+            "Match second point of a pair by cross-correlation")
+        self.predictCheck = QCheckBox(
+            "Predict and zoom to the partner point (3+ pairs)")
+        self.predictCheck.setChecked(True)
+
         self.pickButton = QPushButton("pick mode")
         self.pickButton.setFixedHeight(60)
         self.pickButton.setStyleSheet("color: red; font-size: 16px;")
@@ -205,9 +360,25 @@ class _CorrelationWindow(QMainWindow):
         self.exitButton.setFixedHeight(60)
         self.exitButton.setStyleSheet("font-size: 16px;")
 
+        self.cachedButton = QPushButton("Reapply cached transform")
+        self.cachedButton.setStyleSheet("font-size: 16px")
+        if self.cached_transform is None:
+            self.cachedButton.setEnabled(False)
+            self.cachedButton.setToolTip(
+                "No saved transform matches the geometry of these images.")
+        else:
+            self.cachedButton.setToolTip(
+                "Saved {}".format(self.cached_transform['timestamp']))
+
         vlay2.addWidget(self.help)
+        vlay2.addWidget(self.preview)
         vlay2.addWidget(self.cpTable)
         vlay2.addWidget(self.delButton)
+        vlay2.addWidget(self.cachedButton)
+        vlay2.addLayout(hlay_method)
+        vlay2.addLayout(hlay_refine)
+        vlay2.addWidget(self.crossCorrelationCheck)
+        vlay2.addWidget(self.predictCheck)
 
         vlay2.addLayout(hlay_buttons)
         hlay_buttons.addWidget(self.pickButton)
@@ -219,12 +390,96 @@ class _CorrelationWindow(QMainWindow):
     def create_conn(self):
         self.pickButton.clicked.connect(self.pickmodechange)
         self.delButton.clicked.connect(self.delCP)
+        self.cachedButton.clicked.connect(self.applyCachedTransform)
+        self.methodCombo.currentIndexChanged.connect(self.requestPreview)
+        self.refineCombo.currentIndexChanged.connect(self.refinementChanged)
+        self.crossCorrelationCheck.toggled.connect(self.refinementChanged)
+        self.predictCheck.toggled.connect(self.refinementChanged)
+        self.wp.canvas.controlPointsChanged.connect(self.requestPreview)
+
+    def requestPreview(self):
+        """Re-warp the low resolution preview with the current point pairs.
+
+        Only one preview worker runs at a time. Requests arriving while it is
+        busy are collapsed into a single re-run with the latest points.
+        """
+        if self.session.closed:
+            return
+        if self._preview_worker is not None and self._preview_worker.isRunning():
+            self._preview_pending = True
+            return
+        self._preview_pending = False
+        matched_points_dict = complete_points(self.get_dictlist())
+        method = self.methodCombo.currentData()
+        if len(matched_points_dict) < MINIMUM_POINTS[method]:
+            self.preview.clear(MINIMUM_POINTS[method])
+            return
+        worker = _PreviewWorker(
+            self.session.fluorescence_rgb, self.session.fibsem_rgb,
+            matched_points_dict, method=method, parent=self)
+        worker.preview_ready.connect(self.preview.show_image)
+        worker.finished.connect(lambda: self._preview_finished(worker))
+        worker.finished.connect(worker.deleteLater)
+        self._preview_worker = worker
+        worker.start()
+
+    def _preview_finished(self, worker):
+        if self._preview_worker is worker:
+            self._preview_worker = None
+        if self._preview_pending:
+            self.requestPreview()
+
+    def closeEvent(self, event):
+        if self._preview_worker is not None:
+            self._preview_pending = False
+            self._preview_worker.wait()
+        self.wp.canvas.fig.clear()
+        self.preview.fig.clear()
+        self.session.close()
+        super().closeEvent(event)
+
+    def applyCachedTransform(self):
+        """Replace the control points with those of the cached transform."""
+        if self.cached_transform is None:
+            return
+        canvas = self.wp.canvas
+        canvas.CPlist = []
+        canvas.CPactive = None
+        for point in self.cached_transform['control_points']:
+            canvas.CPlist.append(_ControlPoint.from_dict(point, canvas))
+        canvas.lastIDP = max([cp.idp for cp in canvas.CPlist], default=0)
+        index = self.methodCombo.findData(
+            self.cached_transform.get('method', 'affine'))
+        if index >= 0:
+            self.methodCombo.setCurrentIndex(index)
+        canvas.updateCanvas()
+        canvas.cpChanged = True
+        self.updateCPtable()
+        canvas.controlPointsChanged.emit()
+        self.statusBar().showMessage(
+            "Loaded cached transform from {}. Press Return to apply it.".format(
+                self.cached_transform['timestamp']))
+
+    def refinementChanged(self):
+        self.wp.canvas.refineMethod = self.refineCombo.currentData()
+        self.wp.canvas.refineCrossCorrelation = \
+            self.crossCorrelationCheck.isChecked()
+        self.wp.canvas.predictPartner = self.predictCheck.isChecked()
 
     def menu_quit(self):
-        matched_points_dict = self.get_dictlist()
+        matched_points_dict = complete_points(self.get_dictlist())
         # TODO: correlation fix
         # result, overlay_adorned_image, fluorescence_image_rgb, fluorescence_original = correlate_images(img1, img2, output, matched_points_dict)
-        result = correlate_images(img1, img2, output, matched_points_dict)
+        session = self.session
+        method = self.methodCombo.currentData()
+        if 0 < len(matched_points_dict) < MINIMUM_POINTS[method]:
+            print('The {} transform needs at least {} control points, '
+                  'using an affine transform.'.format(method, MINIMUM_POINTS[method]))
+            method = 'affine'
+        result = correlate_images(session.fluorescence_rgb, session.fibsem_rgb,
+                                  session.output_path, matched_points_dict,
+                                  geometry=session.geometry, method=method,
+                                  warp_maps=session.warp_maps)
         self.close()
         # return result, overlay_adorned_image, fluorescence_image_rgb, fluorescence_original, output, matched_points_dict
         return result
@@ -271,8 +526,11 @@ class _CorrelationWindow(QMainWindow):
                 print("Error occured: '{}'".format(e))
                 pass
 
+        if self.wp.canvas.CPactive not in self.wp.canvas.CPlist:
+            self.wp.canvas.prediction = None
         self.wp.canvas.updateCanvas()
         self.wp.canvas.cpChanged = True
+        self.wp.canvas.controlPointsChanged.emit()
 
     def updateGUI(self):
         if self.wp.canvas.toolbar._active not in ["", None]:
@@ -326,19 +584,72 @@ class _CorrelationWindow(QMainWindow):
 
 
 class _WidgetPlot(QWidget):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, session, *args, **kwargs):
         QWidget.__init__(self, *args, **kwargs)
         self.setLayout(QVBoxLayout())
-        self.canvas = _PlotCanvas(self)
+        self.canvas = _PlotCanvas(session, self)
         self.toolbar = NavigationToolbar(self.canvas, self)
         self.layout().addWidget(self.toolbar)
         self.layout().addWidget(self.canvas)
 
 
-class _PlotCanvas(FigureCanvas):
+class _PreviewCanvas(FigureCanvas):
+    """Small canvas showing the low resolution overlay preview."""
     def __init__(self, parent=None):
         self.fig = Figure()
         FigureCanvas.__init__(self, self.fig)
+        self.setParent(parent)
+        self.ax = self.fig.add_axes(
+            [0, 0, 1, 1], xticks=[], yticks=[])
+        self.clear()
+
+    def clear(self, minimum_points=MINIMUM_POINTS['affine']):
+        """Show the placeholder, asking for the points the method needs."""
+        self.ax.clear()
+        self.ax.set_axis_off()
+        self.ax.text(0.5, 0.5, "Overlay preview\n(pick at least {} point "
+                     "pairs)".format(minimum_points),
+                     ha="center", va="center", transform=self.ax.transAxes)
+        self.draw_idle()
+
+    def show_image(self, image):
+        self.ax.clear()
+        self.ax.set_axis_off()
+        self.ax.imshow(image)
+        self.draw_idle()
+
+
+class _PreviewWorker(QThread):
+    """Computes the low resolution overlay preview off the GUI thread."""
+    preview_ready = pyqtSignal(object)
+
+    def __init__(self, fluorescence_image_rgb, fibsem_image,
+                 matched_points_dict, method='affine', parent=None):
+        super().__init__(parent)
+        self.fluorescence_image_rgb = fluorescence_image_rgb
+        self.fibsem_image = fibsem_image
+        self.matched_points_dict = matched_points_dict
+        self.method = method
+
+    def run(self):
+        try:
+            result = preview_overlay(self.fluorescence_image_rgb,
+                                     self.fibsem_image,
+                                     self.matched_points_dict,
+                                     method=self.method)
+        except Exception:
+            logger.warning("Error occured in overlay preview", exc_info=True)
+        else:
+            self.preview_ready.emit(result)
+
+
+class _PlotCanvas(FigureCanvas):
+    controlPointsChanged = pyqtSignal()
+
+    def __init__(self, session, parent=None):
+        self.session = session
+        self.fig = Figure()
+        FigureCanvas.__init__(self, self.fig)
 
         self.setParent(parent)
         FigureCanvas.setSizePolicy(
@@ -357,6 +668,10 @@ class _PlotCanvas(FigureCanvas):
         self.cursorChanged = False
         self.CPlist = []
         self.lastIDP = 0
+        self.refineMethod = None
+        self.refineCrossCorrelation = False
+        self.predictPartner = True
+        self.prediction = None  # (axes, x, y, covariance)
 
     def plot(self):
         gs0 = self.fig.add_gridspec(1, 2)
@@ -366,8 +681,8 @@ class _PlotCanvas(FigureCanvas):
         self.ax12 = self.fig.add_subplot(
             gs0[1], xticks=[], yticks=[], title="Image 2: Select Points")
 
-        self.ax11.imshow(img1)
-        self.ax12.imshow(img2)
+        self.ax11.imshow(self.session.fluorescence_rgb)
+        self.ax12.imshow(self.session.fibsem_rgb)
 
     def updateCanvas(self, event=None):
         ax11_xlim = self.ax11.get_xlim()
@@ -412,6 +727,17 @@ class _PlotCanvas(FigureCanvas):
                 self.ax12.add_patch(symb1)
                 self.ax12.add_patch(symb2)
 
+        if (self.prediction is not None and self.CPactive is not None
+                and not self.CPactive.status_complete):
+            axes, x, y, covariance = self.prediction
+            units = ax11_units if axes == self.ax11 else ax12_units
+            width, height, angle = ellipse_parameters(
+                covariance, PREDICTION_N_SIGMA)
+            axes.add_patch(Ellipse((x, y), width, height, angle=angle,
+                                   fill=False, color="yellow", linestyle="--"))
+            axes.add_patch(plt.Circle(
+                (x, y), units * 1, fill=True, color="yellow"))
+
         self.fig.canvas.draw()
 
     def createConn(self):
@@ -449,19 +775,93 @@ class _PlotCanvas(FigureCanvas):
         if self.pickmode and (
             (event.inaxes == self.ax11) or (event.inaxes == self.ax12)
         ):
+            x, y = self.refineClick(x, y, event.inaxes)
 
             if self.CPactive and not self.CPactive.status_complete:
                 self.CPactive.appendCoord(x, y)
                 self.cpChanged = True
+                if self.CPactive.status_complete:
+                    self.prediction = None
+                    self.controlPointsChanged.emit()
             else:
                 idp = self.lastIDP + 1
                 cp = _ControlPoint(idp, x, y, self)
                 self.CPlist.append(cp)
                 self.cpChanged = True
                 self.lastIDP += 1
+                self.predictPartnerOf(cp)
 
             self.updateCanvas()
 
+    def predictPartnerOf(self, cp):
+        """Predict where the partner of a new point is, and zoom to it."""
+        self.prediction = None
+        pairs = [p for p in self.CPlist if p.status_complete]
+        if not self.predictPartner or len(pairs) < 3:
+            return
+        img1 = [[p.img1x, p.img1y] for p in pairs]
+        img2 = [[p.img2x, p.img2y] for p in pairs]
+        if cp.img1x is not None:
+            axes, x, y, points_from, points_to = self.ax12, cp.img1x, cp.img1y, img1, img2
+        else:
+            axes, x, y, points_from, points_to = self.ax11, cp.img2x, cp.img2y, img2, img1
+        try:
+            x_predicted, y_predicted, covariance = predict_point(
+                points_from, points_to, x, y)
+        except Exception as e:
+            print("Error occured in point prediction: '{}'".format(e))
+            return
+        self.prediction = (axes, x_predicted, y_predicted, covariance)
+        sigma = np.sqrt(np.linalg.eigvalsh(covariance)[-1])
+        half_width = max(4 * PREDICTION_N_SIGMA * sigma, PREDICTION_MINIMUM_ZOOM)
+        axes.set_xlim(x_predicted - half_width, x_predicted + half_width)
+        axes.set_ylim(y_predicted + half_width, y_predicted - half_width)
+
+    def predictedSearch(self, x, y, axes):
+        """Bound the cross-correlation search by the predicted partner point.
+
+        Returns
+        -------
+        (x, y, search_radius)
+            The predicted point and the radius of its uncertainty ellipse
+            if the click lies inside the ellipse, otherwise the click and
+            the default search radius.
+        """
+        if self.prediction is None or self.prediction[0] != axes:
+            return x, y, 10
+        _, x_predicted, y_predicted, covariance = self.prediction
+        offset = np.array([x - x_predicted, y - y_predicted])
+        if offset @ np.linalg.solve(covariance, offset) > PREDICTION_N_SIGMA ** 2:
+            return x, y, 10  # the user overrode the prediction
+        sigma = np.sqrt(np.linalg.eigvalsh(covariance)[-1])
+        return x_predicted, y_predicted, int(np.ceil(PREDICTION_N_SIGMA * sigma))
+
+    def refineClick(self, x, y, axes):
+        """Apply the selected subpixel refinement to a picked point."""
+        img1 = self.session.fluorescence_rgb
+        img2 = self.session.fibsem_rgb
+        cp = self.CPactive
+        if self.refineCrossCorrelation and cp and not cp.status_complete:
+            x_search, y_search, radius = self.predictedSearch(x, y, axes)
+            try:
+                if axes == self.ax12 and cp.img1x is not None:
+                    return refine_cross_correlation(
+                        img1, cp.img1x, cp.img1y, img2, x_search, y_search,
+                        search_radius=radius)
+                elif axes == self.ax11 and cp.img2x is not None:
+                    return refine_cross_correlation(
+                        img2, cp.img2x, cp.img2y, img1, x_search, y_search,
+                        search_radius=radius)
+            except Exception as e:
+                print("Error occured in point refinement: '{}'".format(e))
+        if self.refineMethod is not None:
+            image = img1 if axes == self.ax11 else img2
+            try:
+                return refine_point(image, x, y, method=self.refineMethod)
+            except Exception as e:
+                print("Error occured in point refinement: '{}'".format(e))
+        return x, y
+
 
 class _ControlPoint:
     def __init__(self, idp, x, y, other):
@@ -477,6 +877,19 @@ class _ControlPoint:
 
         self.appendCoord(x, y)
 
+    @classmethod
+    def from_dict(cls, point, other):
+        """Create a complete control point from a `getdict` dictionary."""
+        cp = cls.__new__(cls)
+        cp.idp = point["point_id"]
+        cp.img1x = point["img1_x"]
+        cp.img1y = point["img1_y"]
+        cp.img2x = point["img2_x"]
+        cp.img2y = point["img2_y"]
+        cp.status_complete = True
+        cp.mn = other
+        return cp
+
     def appendCoord(self, x, y):
 
         if self.mn.axesActive == self.mn.ax11 and self.img1x is None:
@@ -539,169 +952,3 @@ class _ControlPoint:
         }
 
         return dict
-
-
-def point_coords(matched_points_dict):
-    """Create source & destination coordinate numpy arrays from cpselect dict.
-
-    Matched points is an array where:
-    * the number of rows is equal to the number of points selected.
-    * the first column is the point index label.
-    * the second and third columns are the source x, y coordinates.
-    * the last two columns are the destination x, y coordinates.
-
-    Parameters
-    ----------
-    matched_points_dict : dict
-        Dictionary returned from cpselect containing matched point coordinates.
-
-    Returns
-    -------
-    (src, dst)
-        Row, column coordaintes of source and destination matched points.
-        Tuple contains two N x 2 ndarrays, where N is the number of points.
-    """
-
-    matched_points = np.array([list(point.values())
-                               for point in matched_points_dict])
-    src = np.flip(matched_points[:, 1:3], axis=1)  # flip for row, column index
-    dst = np.flip(matched_points[:, 3:], axis=1)   # flip for row, column index
-
-    return src, dst
-
-
-def calculate_transform(src, dst, model=AffineTransform()):
-    """Calculate transformation matrix from matched coordinate pairs.
-
-    Parameters
-    ----------
-    src : ndarray
-        Matched row, column coordinates from source image.
-    dst : ndarray
-        Matched row, column coordinates from destination image.
-    model : scikit-image transformation class, optional.
-        By default, model=AffineTransform()
-
-
-    Returns
-    -------
-    ndarray
-        Transformation matrix.
-    """
-
-    model.estimate(src, dst)
-    print('Transformation matrix:')
-    print(model.params)
-
-    return model.params
-
-
-def apply_transform(image, transformation, inverse=True, multichannel=True):
-    """Apply transformation to a 2D image.
-
-    Parameters
-    ----------
-    image : ndarray
-        Input image array. 2D grayscale image expected, or
-        2D plus color channels if multichannel kwarg is set to True.
-    transformation : ndarray
-        Affine transformation matrix. 3 x 3 shape.
-    inverse : bool, optional
-        Inverse transformation, eg: aligning source image coords to destination
-        By default `inverse=True`.
-    multichannel : bool, optional
-        Treat the last dimension as color, transform each color separately.
-        By default `multichannel=True`.
-
-    Returns
-    -------
-    ndarray
-        Image warped by transformation matrix.
-    """
-
-    if inverse:
-        transformation = np.linalg.inv(transformation)
-
-    if not multichannel:
-        if image.ndim == 2:
-            image = skimage.color.gray2rgb(image)
-        elif image.ndim != transformation.shape[0] - 1:
-            raise ValueError('Unexpected number of image dimensions for the '
-                             'input transformation. Did you need to use: '
-                             'multichannel=True ?')
-
-    # move channel axis to the front for easier iteration over array
-    image = np.moveaxis(image, -1, 0)
-    warped_img = np.array([ndi.affine_transform((img_channel), transformation)
-                           for img_channel in image])
-    warped_img = np.moveaxis(warped_img, 0, -1)
-
-    return warped_img
-
-
-def overlay_images(fluorescence_image, fibsem_image, transparency=0.5):
-    """Blend two RGB images together.
-
-    Parameters
-    ----------
-    fluorescence_image : ndarray
-        2D RGB image.
-    fibsem_image : ndarray
-        2D RGB image.
-    transparency : float, optional
-        Transparency alpha parameter between 0 - 1, by default 0.5
-
-    Returns
-    -------
-    ndarray
-        Blended 2D RGB image.
-    """
-
-    fluorescence_image = skimage.img_as_float(fluorescence_image)
-    fibsem_image = skimage.img_as_float(fibsem_image)
-    blended = transparency * fluorescence_image + (1 - transparency) * fibsem_image
-    blended = np.clip(blended, 0, 1)
-
-    return blended
-
-
-def save_text(output_filename, transformation, matched_points_dict):
-    """Save text summary of transformation matrix and image control points.
-
-    Parameters
-    ----------
-    output_filename : str
-        Filename for saving output overlay image file.
-    transformation : ndarray
-        Transformation matrix relating the two images.
-    matched_points_dict : list of dict
-        User selected matched control point pairs.
-
-    Returns
-    -------
-    str
-        Filename of output text file.
-    """
-
-    output_text_filename = os.path.splitext(output_filename)[0] + '.txt'
-    with open(output_text_filename, 'w') as f:
-        f.write(_timestamp() + '\n')
-        f.write('PIEScope GUI version {}\n'.format(__version__))
-        f.write('\nTRANSFORMATION MATRIX\n')
-        f.write(str(transformation) + '\n')
-        f.write('\nUSER SELECTED CONTROL POINTS\n')
-        f.write(str(matched_points_dict) + '\n')
-
-    return output_text_filename
-
-
-def _timestamp():
-    """Create timestamp string of current local time.
-
-    Returns
-    -------
-    str
-        Timestamp string
-    """
-    timestamp = time.strftime('%d-%b-%Y_%H-%M%p', time.localtime())
-    return timestamp
@@ -0,0 +1,266 @@
+"""Subpixel refinement of control points picked in the correlation window.
+
+Coordinates follow the matplotlib convention used by the correlation
+window: x is the column and y is the row, with pixel centres on integers.
+"""
+import numpy as np
+import scipy.optimize
+import skimage.color
+import skimage.feature
+
+REFINEMENT_METHODS = ('centroid', 'gaussian')
+
+
+def refine_point(image, x, y, method='centroid', window=7):
+    """Snap a picked point to a nearby intensity feature.
+
+    Parameters
+    ----------
+    image : ndarray
+        2D grayscale or RGB image.
+    x, y : float
+        Picked column, row coordinates.
+    method : str, optional
+        'centroid' or 'gaussian', by default 'centroid'.
+    window : int, optional
+        Half width of the square search window in pixels, by default 7.
+
+    Returns
+    -------
+    (x, y)
+        Refined column, row coordinates.
+    """
+    if method == 'centroid':
+        return refine_centroid(image, x, y, window=window)
+    elif method == 'gaussian':
+        return refine_gaussian(image, x, y, window=window)
+    else:
+        raise ValueError("Unknown refinement method '{}', expected one of "
+                         "{}".format(method, REFINEMENT_METHODS))
+
+
+def refine_centroid(image, x, y, window=7):
+    """Intensity weighted centroid in a small window around a point.
+
+    The local minimum is subtracted as background before weighting.
+    If the window is empty or flat the point is returned unchanged.
+
+    Parameters
+    ----------
+    image : ndarray
+        2D grayscale or RGB image.
+    x, y : float
+        Picked column, row coordinates.
+    window : int, optional
+        Half width of the square window in pixels, by default 7.
+
+    Returns
+    -------
+    (x, y)
+        Refined column, row coordinates.
+    """
+    patch, row0, col0 = _patch(image, x, y, window)
+    if patch.size == 0:
+        return x, y
+    weights = patch - patch.min()
+    total = weights.sum()
+    if total <= 0:
+        return x, y
+    rows, cols = np.indices(patch.shape)
+    y_refined = row0 + (rows * weights).sum() / total
+    x_refined = col0 + (cols * weights).sum() / total
+    return float(x_refined), float(y_refined)
+
+
+def refine_gaussian(image, x, y, window=7):
+    """Peak of a 2D Gaussian fitted in a small window around a point.
+
+    Falls back to the intensity centroid if the fit fails or the fitted
+    peak lies outside the window.
+
+    Parameters
+    ----------
+    image : ndarray
+        2D grayscale or RGB image.
+    x, y : float
+        Picked column, row coordinates.
+    window : int, optional
+        Half width of the square window in pixels, by default 7.
+
+    Returns
+    -------
+    (x, y)
+        Refined column, row coordinates.
+    """
+    patch, row0, col0 = _patch(image, x, y, window)
+    x_centroid, y_centroid = refine_centroid(image, x, y, window=window)
+    if patch.size == 0 or patch.max() == patch.min():
+        return x_centroid, y_centroid
+    rows, cols = np.indices(patch.shape)
+    coords = np.vstack([rows.ravel(), cols.ravel()])
+    initial = [patch.max() - patch.min(),
+               y_centroid - row0, x_centroid - col0,
+               max(window / 3., 1.), patch.min()]
+    try:
+        params, _ = scipy.optimize.curve_fit(
+            _gaussian, coords, patch.ravel(), p0=initial, maxfev=2000)
+    except (RuntimeError, ValueError):
+        return x_centroid, y_centroid
+    amplitude, row, col = params[:3]
+    if (amplitude <= 0 or not 0 <= row <= patch.shape[0] - 1
+            or not 0 <= col <= patch.shape[1] - 1):
+        return x_centroid, y_centroid
+    return float(col0 + col), float(row0 + row)
+
+
+def refine_cross_correlation(reference_image, x_reference, y_reference,
+                             image, x, y, template_size=15, search_radius=10):
+    """Refine a point by matching its partner point's neighbourhood.
+
+    A template around the reference point is matched by normalised
+    cross-correlation within `search_radius` pixels of (x, y), and the
+    correlation peak is located to subpixel precision with a parabolic fit.
+
+    Parameters
+    ----------
+    reference_image : ndarray
+        2D grayscale or RGB image containing the already picked point.
+    x_reference, y_reference : float
+        Column, row coordinates of the already picked point.
+    image : ndarray
+        2D grayscale or RGB image containing the point to refine.
+    x, y : float
+        Picked column, row coordinates to refine.
+    template_size : int, optional
+        Half width of the template in pixels, by default 15.
+    search_radius : int, optional
+        Maximum distance in pixels the point may move, by default 10.
+
+    Returns
+    -------
+    (x, y)
+        Refined column, row coordinates.
+        The point is returned unchanged if it is too close to the image
+        edges or the template has no contrast.
+    """
+    template, _, _ = _patch(reference_image, x_reference, y_reference,
+                            template_size)
+    size = 2 * template_size + 1
+    if template.shape != (size, size) or template.max() == template.min():
+        return x, y
+    search, row0, col0 = _patch(image, x, y, template_size + search_radius)
+    if search.shape[0] < size or search.shape[1] < size:
+        return x, y
+    ncc = skimage.feature.match_template(search, template)
+    peak_row, peak_col = np.unravel_index(np.argmax(ncc), ncc.shape)
+    row = peak_row + _parabolic_offset(ncc[:, peak_col], peak_row)
+    col = peak_col + _parabolic_offset(ncc[peak_row, :], peak_col)
+    # match_template returns the position of the template's top left corner
+    return (float(col0 + col + template_size),
+            float(row0 + row + template_size))
+
+
+def predict_point(points_from, points_to, x, y, minimum_sigma=2.0):
+    """Predict where a point's partner is, from the point pairs so far.
+
+    An affine transform is fitted by least squares to the existing pairs.
+    The uncertainty of the prediction combines the scatter of the fit
+    residuals with the extrapolation error of the fit at (x, y), and is
+    never smaller than `minimum_sigma` pixels.
+
+    Parameters
+    ----------
+    points_from : ndarray
+        N x 2 column, row coordinates of complete pairs in the image
+        the new point was picked in. N must be at least three.
+    points_to : ndarray
+        N x 2 column, row coordinates of the same pairs in the other image.
+    x, y : float
+        Column, row coordinates of the new point.
+    minimum_sigma : float, optional
+        Smallest standard deviation in pixels, by default 2.0.
+
+    Returns
+    -------
+    (x, y, covariance)
+        Predicted column, row coordinates in the other image, and the
+        2 x 2 covariance matrix of the prediction in pixels squared.
+    """
+    points_from = np.asarray(points_from, dtype=float)
+    points_to = np.asarray(points_to, dtype=float)
+    n = len(points_from)
+    if n < 3:
+        raise ValueError("At least three point pairs are needed, got {}".format(n))
+    design = np.hstack([points_from, np.ones((n, 1))])
+    coefficients = np.linalg.lstsq(design, points_to, rcond=None)[0]
+    point = np.array([x, y, 1.])
+    prediction = point @ coefficients
+
+    residuals = points_to - design @ coefficients
+    if n > 3:
+        covariance = residuals.T @ residuals / (n - 3)
+    else:
+        covariance = np.zeros((2, 2))  # exact fit, no scatter estimate
+    leverage = point @ np.linalg.pinv(design.T @ design) @ point
+    covariance = covariance * (1 + leverage) + minimum_sigma ** 2 * np.eye(2)
+    return float(prediction[0]), float(prediction[1]), covariance
+
+
+def ellipse_parameters(covariance, n_sigma=2.0):
+    """Size and orientation of an uncertainty ellipse.
+
+    Parameters
+    ----------
+    covariance : ndarray
+        2 x 2 covariance matrix of column, row coordinates.
+    n_sigma : float, optional
+        Number of standard deviations the ellipse encloses, by default 2.
+
+    Returns
+    -------
+    (width, height, angle)
+        Full axis lengths in pixels and the angle in degrees of the first
+        axis from the x axis, as used by `matplotlib.patches.Ellipse`.
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    eigenvalues = np.clip(eigenvalues, 0, None)
+    width, height = 2 * n_sigma * np.sqrt(eigenvalues[::-1])
+    angle = np.degrees(np.arctan2(eigenvectors[1, -1], eigenvectors[0, -1]))
+    return float(width), float(height), float(angle)
+
+
+def _parabolic_offset(values, index):
+    """Subpixel offset of the peak at `index` from its two neighbours."""
+    if index == 0 or index == len(values) - 1:
+        return 0.
+    values = values[index - 1:index + 2]
+    denominator = values[0] - 2 * values[1] + values[2]
+    if denominator == 0:
+        return 0.
+    offset = 0.5 * (values[0] - values[2]) / denominator
+    return float(np.clip(offset, -0.5, 0.5))
+
+
+def _gaussian(coords, amplitude, row, col, sigma, offset):
+    rows, cols = coords
+    return offset + amplitude * np.exp(
+        -((rows - row) ** 2 + (cols - col) ** 2) / (2 * sigma ** 2))
+
+
+def _patch(image, x, y, half_width):
+    """Grayscale float window around (x, y), clipped to the image bounds.
+
+    Returns
+    -------
+    (patch, row0, col0)
+        Window array and the image row, column of its top left pixel.
+    """
+    row, col = int(round(y)), int(round(x))
+    row0 = max(row - half_width, 0)
+    col0 = max(col - half_width, 0)
+    row1 = min(row + half_width + 1, image.shape[0])
+    col1 = min(col + half_width + 1, image.shape[1])
+    patch = np.asarray(image[row0:row1, col0:col1])
+    if patch.ndim == 3:
+        patch = skimage.color.rgb2gray(patch[..., :3])
+    return patch.astype(float), row0, col0
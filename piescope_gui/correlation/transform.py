@@ -0,0 +1,871 @@
+"""Correlation image transformations, independent of the Qt user interface."""
+import collections
+import glob
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import scipy.ndimage as ndi
+import skimage
+import skimage.color
+import skimage.util
+from skimage.transform import AffineTransform, PolynomialTransform
+
+from piescope_gui._version import __version__
+
+# Maximum number of precomputed warp maps kept by `get_warp_map`.
+# Each map needs about 16 bytes per output pixel.
+WARP_MAP_CACHE_SIZE = 2
+_warp_map_cache = collections.OrderedDict()
+_warp_map_lock = threading.Lock()
+
+# Transform models that can relate fluorescence and FIBSEM images.
+# Non-linear models can correct the distortions an affine transform can't,
+# but need more control points: see `MINIMUM_POINTS`.
+TRANSFORM_METHODS = ('affine', 'polynomial', 'tps')
+MINIMUM_POINTS = {'affine': 3, 'polynomial': 6, 'tps': 3}
+
+
+def point_coords(matched_points_dict):
+    """Create source & destination coordinate numpy arrays from cpselect dict.
+
+    Matched points is an array where:
+    * the number of rows is equal to the number of points selected.
+    * the first column is the point index label.
+    * the second and third columns are the source x, y coordinates.
+    * the last two columns are the destination x, y coordinates.
+
+    Parameters
+    ----------
+    matched_points_dict : dict
+        Dictionary returned from cpselect containing matched point coordinates.
+
+    Returns
+    -------
+    (src, dst)
+        Row, column coordaintes of source and destination matched points.
+        Tuple contains two N x 2 ndarrays, where N is the number of points.
+    """
+
+    matched_points = np.array([list(point.values())
+                               for point in matched_points_dict])
+    src = np.flip(matched_points[:, 1:3], axis=1)  # flip for row, column index
+    dst = np.flip(matched_points[:, 3:], axis=1)   # flip for row, column index
+
+    return src, dst
+
+
+def complete_points(matched_points_dict):
+    """Keep only the control points picked in both images.
+
+    Parameters
+    ----------
+    matched_points_dict : list of dict
+        Control points from the correlation window, possibly including a
+        point that has so far only been picked in one of the two images.
+
+    Returns
+    -------
+    list of dict
+        Control points with coordinates in both images.
+    """
+    return [point for point in matched_points_dict
+            if None not in (point['img1_x'], point['img1_y'],
+                            point['img2_x'], point['img2_y'])]
+
+
+def calculate_transform(src, dst, model=None):
+    """Calculate transformation matrix from matched coordinate pairs.
+
+    Parameters
+    ----------
+    src : ndarray
+        Matched row, column coordinates from source image.
+    dst : ndarray
+        Matched row, column coordinates from destination image.
+    model : scikit-image transformation class, optional.
+        By default, a new AffineTransform() for every call.
+
+
+    Returns
+    -------
+    ndarray
+        Transformation matrix.
+    """
+    if model is None:
+        model = AffineTransform()
+    model.estimate(src, dst)
+    print('Transformation matrix:')
+    print(model.params)
+
+    return model.params
+
+
+def apply_transform(image, transformation, inverse=True, multichannel=True):
+    """Apply transformation to a 2D image.
+
+    Parameters
+    ----------
+    image : ndarray
+        Input image array. 2D grayscale image expected, or
+        2D plus color channels if multichannel kwarg is set to True.
+    transformation : ndarray
+        Affine transformation matrix. 3 x 3 shape.
+    inverse : bool, optional
+        Inverse transformation, eg: aligning source image coords to destination
+        By default `inverse=True`.
+    multichannel : bool, optional
+        Treat the last dimension as color, transform each color separately.
+        By default `multichannel=True`.
+
+    Returns
+    -------
+    ndarray
+        Image warped by transformation matrix.
+    """
+
+    if inverse:
+        transformation = np.linalg.inv(transformation)
+
+    if not multichannel:
+        if image.ndim == 2:
+            image = skimage.color.gray2rgb(image)
+        elif image.ndim != transformation.shape[0] - 1:
+            raise ValueError('Unexpected number of image dimensions for the '
+                             'input transformation. Did you need to use: '
+                             'multichannel=True ?')
+
+    # move channel axis to the front for easier iteration over array
+    image = np.moveaxis(image, -1, 0)
+    warped_img = np.array([ndi.affine_transform((img_channel), transformation)
+                           for img_channel in image])
+    warped_img = np.moveaxis(warped_img, 0, -1)
+
+    return warped_img
+
+
+class WarpMap:
+    """Precomputed bilinear resampling of an image onto a new pixel grid.
+
+    The source coordinates of every output pixel are converted once into
+    flat gather indices and fractional offsets, so warping each further
+    image with the same transform is a single gather plus interpolation.
+    Output pixels that map outside the input image are set to zero.
+
+    Parameters
+    ----------
+    coords : ndarray
+        Array of shape (2, rows, columns) with the input image row and
+        column coordinates to sample for every output pixel.
+    input_shape : tuple
+        Shape (rows, columns) of the images to be warped.
+    """
+    def __init__(self, coords, input_shape):
+        rows, columns = input_shape[:2]
+        self.input_shape = (rows, columns)
+        self.output_shape = coords.shape[1:]
+        row, column = coords[0].ravel(), coords[1].ravel()
+        inside = ((row >= 0) & (row <= rows - 1) &
+                  (column >= 0) & (column <= columns - 1))
+        largest = max(rows * columns, int(np.prod(self.output_shape)))
+        index_dtype = np.int32 if largest < 2 ** 31 - 1 else np.intp
+        self.output_index = np.flatnonzero(inside).astype(index_dtype)
+        row, column = row[inside], column[inside]
+        row0 = np.clip(np.floor(row), 0, max(rows - 2, 0))
+        column0 = np.clip(np.floor(column), 0, max(columns - 2, 0))
+        self.row_fraction = (row - row0).astype(np.float32)
+        self.column_fraction = (column - column0).astype(np.float32)
+        self.input_index = (row0 * columns + column0).astype(index_dtype)
+        self._row_step = columns if rows > 1 else 0
+        self._column_step = 1 if columns > 1 else 0
+
+    def warp(self, image):
+        """Warp a 2D image, or a 2D image with trailing channel axes.
+
+        Parameters
+        ----------
+        image : ndarray
+            Image with shape `input_shape`, plus any number of channels.
+
+        Returns
+        -------
+        ndarray
+            Warped image with shape `output_shape` plus the same channels,
+            and the same dtype as the input image.
+        """
+        if image.shape[:2] != self.input_shape:
+            raise ValueError('Expected an image with shape {}, got {}'.format(
+                self.input_shape, image.shape[:2]))
+        channels = image.shape[2:]
+        flat = image.reshape((-1,) + channels)
+        index = self.input_index
+        dtype = np.result_type(image.dtype, np.float32)
+        top_left = flat[index].astype(dtype, copy=False)
+        top_right = flat[index + self._column_step].astype(dtype, copy=False)
+        bottom_left = flat[index + self._row_step].astype(dtype, copy=False)
+        bottom_right = flat[index + self._row_step + self._column_step].astype(
+            dtype, copy=False)
+        column_fraction = self.column_fraction.reshape((-1,) + (1,) * len(channels))
+        row_fraction = self.row_fraction.reshape((-1,) + (1,) * len(channels))
+        top = top_left + (top_right - top_left) * column_fraction
+        bottom = bottom_left + (bottom_right - bottom_left) * column_fraction
+        values = top + (bottom - top) * row_fraction
+
+        warped = np.zeros((np.prod(self.output_shape),) + channels, dtype=image.dtype)
+        if np.issubdtype(image.dtype, np.integer):
+            values = np.round(values)
+        warped[self.output_index] = values
+        return warped.reshape(tuple(self.output_shape) + channels)
+
+    @property
+    def nbytes(self):
+        return (self.output_index.nbytes + self.input_index.nbytes +
+                self.row_fraction.nbytes + self.column_fraction.nbytes)
+
+
+def get_warp_map(transformation, input_shape, output_shape=None, inverse=True):
+    """Get the precomputed warp map for an affine transformation.
+
+    Maps are kept in a least recently used cache of `WARP_MAP_CACHE_SIZE`
+    entries, keyed by transformation, input shape and output shape,
+    so applying one transform to many channels, slices or time points
+    only computes the coordinate mapping once.
+
+    Parameters
+    ----------
+    transformation : ndarray
+        Affine transformation matrix. 3 x 3 shape.
+    input_shape : tuple
+        Shape of the images to be warped (any channel axes are ignored).
+    output_shape : tuple, optional
+        Shape of the warped images. By default, the same as `input_shape`.
+    inverse : bool, optional
+        Inverse transformation, eg: aligning source image coords to destination
+        By default `inverse=True`, as in `apply_transform`.
+
+    Returns
+    -------
+    WarpMap
+    """
+    transformation = np.asarray(transformation, dtype=float)
+    input_shape = tuple(input_shape[:2])
+    output_shape = input_shape if output_shape is None else tuple(output_shape[:2])
+    key = (transformation.tobytes(), input_shape, output_shape, bool(inverse))
+    warp_map = _cached_warp_map(key)
+    if warp_map is not None:
+        return warp_map
+
+    if inverse:
+        transformation = np.linalg.inv(transformation)
+    rows = np.arange(output_shape[0], dtype=float)[:, np.newaxis]
+    columns = np.arange(output_shape[1], dtype=float)[np.newaxis, :]
+    coords = np.array([transformation[i, 0] * rows + transformation[i, 1] * columns
+                       + transformation[i, 2] for i in range(2)])
+    warp_map = WarpMap(coords, input_shape)
+    _cache_warp_map(key, warp_map)
+    return warp_map
+
+
+def clear_warp_map_cache():
+    """Release all precomputed warp maps."""
+    with _warp_map_lock:
+        _warp_map_cache.clear()
+
+
+def release_warp_maps(warp_maps):
+    """Release some precomputed warp maps, keeping the others cached."""
+    with _warp_map_lock:
+        for key, warp_map in list(_warp_map_cache.items()):
+            if any(warp_map is released for released in warp_maps):
+                del _warp_map_cache[key]
+
+
+def _cached_warp_map(key):
+    with _warp_map_lock:
+        if key in _warp_map_cache:
+            _warp_map_cache.move_to_end(key)
+            return _warp_map_cache[key]
+    return None
+
+
+def _cache_warp_map(key, warp_map):
+    with _warp_map_lock:
+        _warp_map_cache[key] = warp_map
+        while len(_warp_map_cache) > WARP_MAP_CACHE_SIZE:
+            _warp_map_cache.popitem(last=False)
+
+
+def warp_image(image, transformation, inverse=True, output_shape=None):
+    """Apply an affine transformation with a cached, precomputed warp map.
+
+    A faster alternative to `apply_transform` when the same transformation
+    is applied to many images of the same shape. Uses bilinear
+    interpolation, and warps every channel in a single pass.
+
+    Parameters
+    ----------
+    image : ndarray
+        2D grayscale image, or 2D image with trailing color channels.
+    transformation : ndarray
+        Affine transformation matrix. 3 x 3 shape.
+    inverse : bool, optional
+        Inverse transformation, eg: aligning source image coords to destination
+        By default `inverse=True`.
+    output_shape : tuple, optional
+        Shape (rows, columns) of the output. By default, the input shape.
+
+    Returns
+    -------
+    ndarray
+        Image warped by transformation matrix.
+    """
+    warp_map = get_warp_map(transformation, image.shape, output_shape,
+                            inverse=inverse)
+    return warp_map.warp(image)
+
+
+class ThinPlateSplineTransform:
+    """Thin-plate spline interpolating between matched coordinate pairs.
+
+    The spline passes exactly through every control point and bends as
+    little as possible in between. Far from the control points it tends
+    to the best fit affine transform.
+    Follows the scikit-image transform interface of `estimate` and call.
+    """
+    def __init__(self):
+        self.control_points = None
+        self.weights = None
+        self.affine = None
+
+    def estimate(self, src, dst):
+        """Estimate the spline mapping `src` coordinates onto `dst`.
+
+        Parameters
+        ----------
+        src, dst : ndarray
+            N x 2 arrays of matched coordinates, with N of at least three.
+
+        Returns
+        -------
+        bool
+            True if the spline could be estimated.
+        """
+        src = np.asarray(src, dtype=float)
+        dst = np.asarray(dst, dtype=float)
+        n = len(src)
+        if n < 3:
+            return False
+        ones = np.hstack([np.ones((n, 1)), src])
+        system = np.zeros((n + 3, n + 3))
+        system[:n, :n] = _tps_kernel(src, src)
+        system[:n, n:] = ones
+        system[n:, :n] = ones.T
+        values = np.vstack([dst, np.zeros((3, 2))])
+        try:
+            solution = np.linalg.solve(system, values)
+        except np.linalg.LinAlgError:
+            # e.g. collinear control points
+            solution = np.linalg.lstsq(system, values, rcond=None)[0]
+        self.control_points = src
+        self.weights = solution[:n]
+        self.affine = solution[n:]
+        return True
+
+    def __call__(self, coords):
+        """Map N x 2 coordinates through the spline."""
+        coords = np.asarray(coords, dtype=float)
+        result = self.affine[0] + coords @ self.affine[1:]
+        return result + _tps_kernel(coords, self.control_points) @ self.weights
+
+
+def _tps_kernel(coords, control_points):
+    """Thin-plate spline radial basis, r^2 log(r), between two point sets."""
+    squared = ((coords[:, np.newaxis, :] - control_points[np.newaxis, :, :]) ** 2
+               ).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kernel = 0.5 * squared * np.log(squared)
+    kernel[squared == 0] = 0
+    return kernel
+
+
+def estimate_mapping(src, dst, method='affine'):
+    """Estimate the mapping from destination coordinates back to the source.
+
+    This is the direction needed to resample the source image onto the
+    destination pixel grid.
+
+    Parameters
+    ----------
+    src : ndarray
+        Matched row, column coordinates from source image.
+    dst : ndarray
+        Matched row, column coordinates from destination image.
+    method : str, optional
+        'affine', 'polynomial' (second order) or 'tps' (thin-plate spline).
+        By default 'affine'.
+
+    Returns
+    -------
+    callable
+        Maps N x 2 destination row, column coordinates to source coordinates.
+
+    Raises
+    ------
+    ValueError
+        If there are too few control points, they are degenerate (e.g. all
+        on one line), or the estimate fails.
+    """
+    if method not in TRANSFORM_METHODS:
+        raise ValueError("Unknown transform method '{}', expected one of "
+                         "{}".format(method, TRANSFORM_METHODS))
+    if len(src) < MINIMUM_POINTS[method]:
+        raise ValueError("The {} transform needs at least {} control points, "
+                         "got {}".format(method, MINIMUM_POINTS[method], len(src)))
+    for points in (src, dst):
+        centred = np.asarray(points, dtype=float) - np.mean(points, axis=0)
+        if np.linalg.matrix_rank(centred) < 2:
+            # least squares would still give a (meaningless) transform
+            raise ValueError("The control points are all on one line, or "
+                             "repeated, so they can't define a transform")
+    if method == 'affine':
+        model = AffineTransform()
+        success = model.estimate(dst, src)
+    elif method == 'polynomial':
+        model = PolynomialTransform()
+        success = model.estimate(dst, src, order=2)
+    else:
+        model = ThinPlateSplineTransform()
+        success = model.estimate(dst, src)
+    if not success or not _finite_model(model):
+        raise ValueError("Could not estimate the {} transform from these "
+                         "control points".format(method))
+    return model
+
+
+def _finite_model(model):
+    if isinstance(model, ThinPlateSplineTransform):
+        return np.all(np.isfinite(model.weights)) and np.all(np.isfinite(model.affine))
+    return np.all(np.isfinite(model.params))
+
+
+def mapping_coords(mapping, output_shape, grid_step=16):
+    """Evaluate a coordinate mapping on a coarse grid and interpolate.
+
+    Non-linear mappings are expensive to evaluate, but smooth, so they are
+    evaluated every `grid_step` pixels only and bilinearly interpolated
+    in between.
+
+    Parameters
+    ----------
+    mapping : callable
+        Maps N x 2 output row, column coordinates to input coordinates.
+    output_shape : tuple
+        Shape (rows, columns) of the output image.
+    grid_step : int, optional
+        Spacing in pixels of the coarse grid, by default 16.
+        Use 1 to evaluate the mapping at every pixel.
+
+    Returns
+    -------
+    ndarray
+        Array of shape (2, rows, columns) of input coordinates, as used
+        by `WarpMap`.
+    """
+    rows, columns = output_shape[:2]
+    grid_rows = _grid(rows, grid_step)
+    grid_columns = _grid(columns, grid_step)
+    mesh = np.stack(np.meshgrid(grid_rows, grid_columns, indexing='ij'), axis=-1)
+    coarse = mapping(mesh.reshape(-1, 2)).reshape(mesh.shape)
+    if len(grid_rows) == rows and len(grid_columns) == columns:
+        return np.moveaxis(coarse, -1, 0)
+    # fractional positions of every output pixel on the coarse grid
+    row_index = np.interp(np.arange(rows), grid_rows, np.arange(len(grid_rows)))
+    column_index = np.interp(np.arange(columns), grid_columns,
+                             np.arange(len(grid_columns)))
+    index = np.meshgrid(row_index, column_index, indexing='ij')
+    return np.array([ndi.map_coordinates(coarse[..., i], index, order=1)
+                     for i in range(2)])
+
+
+def _grid(size, step):
+    grid = np.arange(0, size, max(int(step), 1), dtype=float)
+    if grid[-1] != size - 1:
+        grid = np.append(grid, size - 1)
+    return grid
+
+
+def get_point_warp_map(src, dst, input_shape, output_shape=None,
+                       method='tps', grid_step=16):
+    """Get the precomputed warp map for a transform fitted to control points.
+
+    Maps share the least recently used cache of `get_warp_map`.
+
+    Parameters
+    ----------
+    src : ndarray
+        Matched row, column coordinates from source image.
+    dst : ndarray
+        Matched row, column coordinates from destination image.
+    input_shape : tuple
+        Shape of the source images to be warped (channel axes are ignored).
+    output_shape : tuple, optional
+        Shape of the warped images. By default, the same as `input_shape`.
+    method : str, optional
+        One of `TRANSFORM_METHODS`, by default 'tps'.
+    grid_step : int, optional
+        Spacing in pixels of the grid the mapping is evaluated on,
+        by default 16. See `mapping_coords`.
+
+    Returns
+    -------
+    WarpMap
+    """
+    src = np.asarray(src, dtype=float)
+    dst = np.asarray(dst, dtype=float)
+    input_shape = tuple(input_shape[:2])
+    output_shape = input_shape if output_shape is None else tuple(output_shape[:2])
+    key = (method, src.tobytes(), dst.tobytes(), input_shape, output_shape,
+           int(grid_step))
+    warp_map = _cached_warp_map(key)
+    if warp_map is not None:
+        return warp_map
+
+    mapping = estimate_mapping(src, dst, method=method)
+    warp_map = WarpMap(mapping_coords(mapping, output_shape, grid_step),
+                       input_shape)
+    _cache_warp_map(key, warp_map)
+    return warp_map
+
+
+def warp_image_points(image, src, dst, method='tps', output_shape=None,
+                      grid_step=16):
+    """Warp an image with a transform fitted to control points.
+
+    Parameters
+    ----------
+    image : ndarray
+        2D grayscale image, or 2D image with trailing color channels.
+    src : ndarray
+        Matched row, column coordinates from source image.
+    dst : ndarray
+        Matched row, column coordinates from destination image.
+    method : str, optional
+        One of `TRANSFORM_METHODS`, by default 'tps'.
+    output_shape : tuple, optional
+        Shape (rows, columns) of the output. By default, the input shape.
+    grid_step : int, optional
+        Spacing in pixels of the grid the mapping is evaluated on,
+        by default 16.
+
+    Returns
+    -------
+    ndarray
+        Image aligned to the destination image.
+    """
+    warp_map = get_point_warp_map(src, dst, image.shape, output_shape,
+                                  method=method, grid_step=grid_step)
+    return warp_map.warp(image)
+
+
+def overlay_images(fluorescence_image, fibsem_image, transparency=0.5):
+    """Blend two RGB images together.
+
+    Parameters
+    ----------
+    fluorescence_image : ndarray
+        2D RGB image.
+    fibsem_image : ndarray
+        2D RGB image.
+    transparency : float, optional
+        Transparency alpha parameter between 0 - 1, by default 0.5
+
+    Returns
+    -------
+    ndarray
+        Blended 2D RGB image.
+    """
+
+    fluorescence_image = skimage.img_as_float(fluorescence_image)
+    fibsem_image = skimage.img_as_float(fibsem_image)
+    blended = transparency * fluorescence_image + (1 - transparency) * fibsem_image
+    blended = np.clip(blended, 0, 1)
+
+    return blended
+
+
+def preview_overlay(fluorescence_image_rgb, fibsem_image, matched_points_dict,
+                    max_size=512, method='affine'):
+    """Quickly warp and blend downsampled images for a correlation preview.
+
+    Both images are subsampled so the longest side is at most `max_size`
+    pixels, and the transformation is rescaled to match, so the result is
+    a small version of what `correlate_images` produces at full resolution.
+
+    Parameters
+    ----------
+    fluorescence_image_rgb : ndarray
+        2D RGB fluorescence image.
+    fibsem_image : ndarray
+        2D grayscale or RGB FIBSEM image.
+    matched_points_dict : list of dict
+        Complete control point pairs, at least three are needed.
+    max_size : int, optional
+        Maximum length in pixels of the preview image side, by default 512.
+    method : str, optional
+        One of `TRANSFORM_METHODS`, by default 'affine'.
+
+    Returns
+    -------
+    ndarray
+        Blended 2D RGB preview image, 8-bit.
+    """
+    src, dst = point_coords(matched_points_dict)
+
+    step = int(np.ceil(max(fibsem_image.shape[:2]) / max_size))
+    fluorescence_small = fluorescence_image_rgb[::step, ::step]
+    fibsem_small = fibsem_image[::step, ::step]
+    if fibsem_small.ndim == 2:
+        fibsem_small = skimage.color.gray2rgb(fibsem_small)
+    if method == 'affine':
+        transformation = calculate_transform(src, dst)
+        # Express the transformation in subsampled pixel coordinates
+        scale = np.diag([1. / step, 1. / step, 1.])
+        transformation = scale @ transformation @ np.linalg.inv(scale)
+        aligned = apply_transform(fluorescence_small, transformation)
+    else:
+        aligned = warp_image_points(fluorescence_small, src / step, dst / step,
+                                    method=method,
+                                    output_shape=fibsem_small.shape)
+    result = overlay_images(aligned, fibsem_small)
+    return skimage.util.img_as_ubyte(result)
+
+
+def save_text(output_filename, transformation, matched_points_dict):
+    """Save text summary of transformation matrix and image control points.
+
+    Parameters
+    ----------
+    output_filename : str
+        Filename for saving output overlay image file.
+    transformation : ndarray
+        Transformation matrix relating the two images.
+    matched_points_dict : list of dict
+        User selected matched control point pairs.
+
+    Returns
+    -------
+    str
+        Filename of output text file.
+    """
+
+    output_text_filename = os.path.splitext(output_filename)[0] + '.txt'
+    with open(output_text_filename, 'w') as f:
+        f.write(_timestamp() + '\n')
+        f.write('PIEScope GUI version {}\n'.format(__version__))
+        f.write('\nTRANSFORMATION MATRIX\n')
+        f.write(str(transformation) + '\n')
+        f.write('\nUSER SELECTED CONTROL POINTS\n')
+        f.write(str(matched_points_dict) + '\n')
+
+    return output_text_filename
+
+
+def save_transform(output_filename, transformation, matched_points_dict,
+                   geometry=None, method='affine'):
+    """Save transformation and control points as JSON next to the overlay.
+
+    Parameters
+    ----------
+    output_filename : str
+        Filename for saving output overlay image file.
+    transformation : ndarray
+        Transformation matrix relating the two images.
+    matched_points_dict : list of dict
+        User selected matched control point pairs.
+    geometry : dict, optional
+        Image geometry from `image_geometry`, used to find this transform
+        again for new images acquired with the same geometry.
+    method : str, optional
+        Transform method used to align the images, by default 'affine'.
+        Non-linear transforms are recalculated from the control points,
+        and `transformation` is then only the best fit affine transform.
+
+    Returns
+    -------
+    str
+        Filename of output JSON file.
+    """
+    output_json_filename = os.path.splitext(output_filename)[0] + '.json'
+    contents = {
+        'piescope_gui_version': __version__,
+        'timestamp': _timestamp(),
+        'method': method,
+        'transformation': np.asarray(transformation, dtype=float).tolist(),
+        'control_points': [{key: _to_builtin(value) for key, value in point.items()}
+                           for point in matched_points_dict],
+        'geometry': geometry,
+    }
+    with open(output_json_filename, 'w') as f:
+        json.dump(contents, f, indent=2)
+
+    return output_json_filename
+
+
+def load_transform(filename):
+    """Load a transformation saved with `save_transform`.
+
+    Parameters
+    ----------
+    filename : str
+        JSON transform filename.
+
+    Returns
+    -------
+    dict
+        Saved contents, with the 'transformation' converted to an ndarray.
+        Files saved before non-linear transforms were added get the
+        'affine' method.
+    """
+    with open(filename, 'r') as f:
+        contents = json.load(f)
+    contents['transformation'] = np.array(contents['transformation'])
+    contents.setdefault('method', 'affine')
+    return contents
+
+
+def image_geometry(adorned_image, fluorescence_shape=None):
+    """Describe the imaging geometry of a FIBSEM image for transform caching.
+
+    Parameters
+    ----------
+    adorned_image : AdornedImage
+        FIBSEM image with metadata.
+    fluorescence_shape : tuple, optional
+        Shape of the fluorescence image being correlated.
+
+    Returns
+    -------
+    dict
+        Pixel size (metres), resolution (columns, rows), stage position
+        (metres and radians) and fluorescence image shape.
+        Values missing from the metadata are None.
+    """
+    pixel_size = None
+    stage_position = None
+    try:
+        pixel_size = [float(adorned_image.metadata.binary_result.pixel_size.x),
+                      float(adorned_image.metadata.binary_result.pixel_size.y)]
+    except AttributeError:
+        pass
+    try:
+        position = adorned_image.metadata.stage_settings.stage_position
+        stage_position = {axis: float(getattr(position, axis))
+                          for axis in ('x', 'y', 'z', 'r', 't')}
+    except (AttributeError, TypeError):
+        pass
+    try:
+        resolution = [int(adorned_image.width), int(adorned_image.height)]
+    except AttributeError:
+        rows, columns = np.shape(adorned_image.data)[:2]
+        resolution = [int(columns), int(rows)]
+    if fluorescence_shape is not None:
+        fluorescence_shape = [int(i) for i in fluorescence_shape[:2]]
+
+    geometry = {'pixel_size': pixel_size,
+                'resolution': resolution,
+                'stage_position': stage_position,
+                'fluorescence_shape': fluorescence_shape}
+    return geometry
+
+
+def geometry_matches(geometry, other, position_tolerance=1e-6,
+                     angle_tolerance=1e-3):
+    """Check whether two image geometries are compatible for one transform.
+
+    Parameters
+    ----------
+    geometry, other : dict
+        Image geometries from `image_geometry`.
+    position_tolerance : float, optional
+        Maximum stage x, y, z difference in metres, by default 1e-6.
+    angle_tolerance : float, optional
+        Maximum stage rotation and tilt difference in radians, by default 1e-3.
+
+    Returns
+    -------
+    bool
+    """
+    if not geometry or not other:
+        return False
+    if geometry['pixel_size'] is None or other.get('pixel_size') is None:
+        return False
+    if not np.allclose(geometry['pixel_size'], other['pixel_size'], rtol=1e-6, atol=0):
+        return False
+    if geometry['resolution'] != other.get('resolution'):
+        return False
+    if geometry.get('fluorescence_shape') != other.get('fluorescence_shape'):
+        return False
+    position = geometry['stage_position']
+    other_position = other.get('stage_position')
+    if (position is None) != (other_position is None):
+        return False
+    if position is not None:
+        for axis in ('x', 'y', 'z'):
+            if abs(position[axis] - other_position[axis]) > position_tolerance:
+                return False
+        for axis in ('r', 't'):
+            if abs(position[axis] - other_position[axis]) > angle_tolerance:
+                return False
+    return True
+
+
+def find_cached_transform(directory, geometry, **kwargs):
+    """Find the most recent saved transform matching an image geometry.
+
+    Parameters
+    ----------
+    directory : str
+        Directory containing JSON files written by `save_transform`.
+    geometry : dict
+        Image geometry from `image_geometry`.
+    **kwargs
+        Tolerances passed to `geometry_matches`.
+
+    Returns
+    -------
+    dict or None
+        Contents of the matching transform file (see `load_transform`),
+        plus its 'filename', or None if nothing matches.
+    """
+    filenames = sorted(glob.glob(os.path.join(directory, '*.json')),
+                       key=os.path.getmtime, reverse=True)
+    for filename in filenames:
+        try:
+            contents = load_transform(filename)
+        except (ValueError, KeyError, TypeError, OSError):
+            continue  # not a transform file
+        if geometry_matches(geometry, contents.get('geometry'), **kwargs):
+            contents['filename'] = filename
+            return contents
+    return None
+
+
+def _to_builtin(value):
+    """Convert numpy scalars to python types for JSON serialization."""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _timestamp():
+    """Create timestamp string of current local time.
+
+    Returns
+    -------
+    str
+        Timestamp string
+    """
+    timestamp = time.strftime('%d-%b-%Y_%H-%M%p', time.localtime())
+    return timestamp
@@ -0,0 +1,162 @@
+"""Warp every slice and channel of a fluorescence volume with one transform.
+
+Volumes saved by `GUIMainWindow.acquire_volume` have the axis order
+(slices, channels, rows, columns). Planes are read and written one at a
+time, and warped in parallel by a thread pool, so the whole volume is
+never held in memory.
+"""
+import collections
+import concurrent.futures
+import os
+
+import numpy as np
+import tifffile
+
+from piescope_gui.correlation.batch import (apply_warp,
+                                            get_warp_map_for,
+                                            read_warp,
+                                            )
+from piescope_gui.correlation.transform import load_transform
+
+
+def resize_matrix(input_shape, output_shape):
+    """Affine matrix equivalent to `skimage.transform.resize` coordinates.
+
+    Parameters
+    ----------
+    input_shape, output_shape : tuple
+        Image shapes (rows, columns).
+
+    Returns
+    -------
+    ndarray
+        3 x 3 matrix mapping input row, column coordinates to output ones.
+    """
+    row_scale = output_shape[0] / input_shape[0]
+    column_scale = output_shape[1] / input_shape[1]
+    return np.array([[row_scale, 0, 0.5 * row_scale - 0.5],
+                     [0, column_scale, 0.5 * column_scale - 0.5],
+                     [0, 0, 1]])
+
+
+def volume_warp(warp, fluorescence_shape, fibsem_shape):
+    """Warp from raw fluorescence pixels to FIBSEM pixels.
+
+    Correlation control points are picked on the fluorescence image after
+    it has been resized to the FIBSEM image shape (see
+    `open_correlation_window`), so the resize is folded into the affine
+    matrix, or into the source control points of non-linear transforms.
+
+    Parameters
+    ----------
+    warp : (method, parameters)
+        Correlation warp, as returned by `read_warp`.
+    fluorescence_shape : tuple
+        Shape (rows, columns) of the fluorescence volume planes.
+    fibsem_shape : tuple
+        Shape (rows, columns) of the FIBSEM image.
+
+    Returns
+    -------
+    (method, parameters)
+        Warp to apply to the raw fluorescence volume planes.
+    """
+    method, parameters = warp
+    resize = resize_matrix(fluorescence_shape[:2], fibsem_shape[:2])
+    if method == 'affine':
+        return method, parameters @ resize
+    src, dst = parameters
+    # resized image coordinates back to raw fluorescence image coordinates
+    src = np.asarray(src, dtype=float)
+    src = (src - resize[:2, 2]) / np.diag(resize)[:2]
+    return method, (src, dst)
+
+
+def warp_planes(planes, warp, output_shape, workers=None,
+                max_pending=None):
+    """Warp a stream of 2D planes with a thread pool, preserving their order.
+
+    Parameters
+    ----------
+    planes : iterable of ndarray
+        2D planes, all with the same shape.
+    warp : (method, parameters)
+        Warp from input to output pixels, see `read_warp`.
+    output_shape : tuple
+        Shape (rows, columns) of the warped planes.
+    workers : int, optional
+        Number of worker threads. By default, the number of CPUs.
+    max_pending : int, optional
+        Maximum number of planes in flight. By default, twice the workers.
+
+    Yields
+    ------
+    ndarray
+        Warped planes, in input order.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for plane in planes:
+            if not pending:
+                # compute the shared coordinate map once, before the workers
+                get_warp_map_for(warp, plane.shape, output_shape)
+            pending.append(executor.submit(
+                apply_warp, plane, warp, output_shape=output_shape))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def correlate_volume(volume_filename, transform_filename, output_filename,
+                     fibsem_shape=None, workers=None, max_pending=None):
+    """Warp a saved fluorescence volume into FIBSEM pixel space.
+
+    Parameters
+    ----------
+    volume_filename : str
+        Volume TIFF file, with axes (slices, channels, rows, columns)
+        or (slices, rows, columns).
+    transform_filename : str
+        JSON transform file written by `save_transform`.
+    output_filename : str
+        Filename of the warped volume TIFF file to write.
+    fibsem_shape : tuple, optional
+        Shape (rows, columns) of the FIBSEM image the transform aligns to.
+        By default, the resolution saved in the transform file is used.
+    workers : int, optional
+        Number of worker threads. By default, the number of CPUs.
+    max_pending : int, optional
+        Maximum number of planes in memory. By default, twice the workers.
+
+    Returns
+    -------
+    tuple
+        Shape of the warped volume.
+    """
+    if fibsem_shape is None:
+        geometry = load_transform(transform_filename).get('geometry') or {}
+        resolution = geometry.get('resolution')
+        if resolution is None:
+            raise ValueError("The transform file has no image resolution, "
+                             "please give the FIBSEM image shape.")
+        fibsem_shape = (resolution[1], resolution[0])  # rows, columns
+    fibsem_shape = tuple(int(i) for i in fibsem_shape[:2])
+    warp = read_warp(transform_filename)
+
+    with tifffile.TiffFile(volume_filename) as tif:
+        series = tif.series[0]
+        if len(series.shape) not in (3, 4):
+            raise ValueError("Expected a volume with 3 or 4 dimensions, "
+                             "got shape {}".format(series.shape))
+        plane_shape = series.shape[-2:]
+        output_shape = series.shape[:-2] + fibsem_shape
+        plane_warp = volume_warp(warp, plane_shape, fibsem_shape)
+        planes = (page.asarray() for page in series.pages)
+        warped = warp_planes(planes, plane_warp, fibsem_shape,
+                             workers=workers, max_pending=max_pending)
+        tifffile.imwrite(output_filename, data=warped, shape=output_shape,
+                         dtype=series.dtype, bigtiff=True)
+    return output_shape
@@ -0,0 +1,147 @@
+"""Error reporting from any thread, without blocking on a dialog.
+
+Worker threads (live imaging, milling monitors, background jobs) report
+errors to the `ErrorBus`, which passes them on to the GUI thread with a
+queued Qt signal. The `ErrorPanel` shows them in a non-modal list, where a
+repeated error only increases its count, so a failing acquisition loop
+never waits for someone to click OK.
+"""
+import logging
+import time
+import traceback
+
+from PyQt5 import QtCore, QtWidgets
+
+__all__ = [
+    'ErrorBus',
+    'ErrorPanel',
+    'error_bus',
+    'in_gui_thread',
+    ]
+
+logger = logging.getLogger(__name__)
+
+_error_bus = None
+
+
+def in_gui_thread():
+    """Whether this is the thread running the Qt application."""
+    app = QtCore.QCoreApplication.instance()
+    return app is not None and QtCore.QThread.currentThread() is app.thread()
+
+
+class ErrorBus(QtCore.QObject):
+    """Collects errors from any thread and emits them in the GUI thread.
+
+    Connect to `errorReported`, which is emitted with the error message,
+    its source (e.g. "Live imaging") and the time it was reported.
+    """
+    errorReported = QtCore.pyqtSignal(str, str, float)
+
+    def report(self, message, source=''):
+        """Report an error message. Can be called from any thread."""
+        logger.error("%s%s", source + ': ' if source else '', message)
+        self.errorReported.emit(str(message), source, time.time())
+
+    def report_exception(self, source=''):
+        """Report the exception being handled, with its traceback."""
+        self.report(traceback.format_exc(), source)
+
+
+def error_bus():
+    """The application's `ErrorBus`, created on first use."""
+    global _error_bus
+    if _error_bus is None:
+        _error_bus = ErrorBus()
+        app = QtCore.QCoreApplication.instance()
+        if app is not None and not in_gui_thread():
+            # queued signals are delivered to the thread the bus lives in
+            _error_bus.moveToThread(app.thread())
+    return _error_bus
+
+
+class ErrorPanel(QtWidgets.QDockWidget):
+    """Non-modal list of reported errors, with repeated errors merged.
+
+    The panel shows itself when an error is reported. Selecting an error
+    shows its full message below the list.
+
+    Parameters
+    ----------
+    bus : ErrorBus, optional
+        By default, the application's `error_bus()`.
+    parent : QWidget, optional
+    """
+    MAX_ERRORS = 100
+
+    def __init__(self, bus=None, parent=None):
+        super().__init__("Errors", parent)
+        self.setObjectName("ErrorPanel")
+        self.bus = bus if bus is not None else error_bus()
+        self.errors = {}  # (source, message): [list item, count, last time]
+
+        self.error_list = QtWidgets.QListWidget()
+        self.details = QtWidgets.QPlainTextEdit()
+        self.details.setReadOnly(True)
+        self.clear_button = QtWidgets.QPushButton("Clear")
+        widget = QtWidgets.QWidget()
+        layout = QtWidgets.QVBoxLayout(widget)
+        layout.addWidget(self.error_list)
+        layout.addWidget(self.details)
+        layout.addWidget(self.clear_button)
+        self.setWidget(widget)
+
+        self.error_list.currentItemChanged.connect(self.show_details)
+        self.clear_button.clicked.connect(lambda: self.clear())
+        self.bus.errorReported.connect(self.add_error)
+
+    def add_error(self, message, source='', reported=None):
+        """Add an error, or count it again if it's already listed."""
+        reported = time.time() if reported is None else reported
+        key = (source, message)
+        if key in self.errors:
+            entry = self.errors[key]
+            entry[1] += 1
+            entry[2] = reported
+            item = entry[0]
+            # most recent first
+            self.error_list.insertItem(0, self.error_list.takeItem(
+                self.error_list.row(item)))
+        else:
+            item = QtWidgets.QListWidgetItem()
+            item.setData(QtCore.Qt.UserRole, key)
+            self.errors[key] = [item, 1, reported]
+            self.error_list.insertItem(0, item)
+            while len(self.errors) > self.MAX_ERRORS:
+                oldest = self.error_list.takeItem(self.error_list.count() - 1)
+                del self.errors[oldest.data(QtCore.Qt.UserRole)]
+        item.setText(self._summary(key))
+        self.error_list.setCurrentItem(item)
+        self.show()
+        self.raise_()
+
+    def _summary(self, key):
+        source, message = key
+        _, count, reported = self.errors[key]
+        lines = message.strip().splitlines() or ['']
+        text = '{} {}{}'.format(time.strftime('%H:%M:%S', time.localtime(reported)),
+                                source + ': ' if source else '', lines[-1])
+        if count > 1:
+            text += ' (x{})'.format(count)
+        return text
+
+    def show_details(self, item, previous=None):
+        if item is None:
+            self.details.clear()
+        else:
+            self.details.setPlainText(item.data(QtCore.Qt.UserRole)[1])
+
+    def count(self, message, source=''):
+        """Number of times an error has been reported."""
+        entry = self.errors.get((source, message))
+        return entry[1] if entry is not None else 0
+
+    def clear(self):
+        self.errors = {}
+        self.error_list.clear()
+        self.details.clear()
@@ -0,0 +1,238 @@
+"""Laser power commands, coalesced and sent from a dedicated thread.
+
+Setting `laser_power` on a piescope laser writes a command to the serial
+port. The GUI asks for a new power every time a laser slider moves, so the
+`LaserController` collects the requested powers and only sends them once the
+requests stop changing for `debounce` seconds (or at least every `max_delay`
+seconds while they keep changing). Only the latest power of each laser is
+sent, and only if it differs from the last power the laser accepted:
+
+    controller = LaserController(lasers)
+    controller.set_power("laser640", 4)   # returns straight away
+    controller.set_power("laser640", 5)   # replaces the 4
+    controller.apply_power("laser488", 2)  # sends now, waits for the laser
+
+Lasers share one serial port, so every other laser command must hold
+`serial_lock` while it is written. `emission_on` and `emission_off` do so.
+Operations that set laser powers without the controller (like piescope's
+volume acquisition) should hold the lock, and call `invalidate` afterwards.
+"""
+import logging
+import threading
+import time
+
+from PyQt5 import QtCore
+
+from piescope_gui import errors, tracing
+
+__all__ = [
+    'LaserController',
+    ]
+
+logger = logging.getLogger(__name__)
+
+DEBOUNCE_INTERVAL = 0.1  # seconds without changes before sending
+MAX_DELAY = 0.5  # seconds, longest wait while changes keep coming
+
+
+class LaserController(QtCore.QObject):
+    """Sends laser power changes from a dedicated thread.
+
+    Parameters
+    ----------
+    lasers : dict
+        Piescope lasers by name, as returned by `initialize_lasers`.
+    debounce : float, optional
+        Seconds without new requests before sending, by default
+        DEBOUNCE_INTERVAL.
+    max_delay : float, optional
+        Longest time in seconds a request waits while new requests keep
+        coming, by default MAX_DELAY.
+    parent : QObject, optional
+    """
+    # Emitted with the laser name and power once the laser has accepted it
+    powerApplied = QtCore.pyqtSignal(str, float)
+
+    def __init__(self, lasers, debounce=DEBOUNCE_INTERVAL, max_delay=MAX_DELAY,
+                 parent=None):
+        super().__init__(parent)
+        self.lasers = lasers
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.commands_sent = 0
+        self._condition = threading.Condition()
+        self._requested = {}  # name: latest power requested
+        self._acknowledged = {}  # name: last power the laser accepted
+        self._first_change = None  # when the oldest unsent request was made
+        self._last_change = None
+        self._flush = False
+        self._sending = False
+        self._stopped = False
+        # Held while a command is written to the lasers' serial port
+        self.serial_lock = threading.RLock()
+        self._thread = threading.Thread(target=self._run, name='Laser commands',
+                                        daemon=True)
+        self._thread.start()
+
+    def set_power(self, name, power):
+        """Request a laser power, sent later from the laser thread."""
+        if name not in self.lasers:
+            raise KeyError("Unknown laser {!r}, expected one of {}".format(
+                name, sorted(self.lasers)))
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("The laser controller is stopped")
+            self._requested[name] = float(power)
+            if not self._pending():
+                self._first_change = None  # nothing to send
+                return
+            now = time.monotonic()
+            if self._first_change is None:
+                self._first_change = now
+            self._last_change = now
+            self._condition.notify_all()
+
+    def apply_power(self, name, power, timeout=None):
+        """Set a laser power, and wait until the laser has accepted it.
+
+        Returns
+        -------
+        bool
+            Whether the laser has the power, False on timeout or error.
+        """
+        return self.apply_powers({name: power}, timeout)
+
+    def apply_powers(self, powers, timeout=None):
+        """Set several laser powers, and wait until the lasers accept them.
+
+        Parameters
+        ----------
+        powers : dict
+            {laser name: power}
+        timeout : float, optional
+
+        Returns
+        -------
+        bool
+            Whether every laser has its power, False on timeout or error.
+        """
+        for name, power in powers.items():
+            self.set_power(name, power)
+        if not self.flush(timeout):
+            return False
+        with self._condition:
+            return all(self._acknowledged.get(name) == float(power)
+                       for name, power in powers.items())
+
+    def flush(self, timeout=None):
+        """Send the requested powers now, and wait until they are sent.
+
+        Returns
+        -------
+        bool
+            False if the powers weren't sent before the timeout.
+        """
+        with self._condition:
+            if self._pending():
+                self._flush = True
+                self._condition.notify_all()
+            return self._condition.wait_for(
+                lambda: not self._sending and not self._pending(), timeout)
+
+    def emission_on(self, name):
+        """Turn a laser on, once no other laser command is being written."""
+        with self.serial_lock, tracing.span('emission_on', 'laser',
+                                            laser=name):
+            self.lasers[name].emission_on()
+
+    def emission_off(self, name):
+        """Turn a laser off, once no other laser command is being written."""
+        with self.serial_lock, tracing.span('emission_off', 'laser',
+                                            laser=name):
+            self.lasers[name].emission_off()
+
+    def power(self, name):
+        """The latest power requested for a laser."""
+        with self._condition:
+            if name in self._requested:
+                return self._requested[name]
+            if name in self._acknowledged:
+                return self._acknowledged[name]
+        return self.lasers[name].laser_power
+
+    def pending(self):
+        """Requested powers not yet accepted by the lasers."""
+        with self._condition:
+            return self._pending()
+
+    def _pending(self):
+        return {name: power for name, power in self._requested.items()
+                if self._acknowledged.get(name) != power}
+
+    def invalidate(self, name=None):
+        """Forget the power accepted by a laser, or by every laser.
+
+        The next request is sent even if it matches the forgotten power.
+        """
+        with self._condition:
+            names = list(self._acknowledged) if name is None else [name]
+            for name in names:
+                acknowledged = self._acknowledged.pop(name, None)
+                if (acknowledged is not None
+                        and self._requested.get(name) == acknowledged):
+                    del self._requested[name]  # already sent
+
+    def stop(self, timeout=None):
+        """Send the requested powers, then stop the laser thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def _due(self):
+        if not self._pending():
+            return False
+        if self._flush or self._stopped:
+            return True
+        return self._wait_time() <= 0
+
+    def _wait_time(self):
+        if self._first_change is None:
+            return 0
+        now = time.monotonic()
+        return min(self._last_change + self.debounce,
+                   self._first_change + self.max_delay) - now
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._due():
+                    if self._stopped:
+                        return
+                    self._condition.wait(
+                        self._wait_time() if self._pending() else None)
+                commands = sorted(self._pending().items())
+                self._first_change = None
+                self._flush = False
+                self._sending = True
+            applied = []
+            for name, power in commands:
+                try:
+                    with self.serial_lock, tracing.span(
+                            'laser_power', 'laser', laser=name, power=power):
+                        self.lasers[name].laser_power = power
+                except Exception:
+                    errors.error_bus().report_exception("Laser " + name)
+                    with self._condition:
+                        if self._requested.get(name) == power:
+                            del self._requested[name]  # don't retry
+                else:
+                    self.commands_sent += 1
+                    applied.append((name, power))
+            with self._condition:
+                self._acknowledged.update(applied)
+                self._sending = False
+                self._condition.notify_all()
+            for name, power in applied:
+                logger.debug("Laser %s power set to %s", name, power)
+                self.powerApplied.emit(name, power)
@@ -1,6 +1,5 @@
 import copy
 import logging
-import mock
 import os
 import sys
 import threading
@@ -23,18 +22,33 @@ import piescope.fibsem
 import piescope.utils
 
 import piescope_gui.milling
+from piescope_gui.lasers import LaserController
+import piescope_gui.resources as resources
+import piescope_gui.scheduler as scheduler
+import piescope_gui.simulation
+import piescope_gui.tracing as tracing
 import piescope_gui.correlation.main as corr
 import piescope_gui.qtdesigner_files.main as gui_main
-from piescope_gui.utils import display_error_message, timestamp
+from piescope_gui.errors import ErrorPanel
+from piescope_gui.utils import display_error_message, setup_logging, timestamp
 
 logger = logging.getLogger(__name__)
 
 
 class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
+    # Live imaging frames and their metadata, emitted by the worker thread
+    liveFrameReady = QtCore.pyqtSignal(object, dict)
+    liveImagingStopped = QtCore.pyqtSignal()
+
     def __init__(self, ip_address="10.0.0.1", offline=False):
         super(GUIMainWindow, self).__init__()
         self.offline = offline
         self.setupUi(self)
+        self.actionExport_trace = QtWidgets.QAction("Export Trace...", self)
+        self.menuFile.addAction(self.actionExport_trace)
+        self.pushButton_multichannel = QtWidgets.QPushButton(
+            "Acquire Multichannel Image", self.frame_buttons_extra)
+        self.gridLayout_6.addWidget(self.pushButton_multichannel, 2, 0, 1, 2)
         self.setup_connections()
 
         self.ip_address = ip_address
@@ -43,6 +57,8 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         self.lasers = None
         self.objective_stage = None
         self.initialize_hardware(offline=offline)
+        # laser power changes are coalesced and sent from their own thread
+        self.laser_controller = LaserController(self.lasers, parent=self)
 
         self.image_ion = None  # ion beam image (AdornedImage type)
         self.image_sem = None  # electron beam image (AdornedImage type)
@@ -56,6 +72,15 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         self.status = QtWidgets.QLabel(self.statusbar)
         self.status.setAlignment(QtCore.Qt.AlignRight)
         self.statusbar.addPermanentWidget(self.status, 1)
+        # errors from worker threads, shown without blocking them
+        self.error_panel = ErrorPanel(parent=self)
+        self.addDockWidget(QtCore.Qt.BottomDockWidgetArea, self.error_panel)
+        self.error_panel.hide()
+        # long operations run as jobs, in the order of their priority,
+        # as soon as the hardware they need is free
+        self.scheduler = scheduler.JobScheduler(parent=self)
+        self.job_panel = scheduler.JobQueuePanel(self.scheduler, parent=self)
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea, self.job_panel)
         self.lineEdit_save_destination_FM.setText(self.DEFAULT_PATH)
         self.lineEdit_save_destination_FIBSEM.setText(self.DEFAULT_PATH)
         self.correlation_output_path.setText(self.DEFAULT_PATH)
@@ -69,6 +94,9 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         # self.liveCheck is True when ready to start live imaging,
         # and False while live imaging is running:
         self.liveCheck = True
+        # Frames sent by the live imaging worker but not yet displayed
+        self._live_frames_queued = 0
+        self._live_frame_lock = threading.Lock()
 
         self.save_name = ""
         # self.laser_dict is a dictionary like: {"name": (power, exposure)}
@@ -98,6 +126,8 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
             self.objective_stage = self.initialize_objective_stage()
         elif offline is True:
             self.connect_to_fibsem_microscope(ip_address="localhost")
+            if piescope_gui.simulation.active():
+                self.objective_stage = self.initialize_objective_stage()
 
     def setup_connections(self):
         self.comboBox_resolution.currentTextChanged.connect(
@@ -114,6 +144,8 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
             lambda: self.save_image("FM"))
         self.actionSave_FIBSEM_Image.triggered.connect(
             lambda: self.save_image("FIBSEM"))
+        self.actionExport_trace.triggered.connect(
+            lambda: self.export_trace())
 
         self.slider_stack_FM.valueChanged.connect(
             lambda: self.update_display("FM"))
@@ -155,16 +187,16 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
             lambda: self.update_laser_dict("laser405"))
 
         self.button_get_image_FIB.clicked.connect(
-            lambda: self.get_FIB_image())
+            lambda: self.submit_FIB_image())
         self.button_get_image_SEM.clicked.connect(
-            lambda: self.get_SEM_image())
+            lambda: self.submit_SEM_image())
         self.button_last_image_FIB.clicked.connect(
             lambda: self.get_last_FIB_image())
         self.button_last_image_SEM.clicked.connect(
             lambda: self.get_last_SEM_image())
 
         self.button_get_image_FM.clicked.connect(
-            lambda: self.fluorescence_image(
+            lambda: self.submit_fluorescence_image(
                 self.comboBox_laser_basler.currentText(),
                 self.lineEdit_exposure_basler.text(),
                 self.lineEdit_power_basler_2.text()))
@@ -188,11 +220,17 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         self.connect_microscope.clicked.connect(
             lambda: self.connect_to_fibsem_microscope(ip_address=self.ip_address))
         self.to_light_microscope.clicked.connect(
-            lambda: self.move_to_light_microscope())
+            lambda: self.submit_stage_move(
+                "Move to light microscope",
+                piescope.fibsem.move_to_light_microscope))
         self.to_electron_microscope.clicked.connect(
-            lambda: self.move_to_electron_microscope())
+            lambda: self.submit_stage_move(
+                "Move to electron microscope",
+                piescope.fibsem.move_to_electron_microscope))
 
-        self.pushButton_volume.clicked.connect(lambda: self.acquire_volume())
+        self.pushButton_volume.clicked.connect(lambda: self.submit_volume())
+        self.pushButton_multichannel.clicked.connect(
+            lambda: self.submit_multichannel_image())
         self.pushButton_correlation.clicked.connect(lambda: self.correlateim())
         self.pushButton_milling.clicked.connect(lambda: self.milling())
 
@@ -201,9 +239,15 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         self.pushButton_go_to_saved_position.clicked.connect(
             lambda: self.move_absolute_objective_stage(self.objective_stage))
 
+        self.liveFrameReady.connect(self.show_live_frame)
+        self.liveImagingStopped.connect(self.live_imaging_stopped)
+
     def disconnect(self):
         print('Running cleanup/teardown')
         logging.debug('Running cleanup/teardown')
+        self.scheduler.shutdown()
+        self.scheduler.wait(timeout=30)
+        self.laser_controller.stop(timeout=5)
         if self.objective_stage is not None and self.offline is False:
             # Return objective lens stage to the "out" position and disconnect.
             self.move_absolute_objective_stage(self.objective_stage, position=0)
@@ -235,6 +279,9 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
             display_error_message(traceback.format_exc())
 
     ############## FIBSEM sample stage methods ##############
+    @tracing.traced('stage')
+    @resources.leased(resources.SAMPLE_STAGE, owner="Move to light microscope",
+                      on_busy=display_error_message)
     def move_to_light_microscope(self, x=+49.952e-3, y=-0.1911e-3):
         try:
             piescope.fibsem.move_to_light_microscope(self.microscope, x, y)
@@ -243,6 +290,10 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         else:
             print("Moved to light microscope.")
 
+    @tracing.traced('stage')
+    @resources.leased(resources.SAMPLE_STAGE,
+                      owner="Move to electron microscope",
+                      on_busy=display_error_message)
     def move_to_electron_microscope(self, x=-49.952e-3, y=+0.1911e-3):
         try:
             piescope.fibsem.move_to_electron_microscope(self.microscope, x, y)
@@ -251,31 +302,92 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         else:
             print("Moved to electron microscope.")
 
+    def submit_stage_move(self, name, move, x=None, y=None):
+        """Queue a sample stage move as a high priority job.
+
+        Parameters
+        ----------
+        name : str
+            Job name, e.g. "Move to light microscope".
+        move : callable
+            `piescope.fibsem.move_to_light_microscope` or
+            `piescope.fibsem.move_to_electron_microscope`.
+        x, y : float, optional
+            Relative stage move in metres, by default the move's own.
+
+        Returns
+        -------
+        Job
+        """
+        offsets = {key: value for key, value in (('x', x), ('y', y))
+                   if value is not None}
+        return self.scheduler.submit(
+            name, lambda job: move(self.microscope, **offsets),
+            resources=(resources.SAMPLE_STAGE,),
+            priority=scheduler.PRIORITY_HIGH,
+            on_done=lambda result: print(name + " done."))
+
     ############## FIBSEM image methods ##############
+    @tracing.traced('acquisition')
+    @resources.leased(resources.ION_BEAM, owner="Ion beam image",
+                      on_busy=display_error_message)
     def get_FIB_image(self, autosave=True):
         try:
-            if self.checkBox_Autocontrast.isChecked():
-                self.fibsem_image = self.autocontrast_ion_beam()
-            else:
-                self.fibsem_image = piescope.fibsem.new_ion_image(self.microscope, self.camera_settings)
-            # TODO: Do we really need skimage img_as_ubyte? Display only?
-            self.array_list_FIBSEM = skimage.util.img_as_ubyte(self.fibsem_image.data)
-            # save image
-            save_filename = os.path.join(
-                self.save_destination_FIBSEM,
-                "I_" + self.lineEdit_save_filename_FIBSEM.text() + '.tif')
-            self.string_list_FIBSEM = [save_filename]
-            if autosave is True:
-                piescope.utils.save_image(self.fibsem_image, save_filename)
-                print('Saved: {}'.format(save_filename))
-            # Update display
-            self.update_display("FIBSEM")
+            save_filename = self._fibsem_filename("I_")
+            image = self._acquire_FIB_image(
+                self.checkBox_Autocontrast.isChecked(),
+                save_filename if autosave is True else None)
+            self._show_FIB_image(image, save_filename)
         except Exception as e:
             display_error_message(traceback.format_exc())
         else:
-            self.image_ion = copy.deepcopy(self.fibsem_image)
             return self.fibsem_image
 
+    def submit_FIB_image(self, autosave=True, priority=scheduler.PRIORITY_NORMAL):
+        """Queue an ion beam image as a job, see `get_FIB_image`.
+
+        Returns
+        -------
+        Job
+        """
+        save_filename = self._fibsem_filename("I_")
+        autocontrast = self.checkBox_Autocontrast.isChecked()
+        return self.scheduler.submit(
+            "Ion beam image",
+            lambda job: self._acquire_FIB_image(
+                autocontrast, save_filename if autosave is True else None),
+            resources=(resources.ION_BEAM,), priority=priority,
+            on_done=lambda image: self._show_FIB_image(image, save_filename))
+
+    def _fibsem_filename(self, prefix):
+        return os.path.join(
+            self.save_destination_FIBSEM,
+            prefix + self.lineEdit_save_filename_FIBSEM.text() + '.tif')
+
+    def _acquire_FIB_image(self, autocontrast, save_filename=None):
+        """Acquire and save an ion beam image, without touching the GUI.
+
+        The ion beam must already be leased by the caller.
+        """
+        if autocontrast:
+            image = self._autocontrast_ion_beam()
+        else:
+            image = piescope.fibsem.new_ion_image(self.microscope, self.camera_settings)
+        if save_filename is not None:
+            with tracing.span('save_image', 'save', filename=save_filename):
+                piescope.utils.save_image(image, save_filename)
+            print('Saved: {}'.format(save_filename))
+        return image
+
+    def _show_FIB_image(self, image, filename):
+        self.fibsem_image = image
+        # TODO: Do we really need skimage img_as_ubyte? Display only?
+        self.array_list_FIBSEM = skimage.util.img_as_ubyte(image.data)
+        self.string_list_FIBSEM = [filename]
+        self.update_display("FIBSEM")
+        self.image_ion = copy.deepcopy(image)
+
+    @tracing.traced('acquisition')
     def get_last_FIB_image(self):
         try:
             self.fibsem_image = piescope.fibsem.last_ion_image(self.microscope)
@@ -287,30 +399,64 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
             self.image_ion = copy.deepcopy(self.fibsem_image)
             return self.fibsem_image
 
+    @tracing.traced('acquisition')
+    @resources.leased(resources.ELECTRON_BEAM, owner="Electron beam image",
+                      on_busy=display_error_message)
     def get_SEM_image(self, autosave=True):
         try:
-            self.fibsem_image = piescope.fibsem.new_electron_image(self.microscope, self.camera_settings)
-            # TODO: should this be copied? Should it be skimage img_as_ubyte?
-            self.array_list_FIBSEM = np.copy(self.fibsem_image.data)
-            # TODO: Inconsistent median filtering for display - should be in update_display('FIBSEM'), if anything.
-            # Also consider correlation and milling window displays
-            self.array_list_FIBSEM = ndi.median_filter(self.array_list_FIBSEM, 2)
-            # save image
-            save_filename = os.path.join(
-                self.save_destination_FIBSEM,
-                "E_" + self.lineEdit_save_filename_FIBSEM.text() + '.tif')
-            self.string_list_FIBSEM = [save_filename]
-            if autosave is True:
-                piescope.utils.save_image(self.fibsem_image, save_filename)
-                print('Saved: {}'.format(save_filename))
-            # update display
-            self.update_display("FIBSEM")
+            save_filename = self._fibsem_filename("E_")
+            image, display_array = self._acquire_SEM_image(
+                save_filename if autosave is True else None)
+            self._show_SEM_image(image, display_array, save_filename)
         except Exception as e:
             display_error_message(traceback.format_exc())
         else:
-            self.image_sem = copy.deepcopy(self.fibsem_image)
             return self.fibsem_image
 
+    def submit_SEM_image(self, autosave=True, priority=scheduler.PRIORITY_NORMAL):
+        """Queue an electron beam image as a job, see `get_SEM_image`.
+
+        Returns
+        -------
+        Job
+        """
+        save_filename = self._fibsem_filename("E_")
+        return self.scheduler.submit(
+            "Electron beam image",
+            lambda job: self._acquire_SEM_image(
+                save_filename if autosave is True else None),
+            resources=(resources.ELECTRON_BEAM,), priority=priority,
+            on_done=lambda result: self._show_SEM_image(*result, save_filename))
+
+    def _acquire_SEM_image(self, save_filename=None):
+        """Acquire and save an electron beam image, without touching the GUI.
+
+        The electron beam must already be leased by the caller.
+
+        Returns
+        -------
+        AdornedImage, numpy ndarray
+            The image, and its median filtered data for display.
+        """
+        image = piescope.fibsem.new_electron_image(self.microscope, self.camera_settings)
+        # TODO: should this be copied? Should it be skimage img_as_ubyte?
+        # TODO: Inconsistent median filtering for display - should be in update_display('FIBSEM'), if anything.
+        # Also consider correlation and milling window displays
+        display_array = ndi.median_filter(np.copy(image.data), 2)
+        if save_filename is not None:
+            with tracing.span('save_image', 'save', filename=save_filename):
+                piescope.utils.save_image(image, save_filename)
+            print('Saved: {}'.format(save_filename))
+        return image, display_array
+
+    def _show_SEM_image(self, image, display_array, filename):
+        self.fibsem_image = image
+        self.array_list_FIBSEM = display_array
+        self.string_list_FIBSEM = [filename]
+        self.update_display("FIBSEM")
+        self.image_sem = copy.deepcopy(image)
+
+    @tracing.traced('acquisition')
     def get_last_SEM_image(self):
         try:
             self.fibsem_image = piescope.fibsem.last_electron_image(self.microscope)
@@ -323,18 +469,30 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
             self.image_sem = copy.deepcopy(self.fibsem_image)
             return self.fibsem_image
 
+    @tracing.traced('acquisition')
+    @resources.leased(resources.ION_BEAM, owner="Ion beam autocontrast",
+                      on_busy=display_error_message)
     def autocontrast_ion_beam(self):
         try:
-            self.microscope.imaging.set_active_view(2)  # the ion beam view
-            piescope.fibsem.autocontrast(self.microscope)
-            self.fibsem_image = piescope.fibsem.last_ion_image(self.microscope)
+            self.fibsem_image = self._autocontrast_ion_beam()
         except Exception as e:
             display_error_message(traceback.format_exc())
         else:
             self.image_ion = copy.deepcopy(self.fibsem_image)
             return self.fibsem_image
 
+    def _autocontrast_ion_beam(self):
+        """Run autocontrast and return the ion beam image, with the ion beam
+        already leased by the caller."""
+        self.microscope.imaging.set_active_view(2)  # the ion beam view
+        piescope.fibsem.autocontrast(self.microscope)
+        return piescope.fibsem.last_ion_image(self.microscope)
+
     ############## Fluorescence detector methods ##############
+    @tracing.traced('acquisition', arguments=('wavelength', 'exposure_time',
+                                              'laser_power'))
+    @resources.leased(resources.CAMERA, resources.LASERS,
+                      owner="Fluorescence image", on_busy=display_error_message)
     def fluorescence_image(self, wavelength, exposure_time, laser_power,
                            autosave=True):
         """Acquire a single fluorescence image, at a single wavelength..
@@ -356,46 +514,91 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
             Fluorescence image array.
         """
         try:
-            # Setup
-            exposure_time_microseconds = float(exposure_time) * 1000  # ms ->us
-            WAVELENGTH_TO_LASERNAME = {"640nm": "laser640",
-                                       "561nm": "laser561",
-                                       "488nm": "laser488",
-                                       "405nm": "laser405"}
-            laser_name = WAVELENGTH_TO_LASERNAME[wavelength]
-            self.lasers[laser_name].laser_power = float(laser_power)
-            # Acquire image
-            self.lasers[laser_name].emission_on()
-            image = self.detector.camera_grab(exposure_time_microseconds)
-            meta = {'exposure_time': str(exposure_time),
-                    'laser_name': str(laser_name),
-                    'laser_power': str(laser_power),
-                    'timestamp': timestamp(),
-                    }
-            self.lasers[laser_name].emission_off()
-            # Save image
-            save_filename = os.path.join(
-                self.save_destination_FM,
-                'F_' + self.lineEdit_save_filename_FM.text() + '.tif')
-            self.string_list_FM = [save_filename]
-            if autosave is True:
-                piescope.utils.save_image(image, save_filename, metadata=meta)
-                print("Saved: {}".format(save_filename))
-            # Update GUI
-            self.array_list_FM = image
-            self.slider_stack_FM.setValue(1)
-            self.update_display("FM")
+            save_filename = self._fluorescence_filename('F_')
+            image = self._acquire_fluorescence_image(
+                wavelength, exposure_time, laser_power,
+                save_filename if autosave is True else None)
+            self._show_fluorescence_image(image, save_filename)
         except Exception as e:
             display_error_message(traceback.format_exc())
         else:
-            print("Fluorescence image acquired.")
-            self.image_lm = image
             return image
 
+    def submit_fluorescence_image(self, wavelength, exposure_time, laser_power,
+                                  autosave=True,
+                                  priority=scheduler.PRIORITY_NORMAL):
+        """Queue a fluorescence image as a job, see `fluorescence_image`.
+
+        Returns
+        -------
+        Job
+        """
+        save_filename = self._fluorescence_filename('F_')
+        return self.scheduler.submit(
+            "Fluorescence image",
+            lambda job: self._acquire_fluorescence_image(
+                wavelength, exposure_time, laser_power,
+                save_filename if autosave is True else None),
+            resources=(resources.CAMERA, resources.LASERS), priority=priority,
+            on_done=lambda image: self._show_fluorescence_image(
+                image, save_filename))
+
+    def _fluorescence_filename(self, prefix):
+        return os.path.join(
+            self.save_destination_FM,
+            prefix + self.lineEdit_save_filename_FM.text() + '.tif')
+
+    def _acquire_fluorescence_image(self, wavelength, exposure_time,
+                                    laser_power, save_filename=None):
+        """Acquire and save a fluorescence image, without touching the GUI.
+
+        The camera and lasers must already be leased by the caller.
+        """
+        # Setup
+        exposure_time_microseconds = float(exposure_time) * 1000  # ms ->us
+        WAVELENGTH_TO_LASERNAME = {"640nm": "laser640",
+                                   "561nm": "laser561",
+                                   "488nm": "laser488",
+                                   "405nm": "laser405"}
+        laser_name = WAVELENGTH_TO_LASERNAME[wavelength]
+        self._apply_laser_power(laser_name, laser_power)
+        # Acquire image
+        self.laser_controller.emission_on(laser_name)
+        with tracing.span('camera_grab', 'acquisition',
+                          exposure_time=exposure_time_microseconds):
+            image = self.detector.camera_grab(exposure_time_microseconds)
+        meta = {'exposure_time': str(exposure_time),
+                'laser_name': str(laser_name),
+                'laser_power': str(laser_power),
+                'timestamp': timestamp(),
+                }
+        self.laser_controller.emission_off(laser_name)
+        # Save image
+        if save_filename is not None:
+            with tracing.span('save_image', 'save', filename=save_filename):
+                piescope.utils.save_image(image, save_filename, metadata=meta)
+            print("Saved: {}".format(save_filename))
+        return image
+
+    def _show_fluorescence_image(self, image, filename):
+        self.string_list_FM = [filename]
+        self.array_list_FM = image
+        self.slider_stack_FM.setValue(1)
+        self.update_display("FM")
+        print("Fluorescence image acquired.")
+        self.image_lm = image
+
     def live_imaging_worker(self, stop_event, laser_name, laser_power,
                             exposure_time, image_frame_interval=None):
         """Worker function for live imaging thread.
 
+        The worker only acquires images and never touches the GUI widgets.
+        It waits for the camera and lasers if another acquisition has them.
+        Each frame is sent to the GUI thread with the `liveFrameReady`
+        signal. While the GUI is still displaying the previous frame, new
+        frames are dropped, so the display never falls behind the camera.
+        `liveImagingStopped` is emitted when the worker finishes.
+
         Parameters
         ----------
         stop_event : threading.Event()
@@ -414,32 +617,201 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         """
         # TODO: Can you allow changing which laser is on during live imaging?
         # Setup
+        try:
+            # Wait for any other fluorescence acquisition to finish
+            lease = resources.resource_manager().lease(
+                resources.CAMERA, resources.LASERS, owner="Live imaging",
+                cancel=stop_event)
+        except resources.ResourceBusyError:
+            self.liveImagingStopped.emit()
+            return  # stopped before the camera was free
         print("Live imaging mode running...")
         exposure_time_microseconds = float(exposure_time) * 1000  # ms ->us
-        self.liveCheck = False
-        self.button_live_image_FM.setDown(True)
-        self.lasers[laser_name].laser_power = float(laser_power)
-        self.lasers[laser_name].emission_on()
-        # Running live imaging
-        while not stop_event.isSet():
-            # Take image
-            image = self.detector.camera_grab(exposure_time_microseconds)
-            # Update GUI
+        try:
+            self._apply_laser_power(laser_name, laser_power)
+            self.laser_controller.emission_on(laser_name)
+            # Running live imaging
+            frame = 0
+            while not stop_event.is_set():
+                # Take image
+                with tracing.span('live_imaging_frame', 'acquisition',
+                                  laser=laser_name):
+                    image = self.detector.camera_grab(exposure_time_microseconds)
+                frame += 1
+                metadata = {'exposure_time': str(exposure_time),
+                            'laser_name': str(laser_name),
+                            'laser_power': str(laser_power),
+                            'timestamp': timestamp(),
+                            'frame': frame,
+                            }
+                # Send the image to the GUI thread, unless it is still busy
+                with self._live_frame_lock:
+                    display_busy = self._live_frames_queued > 0
+                    if not display_busy:
+                        self._live_frames_queued += 1
+                if not display_busy:
+                    self.liveFrameReady.emit(image, metadata)
+                # Pause between frames if desired (the laser will remain on)
+                if image_frame_interval is not None:
+                    stop_event.wait(image_frame_interval)
+        except Exception:
+            display_error_message(traceback.format_exc())
+        finally:
+            # Teardown / cleanup
+            print("Stopping live imaging mode.")
+            try:
+                self.laser_controller.emission_off(laser_name)
+                self.detector.camera.Close()
+            except Exception:
+                display_error_message(traceback.format_exc())
+            lease.release()
+            self.liveImagingStopped.emit()
+
+    @tracing.traced('acquisition')
+    @resources.leased(resources.CAMERA, resources.LASERS,
+                      owner="Multichannel image", on_busy=display_error_message)
+    def multichannel_image(self, autosave=True):
+        """Acquire a fluorescence image with each laser selected.
+
+        The lasers, powers and exposure times come from `self.laser_dict`.
+
+        Parameters
+        ----------
+        autosave : bool, optional
+            Whether to save images automatically, by default True
+
+        Returns
+        -------
+        numpy ndarray
+            Channel images stacked along the last axis, with shape
+            (rows, columns, channels).
+        """
+        try:
+            laser_dict = self._selected_lasers()
+            if laser_dict is None:
+                return
+            save_filename = self._fluorescence_filename('Multichannel_')
+            channels = self._acquire_multichannel_image(
+                laser_dict, save_filename if autosave is True else None)
+            self._show_multichannel_image(channels, save_filename)
+        except Exception as e:
+            display_error_message(traceback.format_exc())
+        else:
+            return channels
+
+    def submit_multichannel_image(self, autosave=True,
+                                  priority=scheduler.PRIORITY_NORMAL):
+        """Queue a multichannel image as a job, see `multichannel_image`.
+
+        Returns
+        -------
+        Job
+            None if no lasers, or too many, are selected.
+        """
+        laser_dict = self._selected_lasers()
+        if laser_dict is None:
+            return None
+        save_filename = self._fluorescence_filename('Multichannel_')
+        return self.scheduler.submit(
+            "Multichannel image",
+            lambda job: self._acquire_multichannel_image(
+                laser_dict, save_filename if autosave is True else None,
+                job=job),
+            resources=(resources.CAMERA, resources.LASERS), priority=priority,
+            on_done=lambda channels: self._show_multichannel_image(
+                channels, save_filename))
+
+    def _acquire_multichannel_image(self, laser_dict, save_filename=None,
+                                    job=None):
+        """Acquire and save one image per laser, without touching the GUI.
+
+        Every laser power is set before the first exposure, so between two
+        exposures there is only the switch from one laser to the next and
+        the camera grab. The camera does not stay open across channels:
+        piescope's `camera_grab` opens and closes it for every image, and
+        piescope has no grab that leaves it open. The camera and lasers
+        must already be leased by the caller.
+
+        Parameters
+        ----------
+        laser_dict : dict
+            {laser name: (power, exposure time in microseconds)}, in
+            channel order.
+        save_filename : str, optional
+            Saved with axes (channels, rows, columns), like volumes.
+        job : Job, optional
+            Checked for cancellation between channels.
+
+        Returns
+        -------
+        numpy ndarray
+            Channel images stacked along the last axis, with shape
+            (rows, columns, channels), ready for `piescope.utils.rgb_image`.
+            None if the job was cancelled.
+        """
+        names = list(laser_dict)
+        if not self.laser_controller.apply_powers(
+                {name: laser_dict[name][0] for name in names}):
+            raise RuntimeError("Could not set the laser powers {}".format(
+                {name: laser_dict[name][0] for name in names}))
+        images = []
+        try:
+            for index, name in enumerate(names):
+                if job is not None:
+                    if job.cancelled:
+                        return None
+                    job.report_progress(index / len(names), name)
+                exposure_time = laser_dict[name][1]
+                self.laser_controller.emission_on(name)
+                try:
+                    with tracing.span('camera_grab', 'acquisition', laser=name,
+                                      exposure_time=exposure_time):
+                        images.append(self.detector.camera_grab(exposure_time))
+                finally:
+                    self.laser_controller.emission_off(name)
+        finally:
+            self.detector.camera.Close()  # if a grab failed with it open
+        channels = np.stack(images, axis=-1)
+        if save_filename is not None:
+            meta = {'laser_dict': str(laser_dict),
+                    'timestamp': timestamp(),
+                    }
+            with tracing.span('save_image', 'save', filename=save_filename):
+                piescope.utils.save_image(np.moveaxis(channels, -1, 0),
+                                          save_filename, metadata=meta)
+            print("Saved: {}".format(save_filename))
+        return channels
+
+    def _show_multichannel_image(self, channels, filename):
+        self.string_list_FM = [filename]
+        self.array_list_FM = channels
+        self.slider_stack_FM.setValue(1)
+        self.update_display("FM")
+        print("Multichannel image acquired.")
+        self.image_lm = channels
+
+    def _apply_laser_power(self, laser_name, laser_power):
+        """Set a laser power through the laser thread, and wait for it."""
+        if not self.laser_controller.apply_power(laser_name, laser_power):
+            raise RuntimeError("Could not set {} power to {}".format(
+                laser_name, laser_power))
+
+    def show_live_frame(self, image, metadata):
+        """Display a live imaging frame. Runs in the GUI thread."""
+        try:
             self.array_list_FM = image
-            self.slider_stack_FM.setValue(1)
-            self.update_display("FM")
             # Update filename (if you want to save this image later)
             save_filename = os.path.join(
                 self.save_destination_FM,
                 'F_' + self.lineEdit_save_filename_FM.text() + '.tif')
             self.string_list_FM = [save_filename]
-            # Pause between frames if desired (the laser will remain on)
-            if image_frame_interval is not None:
-                stopevent.wait(image_frame_interval)
-        # Teardown / cleanup
-        print("Stopping live imaging mode.")
-        self.lasers[laser_name].emission_off()
-        self.detector.camera.Close()
+            self.slider_stack_FM.setValue(1)
+            self.update_display("FM")
+        finally:
+            with self._live_frame_lock:
+                self._live_frames_queued -= 1
+
+    def live_imaging_stopped(self):
         self.liveCheck = True
         self.button_live_image_FM.setDown(False)
 
@@ -468,6 +840,9 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
                                         "405nm": "laser405"}
             laser_name = WAVELENGTH_TO_LASERNAME[wavelength]
             if self.liveCheck is True:
+                # Live imaging runs until the button is pressed again
+                self.liveCheck = False
+                self.button_live_image_FM.setDown(True)
                 self.stop_event = threading.Event()
                 self._thread = threading.Thread(
                     target=self.live_imaging_worker,
@@ -519,6 +894,9 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         else:
             return pos
 
+    @tracing.traced('stage', arguments=('position',))
+    @resources.leased(resources.OBJECTIVE_STAGE, owner="Objective stage move",
+                      on_busy=display_error_message)
     def move_absolute_objective_stage(self, stage, position='', time_delay=0.3, testing=False):
         if position is '':
             position = self.label_objective_stage_saved_position.text()
@@ -536,18 +914,21 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
             return
         try:
             logger.debug("Absolute move the objective stage to position "
-                         "{}".format(position))
+                         "%s", position)
             ans = stage.move_absolute(position)
             time.sleep(time_delay)
             new_position = stage.current_position()
             logger.debug("After absolute move, objective stage is now at "
-                         "position: {}".format(new_position))
+                         "position: %s", new_position)
         except Exception as e:
             display_error_message(traceback.format_exc())
         else:
             self.label_objective_stage_position.setText(str(float(new_position)/1000))
             return new_position
 
+    @tracing.traced('stage', arguments=('distance',))
+    @resources.leased(resources.OBJECTIVE_STAGE, owner="Objective stage move",
+                      on_busy=display_error_message)
     def move_relative_objective_stage(self, stage, distance='', time_delay=0.3, testing=False):
         if distance is '':
             distance = self.lineEdit_move_relative.text()
@@ -565,12 +946,12 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
             return
         try:
             logger.debug("Relative move the objective stage by "
-                         "{}".format(distance))
+                         "%s", distance)
             ans = stage.move_relative(distance)
             time.sleep(time_delay)
             new_position = stage.current_position()
             logger.debug("After relative move, objective stage is now at "
-                         "position: {}".format(new_position))
+                         "position: %s", new_position)
         except Exception as e:
             display_error_message(traceback.format_exc())
         else:
@@ -579,10 +960,7 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
 
     ############## Fluorescence laser methods ##############
     def update_laser_dict(self, laser):
-        logger.debug("Updating laser dictionary")
-        logger.debug("{}".format(laser))
-        logger.debug(self.lasers)
-        logger.debug(self.lasers[laser])
+        logger.debug("Updating laser dictionary for %s", laser)
         try:
             assert laser == self.lasers[laser].NAME
             if laser == "laser640":
@@ -615,12 +993,14 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
                 widget_textexposure = self.lineEdit_exposure_4
             # Update laser object attributes
             self.lasers[laser].selected = laser_selected
-            self.lasers[laser].laser_power = laser_power
+            # Sent once the slider stops moving, and only if changed
+            self.laser_controller.set_power(laser, laser_power)
             self.lasers[laser].exposure_time = exposure_time
             laser_dict = {}
             for i in self.lasers.values():
                 if i.selected is True:
-                    laser_dict[i.NAME] = (i.laser_power, i.exposure_time)
+                    laser_dict[i.NAME] = (self.laser_controller.power(i.NAME),
+                                          i.exposure_time)
             self.laser_dict = laser_dict
             # Grey out laser contol widgets if laser checkbox is not selected
             if laser_selected:
@@ -635,6 +1015,7 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
             display_error_message(traceback.format_exc())
 
     ############## Image methods ##############
+    @tracing.traced('load', arguments=('modality',))
     def open_images(self, modality):
         """Open image files and display the first"""
         try:
@@ -661,6 +1042,13 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
                 if self.string_list_FIBSEM:
                     self.array_list_FIBSEM = _create_array_list(
                         self.string_list_FIBSEM, "FIBSEM")
+                    # the last acquired image no longer matches the display
+                    self.fibsem_image = []
+                    if len(self.string_list_FIBSEM) == 1:
+                        adorned_image = _load_adorned_image(
+                            self.string_list_FIBSEM[0])
+                        if adorned_image is not None:
+                            self.fibsem_image = adorned_image
                     self.slider_stack_FIBSEM.setMaximum(
                         len(self.string_list_FIBSEM))
                     self.spinbox_slider_FIBSEM.setMaximum(
@@ -670,6 +1058,7 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         except Exception as e:
             display_error_message(traceback.format_exc())
 
+    @tracing.traced('save', arguments=('modality',))
     def save_image(self, modality):
         """Save image on display """
         try:
@@ -739,6 +1128,7 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         except Exception as e:
             display_error_message(traceback.format_exc())
 
+    @tracing.traced('display', arguments=('modality',))
     def update_display(self, modality):
         """Update the GUI display with the current image"""
         try:
@@ -869,67 +1259,144 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         except Exception as e:
             display_error_message(traceback.format_exc())
 
+    @tracing.traced('acquisition')
+    @resources.leased(resources.CAMERA, resources.LASERS,
+                      resources.OBJECTIVE_STAGE, owner="Volume acquisition",
+                      on_busy=display_error_message)
     def acquire_volume(self, autosave=True):
         print('Acqiuring fluorescence volume image...')
         try:
-            laser_dict = self.laser_dict
-            if laser_dict == {}:
-                display_error_message("Please select up to three lasers.")
-                return
-            if len(laser_dict) > 3:
-                display_error_message("Please select a maximum of 3 lasers.")
+            settings = self._volume_settings()
+            if settings is None:
                 return
+            rgb = self._acquire_volume(
+                *settings, save_filenames=self._volume_filenames(autosave))
+            self._show_volume(rgb)
+        except Exception as e:
+            display_error_message(traceback.format_exc())
 
-            try:
-                num_z_slices = int(self.lineEdit_slice_number.text())
-            except ValueError:
+    def submit_volume(self, autosave=True, priority=scheduler.PRIORITY_NORMAL):
+        """Queue a volume acquisition as a job, see `acquire_volume`.
+
+        Returns
+        -------
+        Job
+            None if the volume settings are invalid.
+        """
+        settings = self._volume_settings()
+        if settings is None:
+            return None
+        save_filenames = self._volume_filenames(autosave)
+        return self.scheduler.submit(
+            "Volume acquisition",
+            lambda job: self._acquire_volume(
+                *settings, save_filenames=save_filenames, job=job),
+            resources=(resources.CAMERA, resources.LASERS,
+                       resources.OBJECTIVE_STAGE),
+            priority=priority, on_done=self._show_volume)
+
+    def _selected_lasers(self):
+        """A copy of `self.laser_dict`, or None after showing an error
+        message if no lasers or more than three are selected."""
+        laser_dict = dict(self.laser_dict)
+        if laser_dict == {}:
+            display_error_message("Please select up to three lasers.")
+            return
+        if len(laser_dict) > 3:
+            display_error_message("Please select a maximum of 3 lasers.")
+            return
+        return laser_dict
+
+    def _volume_settings(self):
+        """The lasers, number of slices and slice distance for a volume,
+        or None after showing an error message if they are invalid."""
+        laser_dict = self._selected_lasers()
+        if laser_dict is None:
+            return
+
+        try:
+            num_z_slices = int(self.lineEdit_slice_number.text())
+        except ValueError:
+            display_error_message("Number of slices must be a positive integer")
+            return
+        else:
+            if num_z_slices < 0:
                 display_error_message("Number of slices must be a positive integer")
                 return
-            else:
-                if num_z_slices < 0:
-                    display_error_message("Number of slices must be a positive integer")
-                    return
 
-            try:
-                z_slice_distance = int(self.lineEdit_slice_distance.text())
-            except ValueError:
+        try:
+            z_slice_distance = int(self.lineEdit_slice_distance.text())
+        except ValueError:
+            display_error_message("Slice distance must be a positive integer")
+            return
+        else:
+            if z_slice_distance < 0:
                 display_error_message("Slice distance must be a positive integer")
                 return
-            else:
-                if z_slice_distance < 0:
-                    display_error_message("Slice distance must be a positive integer")
-                    return
+        return laser_dict, num_z_slices, z_slice_distance
+
+    def _volume_filenames(self, autosave=True):
+        """Filenames for the volume and its maximum intensity projection."""
+        if autosave is not True:
+            return None
+        return (self._fluorescence_filename('Volume_'),
+                self._fluorescence_filename('MIP_'))
+
+    def _acquire_volume(self, laser_dict, num_z_slices, z_slice_distance,
+                        save_filenames=None, job=None):
+        """Acquire and save a volume, without touching the GUI.
 
-            volume = piescope.lm.volume.volume_acquisition(
-                laser_dict, num_z_slices, z_slice_distance,
-                detector=self.detector, lasers=self.lasers,
-                objective_stage=self.objective_stage)
-            meta = {'z_slice_distance': str(z_slice_distance),
-                        'num_z_slices': str(num_z_slices),
-                        'laser_dict': str(laser_dict),
-                        }
-            max_intensity = piescope.utils.max_intensity_projection(volume)
-            if autosave is True:
-                # Save volume
-                save_filename = os.path.join(self.save_destination_FM,
-                    'Volume_' + self.lineEdit_save_filename_FM.text() + '.tif')
+        The camera, lasers and objective stage must already be leased by the
+        caller. The volume is acquired in one go, so a job can only be
+        cancelled before the acquisition or before saving.
+
+        Returns
+        -------
+        numpy ndarray
+            RGB image of the volume's maximum intensity projection.
+        """
+        if job is not None:
+            job.report_progress(0, 'acquiring')
+        self.laser_controller.flush()
+        try:
+            # piescope writes laser commands itself
+            with self.laser_controller.serial_lock, tracing.span(
+                    'volume_acquisition', 'acquisition',
+                    lasers=sorted(laser_dict), num_z_slices=num_z_slices,
+                    z_slice_distance=z_slice_distance):
+                volume = piescope.lm.volume.volume_acquisition(
+                    laser_dict, num_z_slices, z_slice_distance,
+                    detector=self.detector, lasers=self.lasers,
+                    objective_stage=self.objective_stage)
+        finally:
+            # piescope sets the laser powers itself
+            self.laser_controller.invalidate()
+        meta = {'z_slice_distance': str(z_slice_distance),
+                    'num_z_slices': str(num_z_slices),
+                    'laser_dict': str(laser_dict),
+                    }
+        max_intensity = piescope.utils.max_intensity_projection(volume)
+        if save_filenames is not None and not (job is not None and job.cancelled):
+            if job is not None:
+                job.report_progress(0.9, 'saving')
+            # Save volume and maximum intensity projection
+            save_filename, save_filename_max_intensity = save_filenames
+            with tracing.span('save_image', 'save', filename=save_filename):
                 piescope.utils.save_image(volume, save_filename, metadata=meta)
-                print('Saved: {}'.format(save_filename))
-                # Save maximum intensity projection
-                save_filename_max_intensity = os.path.join(
-                    self.save_destination_FM,
-                    'MIP_' + self.lineEdit_save_filename_FM.text() + '.tif')
+            print('Saved: {}'.format(save_filename))
+            with tracing.span('save_image', 'save',
+                              filename=save_filename_max_intensity):
                 piescope.utils.save_image(
                     max_intensity, save_filename_max_intensity, metadata=meta)
-                print('Saved: {}'.format(save_filename_max_intensity))
-            # Update display
-            rgb = piescope.utils.rgb_image(max_intensity)
-            self.string_list_FM = ["RGB image"]
-            self.array_list_FM = rgb
-            self.update_display("FM")
-        except Exception as e:
-            display_error_message(traceback.format_exc())
+            print('Saved: {}'.format(save_filename_max_intensity))
+        return piescope.utils.rgb_image(max_intensity)
 
+    def _show_volume(self, rgb):
+        self.string_list_FM = ["RGB image"]
+        self.array_list_FM = rgb
+        self.update_display("FM")
+
+    @tracing.traced('correlation')
     def correlateim(self):
         tempfile = "C:"
         try:
@@ -958,8 +1425,13 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
 
             output_filename = output_filename + image_ext + "_" + str(copy_count) + ".tiff"
 
+            adorned_fibsem_image = None
+            if (hasattr(self.fibsem_image, 'metadata') and
+                    np.shape(self.fibsem_image.data)[:2] == np.shape(fibsem_image)[:2]):
+                adorned_fibsem_image = self.fibsem_image
             window = corr.open_correlation_window(
-                self, fluorescence_image, fibsem_image, output_filename)
+                self, fluorescence_image, fibsem_image, output_filename,
+                adorned_fibsem_image=adorned_fibsem_image)
             window.showMaximized()
             window.show()
 
@@ -973,6 +1445,7 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
                 os.remove(tempfile)
             display_error_message(traceback.format_exc())
 
+    @tracing.traced('milling')
     def mill_window_from_correlation(self, window):
         aligned_image = window.menu_quit()
         try:
@@ -980,6 +1453,7 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         except Exception:
             display_error_message(traceback.format_exc())
 
+    @tracing.traced('milling')
     def milling(self):
         try:
             filename, _ = QtWidgets.QFileDialog.getOpenFileName(
@@ -1008,6 +1482,30 @@ class GUIMainWindow(gui_main.Ui_MainGui, QtWidgets.QMainWindow):
         except Exception as e:
             display_error_message(traceback.format_exc())
 
+    def export_trace(self):
+        """Save the recent tracing spans as a Chrome trace event JSON file."""
+        try:
+            filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+                self, 'Export Trace',
+                os.path.join(self.DEFAULT_PATH, 'trace_' + timestamp() + '.json'),
+                filter="Chrome trace (*.json)")
+            if filename:
+                tracing.export_chrome_trace(filename)
+                print('Saved: {}'.format(filename))
+        except Exception as e:
+            display_error_message(traceback.format_exc())
+
+
+def _load_adorned_image(filename):
+    """The AdornedImage in a file with its pixel size metadata, or None."""
+    try:
+        from autoscript_sdb_microscope_client.structures import AdornedImage
+        adorned_image = AdornedImage().load(filename)
+        adorned_image.metadata.binary_result.pixel_size.x
+    except Exception:
+        return None
+    return adorned_image
+
 
 def _create_array_list(input_list, modality):
     if modality == "FM":
@@ -1044,9 +1542,9 @@ def main(offline):
     python piescope_gui/main.py
     ```
 
-    To launch `piescope_gui` in offline mode for testing
-    (you will need an offline scripting version of AutoScript installed),
-    call `piescope_gui` using the `--offline=True` command line option:
+    To launch `piescope_gui` in offline mode for testing, with simulated
+    hardware (see `piescope_gui.simulation`), call `piescope_gui` using
+    the `--offline=True` command line option:
     ```
     piescope --offline=True
     ```
@@ -1060,28 +1558,22 @@ def main(offline):
     offline : bool
         Default value is False, which launches the `piescope_gui` & assumes
         it's connected correctly to all the microscope hardware.
-        If offline is True, we launch `piescope_gui` using:
-        * The Basler offline emulator for the fluorescence detector.
-        * A mock patch for the SMARACT objective lens stage.
-        * AutoScript via "localhost" (requires offline scripting installation).
+        If offline is True, we launch `piescope_gui` using simulated
+        lasers, Basler detector, SMARACT objective lens stage and
+        FIBSEM microscope, which need no hardware or AutoScript.
     """
     if offline.lower() == 'false':
-        logging.basicConfig(level=logging.WARNING)
+        setup_logging(level=logging.INFO)
         launch_gui(ip_address='10.0.0.1', offline=False)
     elif offline.lower() == 'true':
-        logging.basicConfig(level=logging.DEBUG)
-        with mock.patch.dict('os.environ', {'PYLON_CAMEMU': '1'}):
-            with mock.patch('piescope.lm.objective.StageController',
-                            autospec=True) as mock_objective:
-                instance = mock_objective.return_value
-                instance.current_position.return_value = 0
-
-                try:
-                    launch_gui(ip_address="localhost", offline=True)
-                except Exception:
-                    import pdb
-                    traceback.print_exc()
-                    pdb.set_trace()
+        setup_logging(level=logging.INFO)
+        with piescope_gui.simulation.simulated_backend():
+            try:
+                launch_gui(ip_address="localhost", offline=True)
+            except Exception:
+                import pdb
+                traceback.print_exc()
+                pdb.set_trace()
 
 
 def launch_gui(ip_address='10.0.0.1', offline=False):
@@ -1,4 +1,8 @@
+import itertools
 import logging
+import os
+import threading
+import time
 import traceback
 
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
@@ -13,12 +17,360 @@ import skimage.color
 import skimage.io
 import skimage.transform
 
-from piescope import fibsem
-
+from piescope_gui import monitoring, resources, tracing
 from piescope_gui.utils import display_error_message, timestamp
 
 logger = logging.getLogger(__name__)
 
+# Seconds between reads of microscope.patterning.state while milling.
+PATTERNING_POLL_INTERVAL = 1.0
+# Seconds to wait for patterning to start running. Until then, an "Idle"
+# state means the asynchronous start hasn't taken effect yet.
+PATTERNING_START_TIMEOUT = 10.0
+
+# Sputter rates in cubic micrometres per nanocoulomb, for a 30 kV gallium
+# ion beam at normal incidence. Real rates depend on the incidence angle,
+# redeposition and the pattern scan strategy, so estimates are approximate.
+SPUTTER_RATES = {
+    'Si': 0.27,
+    'SiO2': 0.24,
+    'Al': 0.30,
+    'C': 0.18,
+    'Cu': 0.25,
+    'Au': 1.50,
+    'Pt': 0.23,
+    'W': 0.12,
+}
+DEFAULT_MATERIAL = 'Si'
+
+# Pattern templates generated around one clicked centre, see `template_patterns`.
+TEMPLATES = ('lamella', 'undercut', 'polishing')
+
+
+class MillingPattern:
+    """Rectangular milling pattern, in microscope patterning coordinates.
+
+    Parameters
+    ----------
+    center_x, center_y : float
+        Pattern centre in metres, relative to the image centre, y up.
+    width, height : float
+        Pattern size in metres.
+    depth : float, optional
+        Milling depth in metres, by default 1e-6.
+    current : float, optional
+        Ion beam current in amps. By default None, milling with whatever
+        current the ion beam is set to.
+    name : str, optional
+        Label shown in the milling window.
+    scan_direction : str, optional
+        Autoscript pattern scan direction, e.g. 'TopToBottom'.
+        By default None, keeping the microscope default.
+    """
+    def __init__(self, center_x, center_y, width, height, depth=1e-6,
+                 current=None, name='', scan_direction=None):
+        self.center_x = center_x
+        self.center_y = center_y
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.current = current
+        self.name = name
+        self.scan_direction = scan_direction
+
+    def __repr__(self):
+        return ('MillingPattern(center_x={}, center_y={}, width={}, height={}, '
+                'depth={}, current={}, name={!r}, scan_direction={!r})'.format(
+                    self.center_x, self.center_y, self.width, self.height,
+                    self.depth, self.current, self.name, self.scan_direction))
+
+
+def pixel_size(adorned_image):
+    """Pixel size in metres of an Adorned Image."""
+    return adorned_image.metadata.binary_result.pixel_size.x
+
+
+def pattern_from_pixels(adorned_image, x0, x1, y0, y1, depth=1e-6,
+                        current=None, name=''):
+    """Milling pattern from a rectangle drawn on an Adorned Image.
+
+    Parameters
+    ----------
+    adorned_image : Adorned Image
+        Ion beam image with pixel size metadata.
+    x0, x1, y0, y1 : float
+        Rectangle corners in image pixel coordinates, in any order.
+    depth, current, name
+        See `MillingPattern`.
+
+    Returns
+    -------
+    MillingPattern
+    """
+    size = pixel_size(adorned_image)
+    center_x, center_y = pixels_to_patterning(
+        adorned_image, (x0 + x1) / 2, (y0 + y1) / 2)
+    return MillingPattern(center_x, center_y, abs(x1 - x0) * size,
+                          abs(y1 - y0) * size, depth=depth, current=current,
+                          name=name)
+
+
+def pixels_to_patterning(adorned_image, x, y):
+    """Patterning coordinates in metres of an image pixel position."""
+    size = pixel_size(adorned_image)
+    rows, columns = adorned_image.data.shape[:2]
+    return (x - columns / 2) * size, (rows / 2 - y) * size
+
+
+def pattern_to_pixels(pattern, adorned_image):
+    """Rectangle of a milling pattern in image pixel coordinates.
+
+    Returns
+    -------
+    (x, y, width, height)
+        Top left corner column and row, and size in pixels.
+    """
+    size = pixel_size(adorned_image)
+    rows, columns = adorned_image.data.shape[:2]
+    width = pattern.width / size
+    height = pattern.height / size
+    x = pattern.center_x / size + columns / 2 - width / 2
+    y = rows / 2 - pattern.center_y / size - height / 2
+    return x, y, width, height
+
+
+@tracing.traced('milling')
+def create_patterns(microscope, patterns):
+    """Replace the patterns on the microscope with a new batch.
+
+    Parameters
+    ----------
+    microscope : Autoscript microscope object.
+    patterns : list of MillingPattern
+
+    Returns
+    -------
+    list
+        Autoscript rectangle pattern objects, in the same order.
+    """
+    microscope.patterning.clear_patterns()
+    created = []
+    for pattern in patterns:
+        rectangle = microscope.patterning.create_rectangle(
+            pattern.center_x, pattern.center_y,
+            pattern.width, pattern.height, pattern.depth)
+        if pattern.scan_direction is not None:
+            rectangle.scan_direction = pattern.scan_direction
+        created.append(rectangle)
+    return created
+
+
+def polishing_patterns(center_x, center_y, width=10e-6, thickness=1e-6,
+                       depth=2e-6, polishing_passes=2, polishing_step=0.25e-6,
+                       current=None, name='Polish'):
+    """Thin passes on both sides of a lamella, from the outside in.
+
+    Parameters
+    ----------
+    center_x, center_y : float
+        Lamella centre in metres, patterning coordinates.
+    width : float, optional
+        Lamella width in metres, by default 10 µm.
+    thickness : float, optional
+        Final lamella thickness in metres, by default 1 µm.
+    depth : float, optional
+        Milling depth in metres, by default 2 µm.
+    polishing_passes : int, optional
+        Number of passes on each side, by default 2.
+    polishing_step : float, optional
+        Material removed from each side per pass in metres, by default 0.25 µm.
+    current : float, optional
+        Ion beam current in amps, see `MillingPattern`.
+    name : str, optional
+        Prefix of the pattern names.
+
+    Returns
+    -------
+    list of MillingPattern
+        Upper and lower passes, alternating, outermost first.
+    """
+    patterns = []
+    for i in range(polishing_passes, 0, -1):
+        offset = thickness / 2 + (i - 0.5) * polishing_step
+        for side, sign, direction in [('upper', 1, 'TopToBottom'),
+                                      ('lower', -1, 'BottomToTop')]:
+            patterns.append(MillingPattern(
+                center_x, center_y + sign * offset, width, polishing_step,
+                depth=depth, current=current, scan_direction=direction,
+                name='{} {} {}'.format(name, side, polishing_passes - i + 1)))
+    return patterns
+
+
+def lamella_patterns(center_x, center_y, width=10e-6, thickness=1e-6,
+                     trench_height=5e-6, depth=2e-6, polishing_passes=2,
+                     polishing_step=0.25e-6, current=None, name='Lamella'):
+    """Upper and lower trenches, then polishing passes, for one lamella.
+
+    The trenches stop `polishing_passes * polishing_step` from the final
+    lamella faces, and are milled towards the lamella. See
+    `polishing_patterns` for the parameters.
+
+    Parameters
+    ----------
+    trench_height : float, optional
+        Height of each trench in metres, by default 5 µm.
+
+    Returns
+    -------
+    list of MillingPattern
+    """
+    offset = thickness / 2 + polishing_passes * polishing_step + trench_height / 2
+    return [
+        MillingPattern(center_x, center_y + offset, width, trench_height,
+                       depth=depth, current=current, scan_direction='TopToBottom',
+                       name=name + ' upper trench'),
+        MillingPattern(center_x, center_y - offset, width, trench_height,
+                       depth=depth, current=current, scan_direction='BottomToTop',
+                       name=name + ' lower trench'),
+    ] + polishing_patterns(center_x, center_y, width, thickness, depth,
+                           polishing_passes, polishing_step, current,
+                           name=name + ' polish')
+
+
+def undercut_patterns(center_x, center_y, width=10e-6, thickness=1e-6,
+                      depth=2e-6, line_width=0.5e-6, current=None,
+                      name='Undercut'):
+    """U shaped cut freeing the bottom and sides of a lamella.
+
+    Parameters
+    ----------
+    line_width : float, optional
+        Width of the cuts in metres, by default 0.5 µm.
+
+    See `polishing_patterns` for the other parameters.
+
+    Returns
+    -------
+    list of MillingPattern
+    """
+    bottom_y = center_y - thickness / 2 - line_width / 2
+    side_x = width / 2 + line_width / 2
+    side_height = thickness + line_width
+    side_y = center_y - line_width / 2
+    return [
+        MillingPattern(center_x, bottom_y, width + 2 * line_width, line_width,
+                       depth=depth, current=current, name=name + ' bottom'),
+        MillingPattern(center_x - side_x, side_y, line_width, side_height,
+                       depth=depth, current=current, name=name + ' left'),
+        MillingPattern(center_x + side_x, side_y, line_width, side_height,
+                       depth=depth, current=current, name=name + ' right'),
+    ]
+
+
+def template_patterns(template, adorned_image, x, y, **parameters):
+    """Generate the full pattern set of a template around a clicked point.
+
+    Parameters
+    ----------
+    template : str
+        One of `TEMPLATES`.
+    adorned_image : Adorned Image
+        Ion beam image with pixel size metadata.
+    x, y : float
+        Template centre in image pixel coordinates.
+    **parameters
+        Sizes in metres and other keyword arguments of the template function,
+        `lamella_patterns`, `undercut_patterns` or `polishing_patterns`.
+
+    Returns
+    -------
+    list of MillingPattern
+    """
+    functions = {'lamella': lamella_patterns,
+                 'undercut': undercut_patterns,
+                 'polishing': polishing_patterns}
+    if template not in functions:
+        raise ValueError("Unknown pattern template '{}', expected one of "
+                         "{}".format(template, TEMPLATES))
+    center_x, center_y = pixels_to_patterning(adorned_image, x, y)
+    return functions[template](center_x, center_y, **parameters)
+
+
+def group_by_current(patterns):
+    """Split a pattern queue into batches milled with one beam current.
+
+    Consecutive patterns with the same current share a batch, so the
+    milling order of the queue is kept.
+
+    Returns
+    -------
+    list of (current, list of MillingPattern)
+    """
+    return [(current, list(group)) for current, group in
+            itertools.groupby(patterns, key=lambda pattern: pattern.current)]
+
+
+def estimate_milling_time(pattern, current=None, material=DEFAULT_MATERIAL,
+                          sputter_rates=None):
+    """Estimate how long a pattern takes to mill.
+
+    The milled volume (area times depth) divided by the sputter rate of
+    the material gives the ion dose needed, and the dose divided by the
+    beam current gives the time.
+
+    Parameters
+    ----------
+    pattern : MillingPattern
+        Pattern with size and depth in metres.
+    current : float, optional
+        Ion beam current in amps. By default, the pattern's own current.
+    material : str, optional
+        Key of the sputter rate table, by default 'Si'.
+    sputter_rates : dict, optional
+        Sputter rates in cubic micrometres per nanocoulomb, by material.
+        By default `SPUTTER_RATES`.
+
+    Returns
+    -------
+    float
+        Estimated milling time in seconds.
+    """
+    sputter_rates = SPUTTER_RATES if sputter_rates is None else sputter_rates
+    if pattern.current is not None:
+        current = pattern.current
+    if not current or current <= 0:
+        raise ValueError("An ion beam current is needed to estimate "
+                         "the milling time, got {}".format(current))
+    if material not in sputter_rates:
+        raise ValueError("Unknown material '{}', expected one of {}".format(
+            material, sorted(sputter_rates)))
+    volume = pattern.width * pattern.height * pattern.depth * 1e18  # µm^3
+    dose = volume / sputter_rates[material]  # nC
+    return dose / (current * 1e9)
+
+
+def estimate_queue_time(patterns, current=None, material=DEFAULT_MATERIAL,
+                        sputter_rates=None):
+    """Estimated total milling time in seconds of a list of patterns.
+
+    See `estimate_milling_time`, `current` is used for patterns without
+    their own current.
+    """
+    return sum(estimate_milling_time(pattern, current, material, sputter_rates)
+               for pattern in patterns)
+
+
+def format_duration(seconds):
+    """Format a duration in seconds as a short human readable string."""
+    seconds = int(round(seconds))
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours:
+        return '{} h {:02d} min'.format(hours, minutes)
+    if minutes:
+        return '{} min {:02d} s'.format(minutes, seconds)
+    return '{} s'.format(seconds)
+
 
 def open_milling_window(parent_gui, display_image, adorned_ion_image):
     """Opens a new window to perform correlation
@@ -42,9 +394,26 @@ def open_milling_window(parent_gui, display_image, adorned_ion_image):
 
 
 class _MainWindow(QMainWindow):
+    driftMeasured = pyqtSignal(object)
+    endpointMeasured = pyqtSignal(object)
+
     def __init__(self, parent=None, adorned_ion_image=None):
         super().__init__(parent=parent)
         self.adorned_ion_image = adorned_ion_image
+        self.queue = []
+        self._pattern_count = 0
+        self._queue_patches = []
+        self._template_patches = []
+        self._stages = []
+        self._stage_estimate = None
+        self._poller = None
+        self._created = []
+        self._drift_tracker = None
+        self._drift_acquisition = None
+        self._endpoint_acquisition = None
+        self._patterning_control = None
+        self._milling_lease = None  # ion beam and sample stage while milling
+        self.beam_current = self.read_beam_current()
         self.create_window()
         self.create_conn()
 
@@ -92,12 +461,12 @@ class _MainWindow(QMainWindow):
         self.button_move_to_fluorescence.setFixedHeight(button_height)
         self.button_move_to_fluorescence.setStyleSheet("font-size: 16px;")
 
-        self.pattern_creation_button = QPushButton("Add milling pattern")
+        self.pattern_creation_button = QPushButton("Add pattern to queue")
         self.pattern_creation_button.setFixedWidth(button_width)
         self.pattern_creation_button.setFixedHeight(button_height)
         self.pattern_creation_button.setStyleSheet("font-size: 16px;")
 
-        self.pattern_start_button = QPushButton("Start milling pattern")
+        self.pattern_start_button = QPushButton("Start milling queue")
         self.pattern_start_button.setFixedWidth(button_width)
         self.pattern_start_button.setFixedHeight(button_height)
         self.pattern_start_button.setStyleSheet("font-size: 16px;")
@@ -148,6 +517,93 @@ class _MainWindow(QMainWindow):
         self.y1_label2.setFixedHeight(30)
         self.y1_label2.setStyleSheet("font-size: 16px;")
 
+        self.depth_label = QLabel("Depth (µm):")
+        self.depth_label.setStyleSheet("font-size: 16px;")
+        self.depth_spinbox = QDoubleSpinBox()
+        self.depth_spinbox.setDecimals(2)
+        self.depth_spinbox.setRange(0.01, 100)
+        self.depth_spinbox.setSingleStep(0.1)
+        self.depth_spinbox.setValue(1.0)
+
+        self.current_label = QLabel("Current (nA):")
+        self.current_label.setStyleSheet("font-size: 16px;")
+        self.current_spinbox = QDoubleSpinBox()
+        self.current_spinbox.setDecimals(3)
+        self.current_spinbox.setRange(0, 100)
+        self.current_spinbox.setSingleStep(0.01)
+        # zero keeps whatever current the ion beam is set to
+        self.current_spinbox.setSpecialValueText("Beam setting")
+
+        self.material_label = QLabel("Material:")
+        self.material_label.setStyleSheet("font-size: 16px;")
+        self.material_combobox = QComboBox()
+        self.material_combobox.addItems(sorted(SPUTTER_RATES))
+        self.material_combobox.setCurrentText(DEFAULT_MATERIAL)
+
+        self.template_label = QLabel("Template:")
+        self.template_label.setStyleSheet("font-size: 16px;")
+        self.template_combobox = QComboBox()
+        self.template_combobox.addItem("Draw rectangle", None)
+        self.template_combobox.addItem("Lamella", 'lamella')
+        self.template_combobox.addItem("Undercut", 'undercut')
+        self.template_combobox.addItem("Polishing passes", 'polishing')
+        self.template_width_spinbox = _micrometre_spinbox(10.0)
+        self.template_thickness_spinbox = _micrometre_spinbox(1.0)
+        self.template_trench_spinbox = _micrometre_spinbox(5.0)
+        self.template_passes_spinbox = QSpinBox()
+        self.template_passes_spinbox.setRange(0, 20)
+        self.template_passes_spinbox.setValue(2)
+        self.template_step_spinbox = _micrometre_spinbox(0.25)
+        self.template_cut_spinbox = _micrometre_spinbox(0.5)
+
+        self.estimate_label = QLabel("Estimated time: -")
+        self.estimate_label.setStyleSheet("font-size: 16px;")
+
+        self.queue_table = QTableWidget(0, 6)
+        self.queue_table.setHorizontalHeaderLabels(
+            ["Pattern", "Width (µm)", "Height (µm)", "Depth (µm)",
+             "Current (nA)", "Estimated time"])
+        self.queue_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.queue_table.setMaximumHeight(200)
+
+        self.remove_pattern_button = QPushButton("Remove selected pattern")
+        self.remove_pattern_button.setFixedWidth(button_width)
+        self.remove_pattern_button.setStyleSheet("font-size: 16px;")
+
+        self.clear_queue_button = QPushButton("Clear queue")
+        self.clear_queue_button.setFixedWidth(button_width)
+        self.clear_queue_button.setStyleSheet("font-size: 16px;")
+
+        self.drift_checkbox = QCheckBox("Track drift while milling")
+        self.drift_checkbox.setStyleSheet("font-size: 16px;")
+        self.drift_combobox = QComboBox()
+        self.drift_combobox.addItem("No compensation", None)
+        self.drift_combobox.addItem("Shift patterns", 'patterns')
+        self.drift_combobox.addItem("Shift ion beam", 'beam')
+        self.drift_label = QLabel("")
+        self.drift_label.setStyleSheet("font-size: 16px;")
+
+        self.endpoint_checkbox = QCheckBox("Pause at milling endpoint")
+        self.endpoint_checkbox.setStyleSheet("font-size: 16px;")
+        self.endpoint_metric_combobox = QComboBox()
+        self.endpoint_metric_combobox.addItem("Brightness change", 'brightness')
+        self.endpoint_metric_combobox.addItem("Image change", 'change')
+        self.endpoint_beam_combobox = QComboBox()
+        self.endpoint_beam_combobox.addItem("Electron beam images", 'electron')
+        self.endpoint_beam_combobox.addItem("Ion beam images", 'ion')
+        self.endpoint_threshold_spinbox = QDoubleSpinBox()
+        self.endpoint_threshold_spinbox.setRange(-100, 1000)
+        self.endpoint_threshold_spinbox.setSuffix(" %")
+        self.endpoint_threshold_spinbox.setValue(20)
+        self.endpoint_label = QLabel("")
+        self.endpoint_label.setStyleSheet("font-size: 16px;")
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, 1000)
+        self.progress_bar.setTextVisible(False)
+        self.progress_label = QLabel("Patterning idle")
+        self.progress_label.setStyleSheet("font-size: 16px;")
+
         spacerItem = QtWidgets.QSpacerItem(0, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
 
         hlay.addWidget(self.x0_label)
@@ -168,6 +624,52 @@ class _MainWindow(QMainWindow):
         hlay.addWidget(self.exitButton)
         vlay.addLayout(hlay)
 
+        hlay_queue = QHBoxLayout()
+        vlay_queue = QVBoxLayout()
+        hlay_depth = QHBoxLayout()
+        hlay_depth.addWidget(self.depth_label)
+        hlay_depth.addWidget(self.depth_spinbox)
+        hlay_current = QHBoxLayout()
+        hlay_current.addWidget(self.current_label)
+        hlay_current.addWidget(self.current_spinbox)
+        hlay_material = QHBoxLayout()
+        hlay_material.addWidget(self.material_label)
+        hlay_material.addWidget(self.material_combobox)
+        vlay_queue.addLayout(hlay_depth)
+        vlay_queue.addLayout(hlay_current)
+        vlay_queue.addLayout(hlay_material)
+        hlay_template = QHBoxLayout()
+        hlay_template.addWidget(self.template_label)
+        hlay_template.addWidget(self.template_combobox)
+        vlay_queue.addLayout(hlay_template)
+        form_template = QFormLayout()
+        form_template.addRow("Lamella width (µm):", self.template_width_spinbox)
+        form_template.addRow("Lamella thickness (µm):",
+                             self.template_thickness_spinbox)
+        form_template.addRow("Trench height (µm):", self.template_trench_spinbox)
+        form_template.addRow("Polishing passes:", self.template_passes_spinbox)
+        form_template.addRow("Polishing step (µm):", self.template_step_spinbox)
+        form_template.addRow("Undercut width (µm):", self.template_cut_spinbox)
+        vlay_queue.addLayout(form_template)
+        vlay_queue.addWidget(self.estimate_label)
+        vlay_queue.addWidget(self.drift_checkbox)
+        vlay_queue.addWidget(self.drift_combobox)
+        vlay_queue.addWidget(self.drift_label)
+        vlay_queue.addWidget(self.endpoint_checkbox)
+        hlay_endpoint = QHBoxLayout()
+        hlay_endpoint.addWidget(self.endpoint_metric_combobox)
+        hlay_endpoint.addWidget(self.endpoint_threshold_spinbox)
+        vlay_queue.addLayout(hlay_endpoint)
+        vlay_queue.addWidget(self.endpoint_beam_combobox)
+        vlay_queue.addWidget(self.endpoint_label)
+        vlay_queue.addWidget(self.remove_pattern_button)
+        vlay_queue.addWidget(self.clear_queue_button)
+        hlay_queue.addWidget(self.queue_table)
+        hlay_queue.addLayout(vlay_queue)
+        vlay.addLayout(hlay_queue)
+        vlay.addWidget(self.progress_bar)
+        vlay.addWidget(self.progress_label)
+
         self.setCentralWidget(widget)
         self.rect = Rectangle((0, 0), 0.2, 0.2, color='yellow', fill=None, alpha=1)
         self.wp.canvas.ax11.add_patch(self.rect)
@@ -185,27 +687,242 @@ class _MainWindow(QMainWindow):
         self.button_move_to_fluorescence.clicked.connect(
             lambda: self.parent().move_to_light_microscope())
 
-        self.pattern_creation_button.clicked.connect(self.add_milling_pattern)
-        self.pattern_start_button.clicked.connect(self.start_patterning)
-        self.pattern_pause_button.clicked.connect(self.pause_patterning)
-        self.pattern_stop_button.clicked.connect(self.stop_patterning)
+        # lambdas, so the traced methods aren't passed the checked state
+        self.pattern_creation_button.clicked.connect(
+            lambda: self.add_milling_pattern())
+        self.pattern_start_button.clicked.connect(
+            lambda: self.start_patterning())
+        self.pattern_pause_button.clicked.connect(
+            lambda: self.pause_patterning())
+        self.pattern_stop_button.clicked.connect(
+            lambda: self.stop_patterning())
+        self.remove_pattern_button.clicked.connect(self.remove_milling_pattern)
+        self.clear_queue_button.clicked.connect(self.clear_milling_queue)
+        self.queue_table.itemChanged.connect(self.queue_item_changed)
+        self.depth_spinbox.valueChanged.connect(self.update_estimate)
+        self.current_spinbox.valueChanged.connect(self.update_estimate)
+        self.material_combobox.currentIndexChanged.connect(self.update_queue)
+        self.template_combobox.currentIndexChanged.connect(
+            self.update_template_preview)
+        for spinbox in [self.template_width_spinbox,
+                        self.template_thickness_spinbox,
+                        self.template_trench_spinbox,
+                        self.template_passes_spinbox,
+                        self.template_step_spinbox,
+                        self.template_cut_spinbox]:
+            spinbox.valueChanged.connect(self.update_template_preview)
+        self.driftMeasured.connect(self.drift_measured)
+        self.endpointMeasured.connect(self.endpoint_measured)
 
     def menu_quit(self):
         self.close()
 
+    def closeEvent(self, event):
+        self.stop_poller()
+        self.stop_drift_tracking()
+        self.stop_endpoint_monitor()
+        self.release_milling_lease()
+        super().closeEvent(event)
+
+    def read_beam_current(self):
+        """Ion beam current in amps, used for patterns without their own."""
+        try:
+            return float(self.parent().microscope.beams.ion_beam.beam_current.value)
+        except Exception as e:
+            logger.warning("Could not read the ion beam current: %s", e)
+            return None
+
+    def estimate_time(self, patterns):
+        """Estimated milling time of patterns as text, or '?' if unknown."""
+        try:
+            seconds = estimate_queue_time(
+                patterns, current=self.beam_current,
+                material=self.material_combobox.currentText())
+        except ValueError:
+            return '?'
+        return format_duration(seconds)
+
+    def drawn_pattern(self):
+        """Milling pattern of the rectangle currently drawn, or None."""
+        if None in (self.xclick, self.yclick, self.x1, self.y1):
+            return None
+        return pattern_from_pixels(
+            self.adorned_ion_image, self.xclick, self.x1, self.yclick,
+            self.y1, depth=self.depth_spinbox.value() * 1e-6,
+            current=self.selected_current())
+
+    def template_parameters(self, template):
+        """Keyword arguments of a pattern template, from the window settings."""
+        parameters = {
+            'width': self.template_width_spinbox.value() * 1e-6,
+            'thickness': self.template_thickness_spinbox.value() * 1e-6,
+            'depth': self.depth_spinbox.value() * 1e-6,
+            'current': self.selected_current(),
+        }
+        if template in ('lamella', 'polishing'):
+            parameters['polishing_passes'] = self.template_passes_spinbox.value()
+            parameters['polishing_step'] = self.template_step_spinbox.value() * 1e-6
+        if template == 'lamella':
+            parameters['trench_height'] = self.template_trench_spinbox.value() * 1e-6
+        if template == 'undercut':
+            parameters['line_width'] = self.template_cut_spinbox.value() * 1e-6
+        return parameters
+
+    def drawn_patterns(self, name=None):
+        """Milling patterns of the drawn rectangle, or of the template
+        centred on the clicked point. Empty if nothing was drawn.
+        """
+        template = self.template_combobox.currentData()
+        if template is None:
+            pattern = self.drawn_pattern()
+            if pattern is None:
+                return []
+            if name is not None:
+                pattern.name = name
+            return [pattern]
+        if None in (self.xclick, self.yclick):
+            return []
+        parameters = self.template_parameters(template)
+        if name is not None:
+            parameters['name'] = name
+        return template_patterns(template, self.adorned_ion_image,
+                                 self.xclick, self.yclick, **parameters)
+
+    def update_estimate(self):
+        """Show the estimated milling time of the drawn patterns."""
+        try:
+            patterns = self.drawn_patterns()
+        except Exception:
+            patterns = []  # e.g. the image has no pixel size metadata
+        if not patterns:
+            self.estimate_label.setText("Estimated time: -")
+        else:
+            self.estimate_label.setText(
+                "Estimated time: {}".format(self.estimate_time(patterns)))
+
+    def update_template_preview(self):
+        """Outline the template patterns around the clicked point."""
+        for patch in self._template_patches:
+            patch.remove()
+        self._template_patches = []
+        try:
+            patterns = []
+            if self.template_combobox.currentData() is not None:
+                patterns = self.drawn_patterns()
+        except Exception:
+            patterns = []
+        if patterns:
+            self.rect.set_visible(False)
+        ax = self.wp.canvas.ax11
+        for pattern in patterns:
+            x, y, width, height = pattern_to_pixels(pattern, self.adorned_ion_image)
+            rectangle = Rectangle((x, y), width, height, color='yellow', fill=None)
+            ax.add_patch(rectangle)
+            self._template_patches.append(rectangle)
+        self.update_estimate()
+        self.wp.canvas.draw()
+
+    def selected_current(self):
+        """Ion beam current in amps chosen for new patterns, or None."""
+        current = self.current_spinbox.value()
+        return current * 1e-9 if current > 0 else None
+
+    @tracing.traced('milling')
     def add_milling_pattern(self):
+        """Add the rectangle drawn on the image, or the template patterns
+        around the clicked point, to the milling queue.
+
+        Template patterns share one beam current, so they are created on
+        the microscope together in a single batch.
+        """
+        self._pattern_count += 1
+        if self.template_combobox.currentData() is None:
+            name = 'Pattern {}'.format(self._pattern_count)
+        else:
+            name = '{} {}'.format(self.template_combobox.currentText(),
+                                  self._pattern_count)
         try:
-            fibsem.create_rectangular_pattern(
-                self.parent().microscope, self.adorned_ion_image,
-                self.xclick, self.x1, self.yclick, self.y1, depth=1e-6)
-            print('Added milling pattern to the FIBSEM microscope.')
+            patterns = self.drawn_patterns(name=name)
         except Exception:
+            self._pattern_count -= 1
             display_error_message(traceback.format_exc())
-
+            return
+        if not patterns:
+            self._pattern_count -= 1
+            display_error_message("Please draw a milling pattern on the image first.")
+            return
+        self.queue.extend(patterns)
+        self.update_template_preview()
+        self.update_queue()
+
+    def remove_milling_pattern(self):
+        rows = sorted({index.row() for index in self.queue_table.selectedIndexes()},
+                      reverse=True)
+        for row in rows:
+            self.queue.pop(row)
+        self.update_queue()
+
+    def clear_milling_queue(self):
+        self.queue = []
+        self.update_queue()
+
+    def update_queue(self):
+        """Show the milling queue in the table and on the image."""
+        self.queue_table.blockSignals(True)
+        self.queue_table.setRowCount(len(self.queue))
+        for row, pattern in enumerate(self.queue):
+            current = '' if pattern.current is None else '%.3f' % (pattern.current * 1e9)
+            values = [pattern.name, '%.2f' % (pattern.width * 1e6),
+                      '%.2f' % (pattern.height * 1e6),
+                      '%.2f' % (pattern.depth * 1e6), current,
+                      self.estimate_time([pattern])]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column not in (3, 4):
+                    item.setFlags(item.flags() & ~Qt.ItemIsEditable)
+                self.queue_table.setItem(row, column, item)
+        self.queue_table.resizeColumnsToContents()
+        self.queue_table.blockSignals(False)
+        if self.queue:
+            self.progress_label.setText("{} patterns queued, estimated time {}".format(
+                len(self.queue), self.estimate_time(self.queue)))
+
+        for patch in self._queue_patches:
+            patch.remove()
+        self._queue_patches = []
+        ax = self.wp.canvas.ax11
+        for pattern in self.queue:
+            x, y, width, height = pattern_to_pixels(pattern, self.adorned_ion_image)
+            rectangle = Rectangle((x, y), width, height, color='cyan', fill=None)
+            ax.add_patch(rectangle)
+            self._queue_patches.append(rectangle)
+            self._queue_patches.append(ax.text(x, y, pattern.name, color='cyan'))
+        self.wp.canvas.draw()
+
+    def queue_item_changed(self, item):
+        """Update the depth or current of a queued pattern edited in the table."""
+        pattern = self.queue[item.row()]
+        text = item.text().strip()
+        try:
+            if item.column() == 3:
+                pattern.depth = float(text) * 1e-6
+            elif item.column() == 4:
+                pattern.current = float(text) * 1e-9 if text else None
+        except ValueError:
+            display_error_message("Please enter a number, not '{}'".format(text))
+        self.update_queue()
+
+    @tracing.traced('milling')
     def start_patterning(self):
-        from autoscript_core.common import ApplicationServerException
+        """Send the milling queue to the microscope and start milling.
+
+        The queue is sent as one batch of patterns for each ion beam current,
+        and batches are milled one after another. If the queue is empty,
+        patterns already on the microscope are milled.
+        """
         try:
-            state = self.parent().microscope.patterning.state
+            microscope = self.parent().microscope
+            state = microscope.patterning.state
             if state != "Idle":
                 logger.warning(
                     "Can't start milling pattern! "
@@ -213,17 +930,236 @@ class _MainWindow(QMainWindow):
                     "microscope.patterning.state = {}".format(state)
                     )
                 return
+            self.release_milling_lease()  # from milling that has finished
+            self.patterning_control().reset()
+            self._milling_lease = resources.resource_manager().lease(
+                resources.ION_BEAM, resources.SAMPLE_STAGE, owner="Milling",
+                blocking=False)
+            if self.queue:
+                self._stages = group_by_current(self.queue)
+                self.start_next_batch()
             else:
-                self.parent().microscope.patterning.start()
-                print('Started milling pattern.')
+                self._stages = []
+                self._stage_estimate = None
+                self._created = []
+                microscope.patterning.start()
+                self.start_poller()
+            if self.drift_checkbox.isChecked():
+                self.start_drift_tracking()
+            if self.endpoint_checkbox.isChecked() and self.queue:
+                self.start_endpoint_monitor()
+            print('Started milling pattern.')
+        except resources.ResourceBusyError as e:
+            display_error_message(str(e))
         except Exception:
+            self.release_milling_lease()
             display_error_message(traceback.format_exc())
 
+    @tracing.traced('milling')
+    def start_next_batch(self):
+        if self.patterning_control().pause_requested:
+            # paused between batches, by the user or at the milling endpoint
+            self._stages = []
+            self.finish_patterning(
+                "Patterning paused, queued batches cancelled")
+            return
+        current, patterns = self._stages.pop(0)
+        microscope = self.parent().microscope
+        if current is not None:
+            microscope.beams.ion_beam.beam_current.value = current
+        created = create_patterns(microscope, patterns)
+        self._created = created
+        self._stage_estimate = _patterns_time(created)
+        if self._stage_estimate is None:
+            try:
+                self._stage_estimate = estimate_queue_time(
+                    patterns, current=self.beam_current,
+                    material=self.material_combobox.currentText())
+            except ValueError:
+                pass
+        microscope.patterning.start()
+        self.start_poller()
+
+    def release_milling_lease(self):
+        if self._milling_lease is not None:
+            self._milling_lease.release()
+            self._milling_lease = None
+
+    def patterning_control(self):
+        """Pauses and resumes milling for the Pause button and monitors."""
+        if self._patterning_control is None:
+            self._patterning_control = monitoring.PatterningControl(
+                self.parent().microscope)
+        return self._patterning_control
+
+    def start_poller(self):
+        self.stop_poller()
+        self.progress_bar.setValue(0)
+        self.progress_label.setText("Starting patterning")
+        self._poller = _PatterningPoller(
+            self.parent().microscope, interval=PATTERNING_POLL_INTERVAL,
+            start_timeout=PATTERNING_START_TIMEOUT, parent=self)
+        self._poller.polled.connect(self.patterning_polled)
+        self._poller.start()
+
+    def stop_poller(self):
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller.wait()
+            self._poller = None
+
+    def patterning_polled(self, state, running_time):
+        """Show milling progress, and start the next batch when one finishes."""
+        if self.sender() is not self._poller:
+            return  # queued from a poller that has since been stopped
+        control = self.patterning_control()
+        if state == "Running" and control.pause_requested:
+            control.pause()  # requested while the batch was starting
+        if state == "Idle":
+            self.stop_poller()
+            if self._stages and control.pause_requested:
+                # paused between batches, e.g. at the milling endpoint
+                self._stages = []
+                self.finish_patterning(
+                    "Patterning paused, queued batches cancelled")
+            elif self._stages:
+                try:
+                    self.start_next_batch()
+                except Exception:
+                    self._stages = []
+                    self.release_milling_lease()
+                    display_error_message(traceback.format_exc())
+            else:
+                self.finish_patterning("Patterning idle")
+            return
+        text = "{}: {} elapsed".format(state, format_duration(running_time))
+        if self._stage_estimate:
+            fraction = min(running_time / self._stage_estimate, 1)
+            self.progress_bar.setValue(int(fraction * self.progress_bar.maximum()))
+            text += ", about {} remaining".format(
+                format_duration(max(self._stage_estimate - running_time, 0)))
+        if self._stages:
+            queued = [pattern for _, patterns in self._stages for pattern in patterns]
+            text += " in this batch, {} more batches queued ({})".format(
+                len(self._stages), self.estimate_time(queued))
+        self.progress_label.setText(text)
+
+    def finish_patterning(self, text):
+        """Stop monitoring and release the ion beam once milling has ended."""
+        tracing.event('patterning_finished', 'milling')
+        self.stop_drift_tracking()
+        self.stop_endpoint_monitor()
+        self.release_milling_lease()
+        self.progress_bar.setValue(self.progress_bar.maximum())
+        self.progress_label.setText(text)
+
+    def start_drift_tracking(self):
+        """Measure drift from periodic reduced resolution ion beam images."""
+        self.stop_drift_tracking()
+        self._drift_tracker = monitoring.DriftTracker(
+            compensation=self.drift_combobox.currentData())
+        acquire = monitoring.ion_image_acquisition(
+            self.parent().microscope, control=self.patterning_control())
+        tracker = self._drift_tracker
+
+        def process(image):
+            self.driftMeasured.emit(tracker.update(image))
+
+        self._drift_acquisition = monitoring.PeriodicAcquisition(
+            acquire, process, interval=monitoring.DRIFT_INTERVAL)
+        self._drift_acquisition.start()
+
+    def stop_drift_tracking(self):
+        if self._drift_acquisition is None:
+            return
+        self._drift_acquisition.stop()
+        self._drift_acquisition = None
+        tracker = self._drift_tracker
+        directory = getattr(self.parent(), 'save_destination_FIBSEM', None)
+        if tracker.history and directory and os.path.isdir(directory):
+            filename = os.path.join(directory, 'drift_' + timestamp() + '.csv')
+            tracker.save_history(filename)
+            print('Saved: {}'.format(filename))
+
+    def drift_measured(self, measurement):
+        """Show the measured drift, and compensate for it if selected."""
+        if measurement is None or self._drift_tracker is None:
+            return  # reference image, or tracking has stopped
+        if measurement['drift_x'] is None:
+            self.drift_label.setText("Drift: {:.1f}, {:.1f} pixels".format(
+                measurement['drift_columns'], measurement['drift_rows']))
+            return
+        self.drift_label.setText("Drift: {:.0f} nm, {:.0f} nm".format(
+            measurement['drift_x'] * 1e9, measurement['drift_y'] * 1e9))
+        x, y = monitoring.pixels_to_metres(
+            measurement['correction_rows'], measurement['correction_columns'],
+            self._drift_tracker.pixel_size)
+        if x == 0 and y == 0:
+            return
+        try:
+            if self._drift_tracker.compensation == 'patterns':
+                monitoring.shift_patterns(self.queue + list(self._created), x, y)
+                self.update_queue()
+            elif self._drift_tracker.compensation == 'beam':
+                monitoring.shift_beam(self.parent().microscope, x, y)
+        except Exception:
+            display_error_message(traceback.format_exc())
+
+    def start_endpoint_monitor(self):
+        """Pause milling once the milled regions have changed enough.
+
+        Low resolution images are taken every `monitoring.ENDPOINT_INTERVAL`
+        seconds, and patterning is paused from the monitoring thread as
+        soon as the threshold is reached.
+        """
+        self.stop_endpoint_monitor()
+        microscope = self.parent().microscope
+        control = self.patterning_control()
+        monitor = monitoring.EndpointMonitor(
+            self.queue, self.endpoint_threshold_spinbox.value() / 100,
+            metric=self.endpoint_metric_combobox.currentData(),
+            pause=control.pause)
+        if self.endpoint_beam_combobox.currentData() == 'ion':
+            acquire = monitoring.ion_image_acquisition(microscope,
+                                                       control=control)
+        else:
+            acquire = monitoring.electron_image_acquisition(microscope)
+
+        def process(image):
+            self.endpointMeasured.emit(monitor.update(image))
+
+        self._endpoint_acquisition = monitoring.PeriodicAcquisition(
+            acquire, process, interval=monitoring.ENDPOINT_INTERVAL)
+        self._endpoint_acquisition.start()
+
+    def stop_endpoint_monitor(self):
+        if self._endpoint_acquisition is not None:
+            self._endpoint_acquisition.stop()
+            self._endpoint_acquisition = None
+
+    def endpoint_measured(self, measurement):
+        if measurement is None or self._endpoint_acquisition is None:
+            return  # baseline image, or monitoring has stopped
+        text = "Endpoint metric: {:.1f} %".format(measurement['value'] * 100)
+        if measurement['triggered']:
+            tracing.event('milling_endpoint', 'milling',
+                          value=measurement['value'])
+            self._stages = []  # don't continue with the next batch
+            self.stop_endpoint_monitor()
+            text = "Milling endpoint reached, patterning paused. " + text
+        self.endpoint_label.setText(text)
+
+    @tracing.traced('milling')
     def pause_patterning(self):
         from autoscript_core.common import ApplicationServerException
         try:
             state = self.parent().microscope.patterning.state
-            if state != "Running":
+            control = self.patterning_control()
+            # "Paused" while a monitoring image is taken, and "Idle" between
+            # batches of the queue
+            milling = (state in ("Running", "Paused")
+                       or self._poller is not None)
+            if not milling or control.pause_requested:
                 logger.warning(
                     "Can't pause milling pattern! "
                     "Patterning state is not currently running.\n"
@@ -231,7 +1167,7 @@ class _MainWindow(QMainWindow):
                     )
                 return
             else:
-                self.parent().microscope.patterning.pause()
+                control.pause()
                 print('Paused milling pattern.')
         except Exception:
             display_error_message(
@@ -239,6 +1175,7 @@ class _MainWindow(QMainWindow):
                 traceback.format_exc()
                 )
 
+    @tracing.traced('milling')
     def stop_patterning(self):
         from autoscript_core.common import ApplicationServerException
         try:
@@ -251,7 +1188,11 @@ class _MainWindow(QMainWindow):
                     )
                 return
             else:
+                self._stages = []  # don't continue with the next batch
+                self.stop_drift_tracking()
+                self.stop_endpoint_monitor()
                 self.parent().microscope.patterning.stop()
+                self.release_milling_lease()
                 print('Stopped milling pattern.')
         except Exception:
             display_error_message(
@@ -271,6 +1212,8 @@ class _MainWindow(QMainWindow):
                 self.on_press = True
 
     def on_motion(self, event):
+        if self.template_combobox.currentData() is not None:
+            return  # templates are placed with a single click
         if event.button == 1 or event.button == 3 and self.on_press:
             if (self.xclick is not None and self.yclick is not None):
                 x0, y0 = self.xclick, self.yclick
@@ -282,14 +1225,18 @@ class _MainWindow(QMainWindow):
                     self.rect.set_height(self.y1 - y0)
                     self.rect.set_xy((x0, y0))
                     self.rect.set_visible(True)
-                    logger.debug("x0 %s", str(x0))
-                    logger.debug("y0 %s", str(y0))
-                    logger.debug("x1 %s", str(self.x1))
-                    logger.debug("y1 %s", str(self.y1))
+                    logger.debug("Pattern from (%s, %s) to (%s, %s)",
+                                 x0, y0, self.x1, self.y1)
+                    self.update_estimate()
                     self.wp.canvas.draw()
 
     def on_release(self, event):
-        if event.button == 1 and self.dragged:
+        if event.button == 1 and self.template_combobox.currentData() is not None:
+            if self.xclick is not None:
+                self.x0_label2.setText("%.1f" % self.xclick)
+                self.y0_label2.setText("%.1f" % self.yclick)
+                self.update_template_preview()
+        elif event.button == 1 and self.dragged:
             logger.debug(self.dragged)
             try:
                 self.x1_label2.setText("%.1f" % self.x1)
@@ -300,6 +1247,67 @@ class _MainWindow(QMainWindow):
             self.y1_label2.setText("%.1f" % self.y1)
 
 
+def _micrometre_spinbox(value):
+    spinbox = QDoubleSpinBox()
+    spinbox.setDecimals(2)
+    spinbox.setRange(0.01, 1000)
+    spinbox.setSingleStep(0.1)
+    spinbox.setValue(value)
+    return spinbox
+
+
+def _patterns_time(patterns):
+    """Total time in seconds the microscope estimates for its patterns."""
+    try:
+        return sum(float(pattern.time) for pattern in patterns)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class _PatterningPoller(QThread):
+    """Reads the patterning state in the background while milling.
+
+    Emits `polled` with the state and the seconds spent running so far,
+    excluding any time paused. The state is "Starting" while the patterning
+    is still idle after being started, until it has been seen running or
+    paused, or for at most `start_timeout` seconds.
+    """
+    polled = pyqtSignal(str, float)
+
+    def __init__(self, microscope, interval=PATTERNING_POLL_INTERVAL,
+                 start_timeout=PATTERNING_START_TIMEOUT, parent=None):
+        super().__init__(parent)
+        self.microscope = microscope
+        self.interval = interval
+        self.start_timeout = start_timeout
+        self._stop_event = threading.Event()
+
+    def run(self):
+        running_time = 0.
+        started = False
+        last_poll = start = time.time()
+        while not self._stop_event.is_set():
+            try:
+                state = str(self.microscope.patterning.state)
+            except Exception as e:
+                logger.warning("Could not read the patterning state: %s", e)
+                state = "Unknown"
+            now = time.time()
+            if state in ("Running", "Paused"):
+                started = True
+            elif (state == "Idle" and not started
+                    and now - start < self.start_timeout):
+                state = "Starting"
+            if state == "Running":
+                running_time += now - last_poll
+            last_poll = now
+            self.polled.emit(state, running_time)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+
 class _WidgetPlot(QWidget):
     def __init__(self, *args, **kwargs):
         QWidget.__init__(self, *args, **kwargs)
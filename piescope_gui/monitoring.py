@@ -0,0 +1,533 @@
+"""Image based monitoring of long milling jobs.
+
+Reduced resolution images are acquired periodically in a background
+thread and compared with a reference image, to measure sample drift
+or to detect the milling endpoint.
+
+Nothing in this module imports Qt. Results are passed to a callback,
+which GUI code can connect to a Qt signal.
+"""
+import contextlib
+import csv
+import logging
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# How drift can be compensated: by moving the queued milling patterns
+# with the sample, or by shifting the ion beam back onto it.
+COMPENSATION_MODES = (None, 'patterns', 'beam')
+# Seconds between drift tracking images.
+DRIFT_INTERVAL = 60.
+# Resolution of the images acquired for monitoring.
+MONITOR_RESOLUTION = '768x512'
+# Seconds between endpoint monitoring images.
+ENDPOINT_INTERVAL = 10.
+# Endpoint metrics, see `endpoint_metric`.
+ENDPOINT_METRICS = ('brightness', 'change')
+# Pattern footprints are subsampled to at most this many pixels per side
+# before computing endpoint metrics.
+ENDPOINT_MAX_SIZE = 128
+
+
+def phase_correlation(reference, image):
+    """Measure the translation between two images by FFT phase correlation.
+
+    A Hann window suppresses the image edges, and the correlation peak is
+    located to subpixel precision with a parabolic fit on each axis.
+
+    Parameters
+    ----------
+    reference : ndarray
+        2D reference image.
+    image : ndarray
+        2D image with the same shape as the reference.
+
+    Returns
+    -------
+    (shift_rows, shift_columns, peak)
+        How far the image content has moved relative to the reference,
+        in pixels, and the height of the normalised correlation peak
+        (close to 1 for a clean match, close to 0 for no match).
+    """
+    reference = np.asarray(reference, dtype=float)
+    image = np.asarray(image, dtype=float)
+    if reference.shape != image.shape:
+        raise ValueError("Images must have the same shape, got {} and {}".format(
+            reference.shape, image.shape))
+    window = np.outer(np.hanning(image.shape[0]), np.hanning(image.shape[1]))
+    reference_fft = np.fft.rfft2((reference - reference.mean()) * window)
+    image_fft = np.fft.rfft2((image - image.mean()) * window)
+    cross_power = image_fft * np.conj(reference_fft)
+    cross_power /= np.abs(cross_power) + np.finfo(float).eps
+    correlation = np.fft.irfft2(cross_power, s=image.shape)
+
+    peak_row, peak_column = np.unravel_index(np.argmax(correlation),
+                                             correlation.shape)
+    rows, columns = correlation.shape
+    shift_rows = peak_row + _wrapped_parabolic_offset(
+        correlation[[peak_row - 1, peak_row, (peak_row + 1) % rows], peak_column])
+    shift_columns = peak_column + _wrapped_parabolic_offset(
+        correlation[peak_row, [peak_column - 1, peak_column,
+                               (peak_column + 1) % columns]])
+    # shifts past half the image wrap around to negative shifts
+    if shift_rows > rows / 2:
+        shift_rows -= rows
+    if shift_columns > columns / 2:
+        shift_columns -= columns
+    return float(shift_rows), float(shift_columns), float(correlation.max())
+
+
+def _wrapped_parabolic_offset(values):
+    denominator = values[0] - 2 * values[1] + values[2]
+    if denominator == 0:
+        return 0.
+    return float(np.clip(0.5 * (values[0] - values[2]) / denominator, -0.5, 0.5))
+
+
+def image_data(image):
+    """Array and pixel size (metres, or None) of an Adorned Image or array."""
+    try:
+        pixel_size = image.metadata.binary_result.pixel_size.x
+    except AttributeError:
+        pixel_size = None
+    return np.asarray(getattr(image, 'data', image)), pixel_size
+
+
+class DriftTracker:
+    """Measure sample drift from a series of images against a reference.
+
+    Parameters
+    ----------
+    reference : Adorned Image or ndarray, optional
+        Reference image. By default, the first image passed to `update`.
+    pixel_size : float, optional
+        Pixel size in metres. By default, read from the image metadata.
+    compensation : str, optional
+        One of `COMPENSATION_MODES`, by default None.
+        With 'beam', images are expected to be taken after the beam has
+        been shifted by the previous corrections, so measured shifts are
+        the drift left over. Otherwise measured shifts are the total drift.
+    minimum_shift : float, optional
+        Corrections smaller than this many pixels are not applied,
+        by default 0.5.
+    minimum_peak : float, optional
+        Measurements with a weaker correlation peak are logged but not
+        used for corrections, by default 0.05.
+    """
+    def __init__(self, reference=None, pixel_size=None, compensation=None,
+                 minimum_shift=0.5, minimum_peak=0.05):
+        if compensation not in COMPENSATION_MODES:
+            raise ValueError("Unknown compensation '{}', expected one of {}".format(
+                compensation, COMPENSATION_MODES))
+        self.reference = None
+        self.pixel_size = pixel_size
+        self.compensation = compensation
+        self.minimum_shift = minimum_shift
+        self.minimum_peak = minimum_peak
+        self.applied = np.zeros(2)  # rows, columns of correction so far
+        self.history = []
+        if reference is not None:
+            self.set_reference(reference)
+
+    def set_reference(self, image):
+        self.reference, pixel_size = image_data(image)
+        if self.pixel_size is None:
+            self.pixel_size = pixel_size
+        self.applied = np.zeros(2)
+
+    def update(self, image, timestamp=None):
+        """Measure the drift in a new image.
+
+        Returns
+        -------
+        dict or None
+            The measurement added to `history`, with the time, the total
+            drift in pixels ('drift_rows', 'drift_columns') and in metres
+            in patterning coordinates with y up ('drift_x', 'drift_y'),
+            the correlation 'peak', and the correction to apply now in
+            pixels ('correction_rows', 'correction_columns').
+            None if the image became the reference.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        if self.reference is None:
+            self.set_reference(image)
+            return None
+        data, _ = image_data(image)
+        shift_rows, shift_columns, peak = phase_correlation(self.reference, data)
+        measured = np.array([shift_rows, shift_columns])
+        if self.compensation == 'beam':
+            drift = self.applied + measured
+        else:
+            drift = measured
+        correction = np.zeros(2)
+        if (self.compensation is not None and peak >= self.minimum_peak
+                and np.hypot(*(drift - self.applied)) >= self.minimum_shift):
+            correction = drift - self.applied
+            self.applied = drift.copy()
+        drift_x, drift_y = pixels_to_metres(drift[0], drift[1], self.pixel_size)
+        measurement = {
+            'time': timestamp,
+            'drift_rows': float(drift[0]),
+            'drift_columns': float(drift[1]),
+            'drift_x': drift_x,
+            'drift_y': drift_y,
+            'peak': peak,
+            'correction_rows': float(correction[0]),
+            'correction_columns': float(correction[1]),
+        }
+        self.history.append(measurement)
+        logger.info("Drift %.2f, %.2f pixels (peak %.2f)",
+                    drift[1], drift[0], peak)
+        return measurement
+
+    def save_history(self, filename):
+        """Save the drift time series as a CSV file."""
+        fields = ['time', 'drift_rows', 'drift_columns', 'drift_x', 'drift_y',
+                  'peak', 'correction_rows', 'correction_columns']
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(self.history)
+        return filename
+
+
+def pixels_to_metres(rows, columns, pixel_size):
+    """Convert an image shift in pixels to patterning coordinates (y up).
+
+    Returns
+    -------
+    (x, y)
+        Shift in metres, or (None, None) if the pixel size is unknown.
+    """
+    if pixel_size is None:
+        return None, None
+    return float(columns * pixel_size), float(-rows * pixel_size)
+
+
+def shift_patterns(patterns, x, y):
+    """Move milling patterns by (x, y) metres in patterning coordinates.
+
+    Works for `piescope_gui.milling.MillingPattern` objects as well as
+    patterns already created on the microscope.
+    """
+    for pattern in patterns:
+        pattern.center_x += x
+        pattern.center_y += y
+
+
+def shift_beam(microscope, x, y):
+    """Add (x, y) metres to the ion beam shift, to follow a drifting sample."""
+    from autoscript_sdb_microscope_client.structures import Point
+    beam_shift = microscope.beams.ion_beam.beam_shift
+    current = beam_shift.value
+    beam_shift.value = Point(current.x + x, current.y + y)
+
+
+def footprint(pattern, image_shape, pixel_size):
+    """Image region covered by a milling pattern.
+
+    Parameters
+    ----------
+    pattern : MillingPattern
+        Pattern with centre and size in metres, patterning coordinates.
+    image_shape : tuple
+        Shape (rows, columns) of the image.
+    pixel_size : float
+        Image pixel size in metres.
+
+    Returns
+    -------
+    tuple of slice
+        Row and column slices, clipped to the image and subsampled to at
+        most `ENDPOINT_MAX_SIZE` pixels per side.
+        Empty if the pattern lies outside the image.
+    """
+    rows, columns = image_shape[:2]
+    center_row = rows / 2 - pattern.center_y / pixel_size
+    center_column = columns / 2 + pattern.center_x / pixel_size
+    half_height = pattern.height / pixel_size / 2
+    half_width = pattern.width / pixel_size / 2
+    row0 = int(np.clip(np.floor(center_row - half_height), 0, rows))
+    row1 = int(np.clip(np.ceil(center_row + half_height), 0, rows))
+    column0 = int(np.clip(np.floor(center_column - half_width), 0, columns))
+    column1 = int(np.clip(np.ceil(center_column + half_width), 0, columns))
+    row_step = max(-(-(row1 - row0) // ENDPOINT_MAX_SIZE), 1)
+    column_step = max(-(-(column1 - column0) // ENDPOINT_MAX_SIZE), 1)
+    return slice(row0, row1, row_step), slice(column0, column1, column_step)
+
+
+def endpoint_metric(region, baseline, metric='brightness'):
+    """Cheap measure of how much a milled region has changed.
+
+    Parameters
+    ----------
+    region : ndarray
+        Pattern footprint in the latest image.
+    baseline : ndarray
+        The same footprint in the first image.
+    metric : str, optional
+        'brightness': relative change of the mean intensity, negative for
+        darker. 'change': mean absolute intensity difference relative to
+        the baseline mean intensity. By default 'brightness'.
+
+    Returns
+    -------
+    float
+    """
+    region = np.asarray(region, dtype=np.float32)
+    baseline = np.asarray(baseline, dtype=np.float32)
+    reference = max(float(baseline.mean()), np.finfo(np.float32).eps)
+    if metric == 'brightness':
+        return float(region.mean()) / reference - 1
+    elif metric == 'change':
+        return float(np.abs(region - baseline).mean()) / reference
+    raise ValueError("Unknown endpoint metric '{}', expected one of {}".format(
+        metric, ENDPOINT_METRICS))
+
+
+class EndpointMonitor:
+    """Watch the milled regions and pause milling when they have changed enough.
+
+    Parameters
+    ----------
+    patterns : list of MillingPattern
+        Patterns being milled, in patterning coordinates.
+    threshold : float
+        Metric value that marks the endpoint. A negative threshold is
+        reached when the metric falls to it, a positive one when the
+        metric rises to it.
+    metric : str, optional
+        One of `ENDPOINT_METRICS`, by default 'brightness'.
+    pause : callable, optional
+        Called with no arguments when the endpoint is reached.
+    pixel_size : float, optional
+        Pixel size in metres. By default, read from the image metadata.
+    """
+    def __init__(self, patterns, threshold, metric='brightness', pause=None,
+                 pixel_size=None):
+        if metric not in ENDPOINT_METRICS:
+            raise ValueError("Unknown endpoint metric '{}', expected one of "
+                             "{}".format(metric, ENDPOINT_METRICS))
+        self.patterns = list(patterns)
+        self.threshold = threshold
+        self.metric = metric
+        self.pause = pause
+        self.pixel_size = pixel_size
+        self.baseline = None
+        self.triggered = False
+        self.history = []
+
+    def update(self, image, timestamp=None):
+        """Compute the endpoint metric for a new image.
+
+        The first image is kept as the baseline. The metric is computed
+        for each pattern footprint, and the value closest to the endpoint
+        is reported.
+
+        Returns
+        -------
+        dict or None
+            The measurement added to `history`, with the 'time', metric
+            'value' and whether the endpoint was 'triggered' by it.
+            None for the baseline image.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        data, pixel_size = image_data(image)
+        if self.pixel_size is None:
+            self.pixel_size = pixel_size
+        if self.pixel_size is None:
+            raise ValueError("The pixel size is needed to find the patterns "
+                             "in the image.")
+        if data.ndim == 3:
+            data = data[..., 0]
+        regions = [footprint(pattern, data.shape, self.pixel_size)
+                   for pattern in self.patterns]
+        regions = [region for region in regions if data[region].size > 0]
+        if self.baseline is None:
+            self.baseline = [data[region].copy() for region in regions]
+            self._regions = regions
+            return None
+        values = [endpoint_metric(data[region], baseline, self.metric)
+                  for region, baseline in zip(self._regions, self.baseline)]
+        sign = -1 if self.threshold < 0 else 1
+        value = max(values, key=lambda v: sign * v) if values else 0.
+        triggered = not self.triggered and sign * value >= sign * self.threshold
+        measurement = {'time': timestamp, 'value': value, 'triggered': triggered}
+        self.history.append(measurement)
+        if triggered:
+            self.triggered = True
+            logger.info("Milling endpoint reached, %s metric %.3f",
+                        self.metric, value)
+            if self.pause is not None:
+                self.pause()
+        return measurement
+
+
+class PatterningControl:
+    """Pauses and resumes milling for every monitor of one microscope.
+
+    Monitors taking ion beam images pause running milling for each image,
+    and resume it afterwards. They share this object's lock, so one monitor
+    never resumes milling while another is imaging, and milling paused on
+    request (by the user, or at the milling endpoint) stays paused.
+
+    Parameters
+    ----------
+    microscope : Autoscript microscope object.
+    """
+    def __init__(self, microscope):
+        self.microscope = microscope
+        self._lock = threading.RLock()
+        self._pause_requested = threading.Event()
+
+    @property
+    def pause_requested(self):
+        """Whether milling should stay paused after monitoring images."""
+        return self._pause_requested.is_set()
+
+    def pause(self):
+        """Pause milling, and keep it paused until `resume` or `reset`."""
+        self._pause_requested.set()
+        with self._lock:
+            if self.microscope.patterning.state == "Running":
+                self.microscope.patterning.pause()
+
+    def resume(self):
+        """Resume milling paused by `pause`."""
+        with self._lock:
+            self._pause_requested.clear()
+            if self.microscope.patterning.state == "Paused":
+                self.microscope.patterning.resume()
+
+    def reset(self):
+        """Forget pause requests, before milling is started again."""
+        self._pause_requested.clear()
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Pause running milling while in the context."""
+        with self._lock:
+            paused = (not self.pause_requested
+                      and self.microscope.patterning.state == "Running")
+            if paused:
+                self.microscope.patterning.pause()
+            try:
+                yield
+            finally:
+                if (paused and not self.pause_requested
+                        and self.microscope.patterning.state == "Paused"):
+                    self.microscope.patterning.resume()
+
+
+def electron_image_acquisition(microscope, resolution=MONITOR_RESOLUTION,
+                               dwell_time=1e-7):
+    """Make a function acquiring reduced resolution electron beam images.
+
+    Electron beam images can be taken while the ion beam mills, without
+    interrupting it. Pattern footprints are found assuming the electron
+    and ion beam images share their centre (the coincidence point), and
+    the stage tilt foreshortening of the electron beam view is ignored.
+
+    See `ion_image_acquisition` for the parameters.
+    """
+    import piescope.fibsem
+
+    settings = piescope.fibsem.update_camera_settings(dwell_time, resolution)
+
+    def acquire():
+        return piescope.fibsem.new_electron_image(microscope, settings)
+    return acquire
+
+
+def ion_image_acquisition(microscope, resolution=MONITOR_RESOLUTION,
+                          dwell_time=1e-7, control=None):
+    """Make a function acquiring reduced resolution ion beam images.
+
+    Ion beam imaging can't run at the same time as ion beam milling,
+    so a running pattern is paused for the acquisition and then resumed,
+    unless a pause was requested from `control` in the meantime.
+
+    Parameters
+    ----------
+    microscope : Autoscript microscope object.
+    resolution : str, optional
+        Image resolution, by default `MONITOR_RESOLUTION`.
+    dwell_time : float, optional
+        Dwell time in seconds, by default 1e-7.
+    control : PatterningControl, optional
+        Shared by every monitor of the microscope, by default a new one.
+
+    Returns
+    -------
+    callable
+        Function with no arguments returning an Adorned Image.
+    """
+    import piescope.fibsem
+
+    settings = piescope.fibsem.update_camera_settings(dwell_time, resolution)
+    if control is None:
+        control = PatterningControl(microscope)
+
+    def acquire():
+        with control.paused():
+            return piescope.fibsem.new_ion_image(microscope, settings)
+    return acquire
+
+
+class PeriodicAcquisition:
+    """Acquire and process images in a background thread at a fixed interval.
+
+    Parameters
+    ----------
+    acquire : callable
+        Function with no arguments returning an image.
+    process : callable
+        Function called with each image.
+    interval : float, optional
+        Seconds between acquisitions, by default `DRIFT_INTERVAL`.
+    immediately : bool, optional
+        Acquire the first image as soon as started, by default True.
+    """
+    def __init__(self, acquire, process, interval=DRIFT_INTERVAL,
+                 immediately=True):
+        self.acquire = acquire
+        self.process = process
+        self.interval = interval
+        self.immediately = immediately
+        self.errors = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=type(self).__name__)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        if not self.immediately and self._stop_event.wait(self.interval):
+            return
+        while not self._stop_event.is_set():
+            start = time.time()
+            try:
+                self.process(self.acquire())
+            except Exception:
+                self.errors += 1
+                logger.exception("Periodic image acquisition failed")
+            self._stop_event.wait(max(self.interval - (time.time() - start), 0))
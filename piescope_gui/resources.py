@@ -0,0 +1,260 @@
+"""Leases on the shared microscope hardware.
+
+Operations lease the hardware they use, e.g. a fluorescence image leases the
+camera and lasers, and an ion beam image leases the ion beam. Operations with
+no hardware in common run in parallel, like an electron beam image during
+fluorescence live imaging, and an operation that needs hardware already
+leased waits for it, or fails straight away with `ResourceBusyError` if it
+can't wait (e.g. in the GUI thread):
+
+    manager = resource_manager()
+    with manager.lease(CAMERA, LASERS, owner="Fluorescence image"):
+        ...
+
+Waiting leases are granted in the order they were requested. Leases are not
+reentrant: an operation holding a lease can't lease the same hardware again.
+"""
+import functools
+import threading
+import time
+
+__all__ = [
+    'CAMERA',
+    'LASERS',
+    'OBJECTIVE_STAGE',
+    'SAMPLE_STAGE',
+    'ELECTRON_BEAM',
+    'ION_BEAM',
+    'RESOURCES',
+    'ResourceBusyError',
+    'Lease',
+    'ResourceManager',
+    'resource_manager',
+    'leased',
+    ]
+
+CAMERA = 'camera'
+LASERS = 'lasers'
+OBJECTIVE_STAGE = 'objective stage'
+SAMPLE_STAGE = 'sample stage'
+ELECTRON_BEAM = 'electron beam'
+ION_BEAM = 'ion beam'
+RESOURCES = (CAMERA, LASERS, OBJECTIVE_STAGE, SAMPLE_STAGE, ELECTRON_BEAM,
+             ION_BEAM)
+
+CANCEL_POLL_INTERVAL = 0.1  # seconds
+
+_resource_manager = None
+
+
+class ResourceBusyError(RuntimeError):
+    """Hardware is leased by another operation."""
+
+
+class Lease:
+    """Hardware leased by one operation, released when the lease is closed.
+
+    Use as a context manager, or call `release`.
+    """
+    def __init__(self, manager, resources, owner):
+        self.manager = manager
+        self.resources = frozenset(resources)
+        self.owner = owner
+        self.released = False
+
+    def __repr__(self):
+        return "<Lease {} of {}>".format(self.owner, sorted(self.resources))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        """Release the leased hardware. Releasing again does nothing."""
+        self.manager._release(self)
+
+
+class _Request:
+    def __init__(self, resources):
+        self.resources = resources
+
+
+class ResourceManager:
+    """Issues leases on hardware resources, one operation at a time each.
+
+    Parameters
+    ----------
+    resources : iterable of str, optional
+        Names of the resources managed, by default RESOURCES.
+    """
+    def __init__(self, resources=RESOURCES):
+        self.resources = frozenset(resources)
+        self._condition = threading.Condition()
+        self._leases = {}  # resource: Lease
+        self._waiting = []  # _Request, oldest first
+        self._listeners = []
+
+    def _check(self, resources):
+        unknown = set(resources) - self.resources
+        if unknown:
+            raise ValueError("Unknown resources {}, expected some of {}"
+                             .format(sorted(unknown), sorted(self.resources)))
+        if not resources:
+            raise ValueError("No resources given to lease")
+
+    def _grantable(self, request):
+        if any(resource in self._leases for resource in request.resources):
+            return False
+        for earlier in self._waiting:
+            if earlier is request:
+                return True
+            if earlier.resources & request.resources:
+                return False  # first come, first served
+        return True
+
+    def lease(self, *resources, owner=None, blocking=True, timeout=None,
+              cancel=None):
+        """Lease resources, all of them at once.
+
+        Parameters
+        ----------
+        *resources : str
+        owner : str, optional
+            Name of the operation, shown to operations that have to wait.
+        blocking : bool, optional
+            Whether to wait for resources in use, by default True.
+        timeout : float, optional
+            Maximum seconds to wait, by default no limit.
+        cancel : threading.Event, optional
+            Stop waiting when this event is set.
+
+        Returns
+        -------
+        Lease
+
+        Raises
+        ------
+        ResourceBusyError
+            If the resources are in use and can't be waited for, or the
+            wait timed out or was cancelled.
+        """
+        self._check(resources)
+        request = _Request(frozenset(resources))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            self._waiting.append(request)
+            try:
+                while not self._grantable(request):
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                    if (not blocking or (remaining is not None and remaining <= 0)
+                            or (cancel is not None and cancel.is_set())):
+                        raise ResourceBusyError(self._busy_message(request, owner))
+                    if cancel is not None:
+                        remaining = min(remaining or CANCEL_POLL_INTERVAL,
+                                        CANCEL_POLL_INTERVAL)
+                    self._condition.wait(remaining)
+                granted = Lease(self, request.resources, owner)
+                for resource in request.resources:
+                    self._leases[resource] = granted
+                return granted
+            finally:
+                self._waiting.remove(request)
+                self._condition.notify_all()  # later requests may now be grantable
+
+    def _busy_message(self, request, owner):
+        holders = {}
+        for resource in sorted(request.resources):
+            held = self._leases.get(resource)
+            if held is not None:
+                holders.setdefault(held.owner or 'another operation', []).append(resource)
+        if not holders:
+            return "{} can't start: an earlier operation is waiting for {}".format(
+                owner or "This operation", ' and '.join(sorted(request.resources)))
+        return "{} can't start: {}".format(owner or "This operation", '; '.join(
+            'the {} {} in use by {}'.format(' and '.join(resources),
+                                            'are' if len(resources) > 1 else 'is',
+                                            holder)
+            for holder, resources in holders.items()))
+
+    def _release(self, lease):
+        with self._condition:
+            if lease.released:
+                return
+            lease.released = True
+            for resource in lease.resources:
+                if self._leases.get(resource) is lease:
+                    del self._leases[resource]
+            self._condition.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def available(self, *resources):
+        """Whether resources could be leased now, without waiting."""
+        self._check(resources)
+        with self._condition:
+            return self._grantable(_Request(frozenset(resources)))
+
+    def holders(self):
+        """Owner of each leased resource."""
+        with self._condition:
+            return {resource: lease.owner
+                    for resource, lease in self._leases.items()}
+
+    def add_listener(self, callback):
+        """Call `callback()` whenever resources are released.
+
+        Callbacks are called in the releasing thread.
+        """
+        with self._condition:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._condition:
+            self._listeners.remove(callback)
+
+
+def resource_manager():
+    """The application's `ResourceManager`, shared by every window."""
+    global _resource_manager
+    if _resource_manager is None:
+        _resource_manager = ResourceManager()
+    return _resource_manager
+
+
+def leased(*resources, owner=None, on_busy=None):
+    """Decorator leasing resources for every call of a function.
+
+    The lease is taken without waiting. If the resources are in use,
+    the function isn't called, `on_busy` is called with the error message
+    instead, and None is returned.
+
+    Parameters
+    ----------
+    *resources : str
+    owner : str, optional
+        By default, the function name.
+    on_busy : callable, optional
+        By default, `ResourceBusyError` is raised.
+    """
+    def decorator(function):
+        name = owner or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                lease = resource_manager().lease(*resources, owner=name,
+                                                 blocking=False)
+            except ResourceBusyError as e:
+                if on_busy is None:
+                    raise
+                on_busy(str(e))
+                return None
+            with lease:
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
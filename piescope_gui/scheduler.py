@@ -0,0 +1,327 @@
+"""Prioritised, cancellable jobs using the microscope hardware.
+
+Long operations are submitted to the `JobScheduler` as jobs, with the
+hardware they need (see `piescope_gui.resources`) and a priority. A job
+starts in its own thread as soon as its hardware is free. Higher priority
+jobs go first, and a queued job never overtakes a higher priority job that
+needs the same hardware. Each job function is called with its `Job`, to
+check `job.cancelled` and report progress. When the job finishes, its
+`on_done` callback is called with the result in the GUI thread, where it can
+update the display. Failed jobs are reported to the error panel.
+
+The `JobQueuePanel` shows queued, running and recent jobs, and cancels them.
+"""
+import itertools
+import logging
+import threading
+import time
+import traceback
+
+from PyQt5 import QtCore, QtWidgets
+
+from piescope_gui import errors, resources, tracing
+
+__all__ = [
+    'PRIORITY_HIGH',
+    'PRIORITY_NORMAL',
+    'PRIORITY_LOW',
+    'Job',
+    'JobScheduler',
+    'JobQueuePanel',
+    ]
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = -10
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+DEFAULT_WORKERS = 4
+
+_job_ids = itertools.count(1)
+
+
+class Job:
+    """An operation waiting for, or running on, the microscope hardware.
+
+    Parameters
+    ----------
+    name : str
+    function : callable
+        Called with this job in the job thread, returns the job result.
+    resources : tuple of str, optional
+        Hardware leased while the job runs.
+    priority : int, optional
+        Higher priority jobs start first, by default PRIORITY_NORMAL.
+    on_done : callable, optional
+        Called with the result in the GUI thread when the job succeeds.
+    """
+    def __init__(self, name, function, resources=(), priority=PRIORITY_NORMAL,
+                 on_done=None):
+        self.id = next(_job_ids)
+        self.name = name
+        self.function = function
+        self.resources = tuple(resources)
+        self.priority = priority
+        self.on_done = on_done
+        self.status = QUEUED
+        self.progress = None  # fraction done, None if unknown
+        self.message = ''
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+        self._scheduler = None
+
+    def __repr__(self):
+        return "<Job {} {!r} {}>".format(self.id, self.name, self.status)
+
+    @property
+    def cancelled(self):
+        """Whether the job has been asked to stop."""
+        return self._cancel.is_set()
+
+    @property
+    def cancel_event(self):
+        """`threading.Event` set when the job is cancelled."""
+        return self._cancel
+
+    @property
+    def ended(self):
+        """Whether the job is done, failed or cancelled."""
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def report_progress(self, fraction=None, message=''):
+        """Report progress from the job function, fraction between 0 and 1."""
+        self.progress = fraction
+        self.message = message
+        if self._scheduler is not None:
+            self._scheduler.jobChanged.emit(self)
+
+
+class JobScheduler(QtCore.QObject):
+    """Runs jobs by priority, as soon as the hardware they need is free.
+
+    Parameters
+    ----------
+    manager : ResourceManager, optional
+        By default, the application's `resource_manager()`.
+    max_workers : int, optional
+        Maximum number of jobs running at once, by default DEFAULT_WORKERS.
+    parent : QObject, optional
+    """
+    # Emitted with the job when it is queued, starts, reports progress or ends
+    jobChanged = QtCore.pyqtSignal(object)
+    _jobEnded = QtCore.pyqtSignal(object)
+
+    def __init__(self, manager=None, max_workers=DEFAULT_WORKERS, parent=None):
+        super().__init__(parent)
+        self.manager = manager if manager is not None else resources.resource_manager()
+        self.max_workers = max_workers
+        self._lock = threading.RLock()
+        self._queued = []
+        self._running = {}  # job: thread
+        self._jobEnded.connect(self._job_ended)
+        self.manager.add_listener(self.dispatch)
+
+    def submit(self, name, function, resources=(), priority=PRIORITY_NORMAL,
+               on_done=None):
+        """Queue a job, see `Job` for the parameters.
+
+        Returns
+        -------
+        Job
+        """
+        job = Job(name, function, resources=resources, priority=priority,
+                  on_done=on_done)
+        job._scheduler = self
+        with self._lock:
+            self._queued.append(job)
+        self.jobChanged.emit(job)
+        self.dispatch()
+        return job
+
+    def cancel(self, job):
+        """Remove a queued job, or ask a running job to stop."""
+        job._cancel.set()
+        with self._lock:
+            if job not in self._queued:
+                return  # running jobs stop when they next check
+            self._queued.remove(job)
+            job.status = CANCELLED
+            job.finished = time.time()
+        self.jobChanged.emit(job)
+        self.dispatch()
+
+    def jobs(self):
+        """Running jobs, then queued jobs in the order they will start."""
+        with self._lock:
+            return list(self._running) + self._ordered_queue()
+
+    def _ordered_queue(self):
+        return sorted(self._queued, key=lambda job: (-job.priority, job.id))
+
+    def dispatch(self):
+        """Start every queued job whose hardware is free."""
+        started = []
+        with self._lock:
+            reserved = set()  # needed by higher priority jobs still waiting
+            for job in self._ordered_queue():
+                if len(self._running) >= self.max_workers:
+                    break
+                needed = set(job.resources)
+                if needed & reserved:
+                    continue
+                lease = None
+                if needed:
+                    try:
+                        lease = self.manager.lease(*job.resources, owner=job.name,
+                                                   blocking=False)
+                    except resources.ResourceBusyError:
+                        reserved |= needed
+                        continue
+                self._queued.remove(job)
+                job.status = RUNNING
+                job.started = time.time()
+                thread = threading.Thread(target=self._run, args=(job, lease),
+                                          name='Job {}'.format(job.id),
+                                          daemon=True)
+                self._running[job] = thread
+                started.append(thread)
+        for thread in started:
+            thread.start()
+
+    def _run(self, job, lease):
+        self.jobChanged.emit(job)
+        status = FAILED
+        try:
+            with tracing.span(job.name, 'job', job=job.id, priority=job.priority):
+                job.result = job.function(job)
+        except Exception:
+            job.error = traceback.format_exc()
+        else:
+            status = CANCELLED if job.cancelled else DONE
+        finally:
+            with self._lock:
+                del self._running[job]
+                job.finished = time.time()
+                job.status = status
+            if lease is not None:
+                lease.release()  # dispatches the next jobs
+            else:
+                self.dispatch()
+            self._jobEnded.emit(job)
+
+    def _job_ended(self, job):
+        """Runs in the GUI thread."""
+        if job.status == DONE and job.on_done is not None:
+            try:
+                job.on_done(job.result)
+            except Exception:
+                job.error = traceback.format_exc()
+                job.status = FAILED
+        if job.status == FAILED:
+            errors.error_bus().report(job.error, job.name)
+        self.jobChanged.emit(job)
+
+    def wait(self, timeout=None):
+        """Wait for every job to finish. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                threads = list(self._running.values())
+                queued = bool(self._queued)
+            if not threads and not queued:
+                return True
+            for thread in threads:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                thread.join(remaining)
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            if queued and not threads:
+                time.sleep(0.01)  # waiting for hardware leased elsewhere
+
+    def shutdown(self):
+        """Cancel every job and stop listening for released hardware."""
+        for job in self.jobs():
+            self.cancel(job)
+        self.manager.remove_listener(self.dispatch)
+
+
+class JobQueuePanel(QtWidgets.QDockWidget):
+    """Queued, running and recently finished jobs, with a cancel button.
+
+    Parameters
+    ----------
+    scheduler : JobScheduler
+    parent : QWidget, optional
+    """
+    MAX_FINISHED = 20
+    COLUMNS = ("Job", "Priority", "Status", "Progress")
+
+    def __init__(self, scheduler, parent=None):
+        super().__init__("Jobs", parent)
+        self.setObjectName("JobQueuePanel")
+        self.scheduler = scheduler
+        self._items = {}  # job: QTreeWidgetItem
+
+        self.job_list = QtWidgets.QTreeWidget()
+        self.job_list.setHeaderLabels(self.COLUMNS)
+        self.job_list.setRootIsDecorated(False)
+        self.cancel_button = QtWidgets.QPushButton("Cancel")
+        self.clear_button = QtWidgets.QPushButton("Clear finished")
+        buttons = QtWidgets.QHBoxLayout()
+        buttons.addWidget(self.cancel_button)
+        buttons.addWidget(self.clear_button)
+        widget = QtWidgets.QWidget()
+        layout = QtWidgets.QVBoxLayout(widget)
+        layout.addWidget(self.job_list)
+        layout.addLayout(buttons)
+        self.setWidget(widget)
+
+        self.cancel_button.clicked.connect(lambda: self.cancel_selected())
+        self.clear_button.clicked.connect(lambda: self.clear_finished())
+        self.scheduler.jobChanged.connect(self.update_job)
+
+    def update_job(self, job):
+        item = self._items.get(job)
+        if item is None:
+            item = QtWidgets.QTreeWidgetItem()
+            self._items[job] = item
+            self.job_list.addTopLevelItem(item)
+        if job.progress is None:
+            progress = job.message
+        else:
+            progress = '{:.0f} % {}'.format(job.progress * 100, job.message)
+        for column, text in enumerate((job.name, str(job.priority),
+                                       job.status, progress.strip())):
+            item.setText(column, text)
+        if job.ended:
+            self._forget_finished(self.MAX_FINISHED)
+
+    def selected_jobs(self):
+        selected = self.job_list.selectedItems()
+        return [job for job, item in self._items.items() if item in selected]
+
+    def cancel_selected(self):
+        for job in self.selected_jobs():
+            self.scheduler.cancel(job)
+
+    def clear_finished(self):
+        self._forget_finished(0)
+
+    def _forget_finished(self, keep):
+        finished = sorted((job for job in self._items if job.ended),
+                          key=lambda job: job.finished)
+        for job in finished[:max(len(finished) - keep, 0)]:
+            item = self._items.pop(job)
+            self.job_list.takeTopLevelItem(
+                self.job_list.indexOfTopLevelItem(item))
@@ -0,0 +1,697 @@
+"""Simulated PIE-scope hardware, for offline development and benchmarks.
+
+`simulated_backend` replaces the piescope hardware interfaces used by
+`GUIMainWindow` with simulated Toptica lasers, Basler camera, SMARACT
+objective lens stage and an AutoScript-like FIBSEM microscope (imaging,
+patterning, beams and sample stage). Images are views of one synthetic
+sample, so moving the stage, drift, defocus and milling all show up in
+them. Latencies, noise and drift are set with `SimulationSettings`.
+
+Only numpy and scipy are needed, so the whole acquisition pipeline can
+run on any machine, without AutoScript or the microscope hardware.
+"""
+import contextlib
+import logging
+import os
+import sys
+import threading
+import time
+import types
+
+import mock
+import numpy as np
+import scipy.ndimage as ndi
+
+logger = logging.getLogger(__name__)
+
+LASER_NAMES = ('laser640', 'laser561', 'laser488', 'laser405')
+BASLER_SHAPE = (1200, 1920)
+# AutoScript imaging view numbers
+ELECTRON_VIEW = 1
+ION_VIEW = 2
+# Sample stage offset between the FIBSEM and light microscope positions,
+# see `GUIMainWindow.move_to_light_microscope`.
+LIGHT_MICROSCOPE_OFFSET = (+49.952e-3, -0.1911e-3)
+
+_active_backends = 0
+
+
+class SimulationSettings:
+    """Timing, noise and drift of the simulated hardware.
+
+    Parameters
+    ----------
+    time_scale : float, optional
+        Factor applied to every simulated delay, by default 1 (real time).
+        Zero runs everything as fast as possible.
+    laser_latency : float, optional
+        Seconds to switch a laser on or off, by default 0.05.
+    camera_latency : float, optional
+        Basler readout seconds, on top of the exposure time, by default 0.02.
+    objective_latency : float, optional
+        Seconds per objective stage move, by default 0.05.
+    objective_speed : float, optional
+        Objective stage speed in nanometres per second, by default 1e6.
+    stage_latency : float, optional
+        Seconds per sample stage move, by default 0.5.
+    imaging_latency : float, optional
+        FIBSEM imaging overhead in seconds, on top of the pixel dwell
+        times, by default 0.1.
+    noise : float, optional
+        Standard deviation of the image noise, as a fraction of the full
+        intensity range, by default 0.05. FIBSEM image noise falls with
+        longer dwell times.
+    drift : (float, float), optional
+        Sample drift velocity (x, y) in metres per second, seen in FIBSEM
+        images and milling, by default no drift.
+    focus : float, optional
+        Objective stage position in nanometres where fluorescence images
+        are in focus, by default 0.
+    depth_of_field : float, optional
+        Defocus in nanometres blurring by one pixel, by default 500.
+    seed : int, optional
+        Random seed of the sample and noise.
+    """
+    def __init__(self, time_scale=1.0, laser_latency=0.05, camera_latency=0.02,
+                 objective_latency=0.05, objective_speed=1e6, stage_latency=0.5,
+                 imaging_latency=0.1, noise=0.05, drift=(0., 0.), focus=0.,
+                 depth_of_field=500., seed=None):
+        self.time_scale = time_scale
+        self.laser_latency = laser_latency
+        self.camera_latency = camera_latency
+        self.objective_latency = objective_latency
+        self.objective_speed = objective_speed
+        self.stage_latency = stage_latency
+        self.imaging_latency = imaging_latency
+        self.noise = noise
+        self.drift = drift
+        self.focus = focus
+        self.depth_of_field = depth_of_field
+        self.seed = seed
+
+    def sleep(self, seconds):
+        """Wait for a simulated delay, scaled by `time_scale`."""
+        if seconds > 0 and self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+
+############## AutoScript structures ##############
+class StagePosition:
+    """Sample stage coordinates, like the AutoScript structure."""
+    def __init__(self, x=None, y=None, z=None, r=None, t=None,
+                 coordinate_system=None):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.r = r
+        self.t = t
+        self.coordinate_system = coordinate_system
+
+    def __repr__(self):
+        return 'StagePosition(x={}, y={}, z={}, r={}, t={})'.format(
+            self.x, self.y, self.z, self.r, self.t)
+
+
+class Point:
+    """Two dimensional point, like the AutoScript structure."""
+    def __init__(self, x=0., y=0.):
+        self.x = x
+        self.y = y
+
+    def __repr__(self):
+        return 'Point(x={}, y={})'.format(self.x, self.y)
+
+
+class GrabFrameSettings:
+    """FIBSEM imaging settings, like the AutoScript structure."""
+    def __init__(self, resolution='1536x1024', dwell_time=1e-6):
+        self.resolution = resolution
+        self.dwell_time = dwell_time
+
+
+class AdornedImage:
+    """Image data with pixel size metadata, like the AutoScript structure."""
+    def __init__(self, data=None, pixel_size=None):
+        self.data = data
+        size = types.SimpleNamespace(x=pixel_size, y=pixel_size)
+        self.metadata = types.SimpleNamespace(
+            binary_result=types.SimpleNamespace(pixel_size=size))
+
+    @property
+    def width(self):
+        return self.data.shape[1]
+
+    @property
+    def height(self):
+        return self.data.shape[0]
+
+    def save(self, filename):
+        import tifffile
+
+        tifffile.imwrite(filename, self.data, metadata={
+            'pixel_size': self.metadata.binary_result.pixel_size.x})
+
+    def load(self, filename):
+        import tifffile
+
+        with tifffile.TiffFile(filename) as tif:
+            data = tif.asarray()
+            pixel_size = (tif.shaped_metadata or [{}])[0].get('pixel_size')
+        return AdornedImage(data, pixel_size)
+
+
+def structures_module():
+    """Module standing in for `autoscript_sdb_microscope_client.structures`."""
+    module = types.ModuleType('autoscript_sdb_microscope_client.structures')
+    module.AdornedImage = AdornedImage
+    module.GrabFrameSettings = GrabFrameSettings
+    module.Point = Point
+    module.StagePosition = StagePosition
+    return module
+
+
+############## Sample ##############
+class SimulatedSample:
+    """Synthetic sample imaged by every simulated microscope.
+
+    The sample repeats periodically beyond its size. Coordinates are in
+    metres, x to the right and y up, like the sample stage.
+
+    Parameters
+    ----------
+    size : int, optional
+        Sample size in pixels, by default 2048.
+    pixel_size : float, optional
+        Sample pixel size in metres, by default 50 nm.
+    seed : int, optional
+        Random seed.
+    """
+    def __init__(self, size=2048, pixel_size=50e-9, seed=None):
+        rng = np.random.RandomState(seed)
+        self.size = size
+        self.pixel_size = pixel_size
+        texture = ndi.gaussian_filter(rng.rand(size, size), 6, mode='wrap')
+        texture += ndi.gaussian_filter(rng.rand(size, size), 1.5, mode='wrap') / 4
+        self.structure = _normalize(texture)
+        spots = np.zeros((size, size))
+        n_spots = size * size // 2000
+        spots[rng.randint(size, size=n_spots), rng.randint(size, size=n_spots)] = 1
+        self.fluorescence = _normalize(ndi.gaussian_filter(spots, 3, mode='wrap'))
+        self.milled = []  # [x0, x1, y0, y1, fraction milled]
+        self._lock = threading.Lock()
+
+    def view(self, layer, center_x, center_y, shape, pixel_size):
+        """Image of a sample layer, by nearest neighbour sampling.
+
+        Parameters
+        ----------
+        layer : str
+            'structure' (FIBSEM images) or 'fluorescence'.
+        center_x, center_y : float
+            Sample position at the image centre, in metres.
+        shape : tuple
+            Image shape (rows, columns).
+        pixel_size : float
+            Image pixel size in metres.
+
+        Returns
+        -------
+        ndarray
+            Float image with values between 0 and 1.
+        """
+        rows, columns = shape
+        y = center_y + (rows / 2 - np.arange(rows)) * pixel_size
+        x = center_x + (np.arange(columns) - columns / 2) * pixel_size
+        sample_rows = np.round(-y / self.pixel_size).astype(int) % self.size
+        sample_columns = np.round(x / self.pixel_size).astype(int) % self.size
+        image = getattr(self, layer)[np.ix_(sample_rows, sample_columns)]
+        if layer == 'structure':
+            image = image.copy()
+            with self._lock:
+                milled = [list(region) for region in self.milled]
+            for x0, x1, y0, y1, fraction in milled:
+                row_slice = slice(*np.clip(np.round(
+                    [rows / 2 - (y1 - center_y) / pixel_size,
+                     rows / 2 - (y0 - center_y) / pixel_size]).astype(int),
+                    0, rows))
+                column_slice = slice(*np.clip(np.round(
+                    [columns / 2 + (x0 - center_x) / pixel_size,
+                     columns / 2 + (x1 - center_x) / pixel_size]).astype(int),
+                    0, columns))
+                image[row_slice, column_slice] *= 1 - 0.8 * fraction
+        return image
+
+    def mill(self, center_x, center_y, width, height):
+        """Start milling a sample region, returning its index in `milled`."""
+        with self._lock:
+            self.milled.append([center_x - width / 2, center_x + width / 2,
+                                center_y - height / 2, center_y + height / 2, 0.])
+            return len(self.milled) - 1
+
+    def set_milled_fraction(self, index, fraction):
+        with self._lock:
+            self.milled[index][4] = float(np.clip(fraction, 0, 1))
+
+
+def _normalize(image):
+    image = image - image.min()
+    return (image / max(image.max(), np.finfo(float).eps)).astype(np.float32)
+
+
+def _add_noise(image, noise, rng):
+    if noise > 0:
+        image = image + rng.normal(0, noise, image.shape)
+    return (np.clip(image, 0, 1) * 255).astype(np.uint8)
+
+
+############## Fluorescence microscope ##############
+class SimulatedLaser:
+    """Laser with the attributes and methods of a piescope laser."""
+    def __init__(self, name, settings=None):
+        self.NAME = name
+        self.settings = settings or SimulationSettings()
+        self.selected = False
+        self.laser_power = 0.
+        self.exposure_time = 0
+        self.emission = False
+
+    def emission_on(self):
+        self.settings.sleep(self.settings.laser_latency)
+        self.emission = True
+
+    def emission_off(self):
+        self.settings.sleep(self.settings.laser_latency)
+        self.emission = False
+
+
+class _SimulatedPylonCamera:
+    """Stands in for the pypylon camera object of the Basler detector."""
+    def __init__(self):
+        self._open = False
+
+    def Open(self):
+        self._open = True
+
+    def Close(self):
+        self._open = False
+
+    def IsOpen(self):
+        return self._open
+
+
+class SimulatedBasler:
+    """Basler camera imaging the sample under the light microscope.
+
+    The image brightness follows the power of the lasers emitting and the
+    exposure time, and it blurs as the objective stage moves out of focus.
+    """
+    pixel_size = 50e-9  # at the sample, through the objective lens
+
+    def __init__(self, hardware):
+        self.hardware = hardware
+        self.settings = hardware.settings
+        self.camera = _SimulatedPylonCamera()
+        self._rng = np.random.RandomState(self.settings.seed)
+
+    def camera_grab(self, exposure_time=None, trigger_mode='software',
+                    flip_image=True, **kwargs):
+        """Acquire an image, with the exposure time in microseconds."""
+        exposure_time = 1e5 if exposure_time is None else float(exposure_time)
+        self.camera.Open()
+        self.settings.sleep(exposure_time * 1e-6 + self.settings.camera_latency)
+        stage = self.hardware.microscope.specimen.stage.current_position
+        image = self.hardware.sample.view(
+            'fluorescence', stage.x - LIGHT_MICROSCOPE_OFFSET[0],
+            stage.y - LIGHT_MICROSCOPE_OFFSET[1], BASLER_SHAPE, self.pixel_size)
+        defocus = (self.hardware.objective_stage.position - self.settings.focus)
+        sigma = abs(defocus) / self.settings.depth_of_field
+        if sigma > 0.5:
+            image = ndi.gaussian_filter(image, sigma)
+        power = sum(laser.laser_power for laser in self.hardware.lasers.values()
+                    if laser.emission)
+        # full scale at 10 % laser power for 100 ms
+        image = image * power / 10 * exposure_time / 1e5
+        return _add_noise(image, self.settings.noise, self._rng)
+
+
+class SimulatedObjectiveStage:
+    """Objective lens stage with the methods of a piescope StageController.
+
+    Positions are in nanometres.
+    """
+    def __init__(self, settings=None):
+        self.settings = settings or SimulationSettings()
+        self.position = 0.
+
+    def initialise_system_parameters(self, *args, **kwargs):
+        return None
+
+    def current_position(self):
+        return self.position
+
+    def move_absolute(self, position):
+        self.settings.sleep(self.settings.objective_latency +
+                            abs(position - self.position) /
+                            self.settings.objective_speed)
+        self.position = float(position)
+
+    def move_relative(self, distance):
+        self.move_absolute(self.position + distance)
+
+    def disconnect(self):
+        return None
+
+
+############## FIBSEM microscope ##############
+class _Value:
+    """A microscope setting, read and written through `value`."""
+    def __init__(self, value):
+        self.value = value
+
+
+class _SimulatedBeam:
+    def __init__(self, beam_current, horizontal_field_width=100e-6):
+        self.beam_current = _Value(beam_current)
+        self.horizontal_field_width = _Value(horizontal_field_width)
+        self.beam_shift = _Value(Point(0., 0.))
+
+
+class _SimulatedStage:
+    def __init__(self, settings):
+        self.settings = settings
+        self._position = StagePosition(0., 0., 4e-3, 0., 0.)
+        self._lock = threading.Lock()
+
+    @property
+    def current_position(self):
+        with self._lock:
+            p = self._position
+            return StagePosition(p.x, p.y, p.z, p.r, p.t)
+
+    def absolute_move(self, position):
+        self.settings.sleep(self.settings.stage_latency)
+        with self._lock:
+            for axis in 'xyzrt':
+                value = getattr(position, axis)
+                if value is not None:
+                    setattr(self._position, axis, value)
+
+    def relative_move(self, position):
+        self.settings.sleep(self.settings.stage_latency)
+        with self._lock:
+            for axis in 'xyzrt':
+                value = getattr(position, axis)
+                if value is not None:
+                    setattr(self._position, axis,
+                            getattr(self._position, axis) + value)
+
+
+class _SimulatedImaging:
+    def __init__(self, microscope):
+        self.microscope = microscope
+        self.settings = microscope.settings
+        self._view = ELECTRON_VIEW
+        self._last = {}
+        self._rng = np.random.RandomState(self.settings.seed)
+        self._lock = threading.Lock()
+
+    def set_active_view(self, view):
+        self._view = view
+
+    def get_active_view(self):
+        return self._view
+
+    def grab_frame(self, settings=None):
+        """Acquire an Adorned Image with the beam of the active view."""
+        settings = settings or GrabFrameSettings()
+        columns, rows = (int(i) for i in settings.resolution.split('x'))
+        self.settings.sleep(self.settings.imaging_latency +
+                            rows * columns * settings.dwell_time)
+        view = self._view
+        beam = self.microscope.beam(view)
+        pixel_size = beam.horizontal_field_width.value / columns
+        center_x, center_y = self.microscope.beam_center(beam)
+        image = self.microscope.hardware.sample.view(
+            'structure', center_x, center_y, (rows, columns), pixel_size)
+        if view == ION_VIEW:
+            image = image ** 0.8
+        noise = self.settings.noise * np.sqrt(1e-6 / max(settings.dwell_time, 1e-9))
+        with self._lock:
+            data = _add_noise(image, min(noise, 0.5), self._rng)
+        adorned = AdornedImage(data, pixel_size)
+        self._last[view] = adorned
+        return adorned
+
+    def get_image(self):
+        """The last image acquired with the active view."""
+        return self._last.get(self._view) or self.grab_frame()
+
+
+class _SimulatedPattern:
+    def __init__(self, center_x, center_y, width, height, depth, current):
+        self.center_x = center_x
+        self.center_y = center_y
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.scan_direction = 'TopToBottom'
+        # silicon sputter rate of 0.27 µm^3/nC
+        self.time = width * height * depth * 1e18 / 0.27 / (current * 1e9)
+
+
+class _SimulatedPatterning:
+    """Ion beam patterning, milling patterns one after another in a thread."""
+    tick = 0.05  # seconds
+
+    def __init__(self, microscope):
+        self.microscope = microscope
+        self.settings = microscope.settings
+        self.state = "Idle"
+        self.patterns = []
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def create_rectangle(self, center_x, center_y, width, height, depth):
+        current = self.microscope.beams.ion_beam.beam_current.value
+        pattern = _SimulatedPattern(center_x, center_y, width, height, depth,
+                                    current)
+        self.patterns.append(pattern)
+        return pattern
+
+    def clear_patterns(self):
+        self.patterns = []
+
+    def start(self):
+        if self.state != "Idle":
+            raise RuntimeError("Patterning is {}".format(self.state))
+        self.state = "Running"
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._mill, daemon=True,
+                                        args=(list(self.patterns),))
+        self._thread.start()
+
+    def run(self):
+        """Mill the patterns, blocking until finished."""
+        self.start()
+        self._thread.join()
+
+    def pause(self):
+        if self.state == "Running":
+            self.state = "Paused"
+
+    def resume(self):
+        if self.state == "Paused":
+            self.state = "Running"
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.state = "Idle"
+
+    def _mill(self, patterns):
+        sample = self.microscope.hardware.sample
+        beam = self.microscope.beams.ion_beam
+        try:
+            for pattern in patterns:
+                center_x, center_y = self.microscope.beam_center(beam)
+                index = sample.mill(center_x + pattern.center_x,
+                                    center_y + pattern.center_y,
+                                    pattern.width, pattern.height)
+                duration = pattern.time * self.settings.time_scale
+                elapsed = 0.
+                while elapsed < duration:
+                    if self._stop_event.wait(self.tick):
+                        return
+                    if self.state == "Running":
+                        elapsed += self.tick
+                        sample.set_milled_fraction(index, elapsed / duration)
+                sample.set_milled_fraction(index, 1)
+        finally:
+            self.state = "Idle"
+
+
+class SimulatedMicroscope:
+    """FIBSEM microscope with the parts of the AutoScript API piescope uses."""
+    def __init__(self, hardware):
+        self.hardware = hardware
+        self.settings = hardware.settings
+        self._start_time = time.time()
+        self.beams = types.SimpleNamespace(
+            electron_beam=_SimulatedBeam(1e-10),
+            ion_beam=_SimulatedBeam(1e-9))
+        self.specimen = types.SimpleNamespace(stage=_SimulatedStage(self.settings))
+        self.imaging = _SimulatedImaging(self)
+        self.patterning = _SimulatedPatterning(self)
+        self.auto_functions = types.SimpleNamespace(
+            run_auto_cb=lambda *args, **kwargs: None)
+
+    def beam(self, view):
+        if view == ION_VIEW:
+            return self.beams.ion_beam
+        return self.beams.electron_beam
+
+    def drift(self):
+        """Sample drift (x, y) in metres since the microscope was created."""
+        elapsed = (time.time() - self._start_time) * self.settings.time_scale
+        return (self.settings.drift[0] * elapsed,
+                self.settings.drift[1] * elapsed)
+
+    def beam_center(self, beam):
+        """Sample position (x, y) in metres at the centre of a beam's view."""
+        stage = self.specimen.stage.current_position
+        drift_x, drift_y = self.drift()
+        shift = beam.beam_shift.value
+        return stage.x + drift_x + shift.x, stage.y + drift_y + shift.y
+
+    def disconnect(self):
+        self.patterning.stop()
+
+
+class SimulatedHardware:
+    """All the simulated PIE-scope hardware, sharing one sample.
+
+    Parameters
+    ----------
+    settings : SimulationSettings, optional
+    sample : SimulatedSample, optional
+    """
+    def __init__(self, settings=None, sample=None):
+        self.settings = settings or SimulationSettings()
+        self.sample = sample or SimulatedSample(seed=self.settings.seed)
+        self.lasers = {name: SimulatedLaser(name, self.settings)
+                       for name in LASER_NAMES}
+        self.objective_stage = SimulatedObjectiveStage(self.settings)
+        self.microscope = SimulatedMicroscope(self)
+        self.detector = SimulatedBasler(self)
+
+
+############## piescope.fibsem functions ##############
+def update_camera_settings(dwell_time, resolution):
+    return GrabFrameSettings(resolution=resolution, dwell_time=dwell_time)
+
+
+def new_ion_image(microscope, settings=None):
+    microscope.imaging.set_active_view(ION_VIEW)
+    return microscope.imaging.grab_frame(settings)
+
+
+def new_electron_image(microscope, settings=None):
+    microscope.imaging.set_active_view(ELECTRON_VIEW)
+    return microscope.imaging.grab_frame(settings)
+
+
+def last_ion_image(microscope):
+    microscope.imaging.set_active_view(ION_VIEW)
+    return microscope.imaging.get_image()
+
+
+def last_electron_image(microscope):
+    microscope.imaging.set_active_view(ELECTRON_VIEW)
+    return microscope.imaging.get_image()
+
+
+def autocontrast(microscope):
+    microscope.auto_functions.run_auto_cb()
+    return microscope.imaging.grab_frame()
+
+
+def move_to_light_microscope(microscope, x=+49.952e-3, y=-0.1911e-3):
+    microscope.specimen.stage.relative_move(StagePosition(x=x, y=y))
+    return microscope.specimen.stage.current_position
+
+
+def move_to_electron_microscope(microscope, x=-49.952e-3, y=+0.1911e-3):
+    microscope.specimen.stage.relative_move(StagePosition(x=x, y=y))
+    return microscope.specimen.stage.current_position
+
+
+def active():
+    """Whether the hardware is currently simulated by `simulated_backend`."""
+    return _active_backends > 0
+
+
+@contextlib.contextmanager
+def simulated_backend(settings=None, sample=None):
+    """Replace the piescope hardware interfaces with simulated hardware.
+
+    Inside the context, `piescope.lm.laser.initialize_lasers`,
+    `piescope.lm.detector.Basler`, `piescope.lm.objective.StageController`
+    and the `piescope.fibsem` functions used by `GUIMainWindow` return or
+    act on simulated hardware. If AutoScript isn't installed, its
+    structures module is simulated too.
+
+    Parameters
+    ----------
+    settings : SimulationSettings, optional
+    sample : SimulatedSample, optional
+
+    Yields
+    ------
+    SimulatedHardware
+    """
+    global _active_backends
+    import piescope.fibsem
+    import piescope.lm
+
+    hardware = SimulatedHardware(settings, sample)
+    fibsem_functions = {
+        'initialize': lambda *args, **kwargs: hardware.microscope,
+        'update_camera_settings': update_camera_settings,
+        'new_ion_image': new_ion_image,
+        'new_electron_image': new_electron_image,
+        'last_ion_image': last_ion_image,
+        'last_electron_image': last_electron_image,
+        'autocontrast': autocontrast,
+        'move_to_light_microscope': move_to_light_microscope,
+        'move_to_electron_microscope': move_to_electron_microscope,
+    }
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.dict(os.environ, {'PYLON_CAMEMU': '1'}))
+        stack.enter_context(mock.patch(
+            'piescope.lm.laser.initialize_lasers',
+            lambda *args, **kwargs: hardware.lasers))
+        stack.enter_context(mock.patch(
+            'piescope.lm.detector.Basler',
+            lambda *args, **kwargs: hardware.detector))
+        stack.enter_context(mock.patch(
+            'piescope.lm.objective.StageController',
+            lambda *args, **kwargs: hardware.objective_stage))
+        for name, function in fibsem_functions.items():
+            stack.enter_context(mock.patch.object(
+                piescope.fibsem, name, function, create=True))
+        try:
+            import autoscript_sdb_microscope_client.structures  # noqa: F401
+        except ImportError:
+            package = types.ModuleType('autoscript_sdb_microscope_client')
+            package.structures = structures_module()
+            stack.enter_context(mock.patch.dict(sys.modules, {
+                'autoscript_sdb_microscope_client': package,
+                'autoscript_sdb_microscope_client.structures': package.structures,
+            }))
+        _active_backends += 1
+        try:
+            yield hardware
+        finally:
+            _active_backends -= 1
+            hardware.microscope.disconnect()
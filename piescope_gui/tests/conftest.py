@@ -0,0 +1,12 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="session")
+def example_affine_matrix():
+    r = 0.12
+    c, s = np.cos(r), np.sin(r)
+    matrix_transform = np.array([[c, -s, 0],
+                                 [s, c, 50],
+                                 [0, 0, 1]])
+    return matrix_transform
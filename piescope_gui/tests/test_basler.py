@@ -50,6 +50,17 @@ def test_fluorescence_image(window, monkeypatch, tmpdir, wavelength, exposure_ti
         assert np.allclose(window.array_list_FM, expected)
 
 
+def test_multichannel_image(window, monkeypatch, tmpdir):
+    monkeypatch.setenv("PYLON_CAMEMU", "1")
+    window.save_destination_FM = str(tmpdir)
+    window.laser_dict = {"laser640": (1.0, 150000), "laser488": (0.5, 150000)}
+    output = window.multichannel_image()
+    assert output.ndim == 3
+    assert output.shape[-1] == 2
+    assert window.laser_controller.pending() == {}
+    assert tmpdir.join('Multichannel_Image.tif').check()
+
+
 # Do not parameterize this test function
 def test_fluorescence_live_imaging(window, monkeypatch):
     monkeypatch.setenv("PYLON_CAMEMU", "1")
@@ -0,0 +1,38 @@
+import pytest
+
+from piescope_gui import benchmark
+
+
+def test_run_benchmarks(tmpdir):
+    names = ['warp_image', 'overlay_images']
+    results = benchmark.run_benchmarks(names, repeat=2, warmup=0)
+    assert list(results['benchmarks']) == names
+    for result in results['benchmarks'].values():
+        assert len(result['times']) == 2
+        assert result['min'] <= result['median']
+        assert result['throughput'] > 0
+    filename = str(tmpdir.join('results.json'))
+    benchmark.save_results(results, filename)
+    assert benchmark.load_results(filename)['benchmarks'] == results['benchmarks']
+
+
+def test_unknown_benchmark():
+    with pytest.raises(ValueError):
+        benchmark.run_benchmarks(['not a benchmark'])
+
+
+def test_compare_results():
+    baseline = {'benchmarks': {'a': {'median': 1.0}, 'b': {'median': 1.0},
+                               'c': {'skipped': 'No module named piescope'},
+                               'e': {'median': 1.0}, 'f': {'median': 1.0},
+                               'g': {'median': 1.0}}}
+    results = {'benchmarks': {'a': {'median': 1.1}, 'b': {'median': 1.5},
+                              'c': {'median': 1.0}, 'd': {'median': 1.0},
+                              'e': {'error': 'ValueError: bad shape'},
+                              'g': {'skipped': 'No module named piescope'}}}
+    comparison = benchmark.compare_results(results, baseline, tolerance=0.2)
+    assert [row['name'] for row in comparison] == ['a', 'b', 'e', 'f']
+    assert [row['regressed'] for row in comparison] == [False] + [True] * 3
+    assert comparison[1]['ratio'] == 1.5
+    assert comparison[2]['error'] == 'ValueError: bad shape'
+    assert comparison[3]['error'] == 'missing'
@@ -1,19 +1,40 @@
 import os
+import time
+from types import SimpleNamespace
 
 import matplotlib
 matplotlib.use('Agg')  # noqa: E402
 import matplotlib.pyplot as plt
 import numpy as np
 import pytest
+import scipy.ndimage as ndi
+import skimage.color
 import skimage.data
 from unittest.mock import patch
 
-from piescope_gui.correlation.main import (apply_transform,
+from piescope_gui.correlation.main import (CorrelationSession,
+                                           apply_transform,
                                            calculate_transform,
+                                           complete_points,
+                                           find_cached_transform,
+                                           image_geometry,
                                            overlay_images,
                                            point_coords,
+                                           preview_overlay,
                                            save_text,
+                                           save_transform,
                                            )
+from piescope_gui.correlation.transform import (ThinPlateSplineTransform,
+                                                clear_warp_map_cache,
+                                                estimate_mapping,
+                                                geometry_matches,
+                                                get_point_warp_map,
+                                                get_warp_map,
+                                                load_transform,
+                                                mapping_coords,
+                                                warp_image,
+                                                warp_image_points,
+                                                )
 
 
 @pytest.fixture(scope="session")
@@ -38,14 +59,16 @@ def destination_coords():
     return dst
 
 
-@pytest.fixture(scope="session")
-def example_affine_matrix():
-    r = 0.12
-    c, s = np.cos(r), np.sin(r)
-    matrix_transform = np.array([[c, -s, 0],
-                                 [s, c, 50],
-                                 [0, 0, 1]])
-    return matrix_transform
+@pytest.fixture
+def adorned_image():
+    position = SimpleNamespace(x=1e-3, y=2e-3, z=4e-3, r=0.5, t=0.1)
+    metadata = SimpleNamespace(
+        binary_result=SimpleNamespace(
+            pixel_size=SimpleNamespace(x=1e-8, y=1e-8)),
+        stage_settings=SimpleNamespace(stage_position=position))
+    image = SimpleNamespace(data=np.zeros((512, 768)), metadata=metadata,
+                            width=768, height=512)
+    return image
 
 
 @pytest.fixture(scope="session")
@@ -131,6 +154,33 @@ def test_point_coords(source_coords, destination_coords, matched_points_dict):
     assert np.allclose(dst, destination_coords)
 
 
+def test_complete_points(matched_points_dict):
+    incomplete_point = {'point_id': 6,
+                        'img1_x': 10.0,
+                        'img1_y': 20.0,
+                        'img2_x': None,
+                        'img2_y': None}
+    output = complete_points(matched_points_dict + [incomplete_point])
+    assert output == matched_points_dict
+
+
+def test_preview_overlay(matched_points_dict):
+    fluorescence_image = skimage.data.astronaut()
+    fibsem_image = skimage.data.astronaut()[..., 0]
+    output = preview_overlay(fluorescence_image, fibsem_image,
+                             matched_points_dict, max_size=128)
+    assert output.shape == (128, 128, 3)
+    assert output.dtype == np.uint8
+    # compare against the full resolution result, subsampled afterwards
+    src, dst = point_coords(matched_points_dict)
+    transformation = calculate_transform(src, dst)
+    aligned = apply_transform(fluorescence_image, transformation)
+    expected = overlay_images(aligned, skimage.color.gray2rgb(fibsem_image))
+    expected = skimage.img_as_ubyte(expected)[::4, ::4]
+    difference = np.abs(output.astype(float) - expected.astype(float))
+    assert np.median(difference) < 5
+
+
 def test_save_text(tmpdir, matched_points_dict):
     output_filename = os.path.join(tmpdir, "save_text.txt")
     transformation = "transformation"  # dummy placeholder for an actual matrix
@@ -153,3 +203,214 @@ def test_overlay_images():
     fig, ax = plt.subplots()
     ax.imshow(output)
     return fig
+
+
+def test_image_geometry(adorned_image):
+    geometry = image_geometry(adorned_image, (512, 768, 3))
+    assert geometry == {'pixel_size': [1e-8, 1e-8],
+                        'resolution': [768, 512],
+                        'stage_position': {'x': 1e-3, 'y': 2e-3, 'z': 4e-3,
+                                           'r': 0.5, 't': 0.1},
+                        'fluorescence_shape': [512, 768]}
+
+
+def test_image_geometry_missing_metadata():
+    image = SimpleNamespace(data=np.zeros((10, 20)), metadata=None)
+    geometry = image_geometry(image)
+    assert geometry['pixel_size'] is None
+    assert geometry['stage_position'] is None
+    assert geometry['resolution'] == [20, 10]
+
+
+def test_geometry_matches(adorned_image):
+    geometry = image_geometry(adorned_image)
+    assert geometry_matches(geometry, image_geometry(adorned_image))
+    adorned_image.metadata.stage_settings.stage_position.x += 1e-5
+    assert not geometry_matches(geometry, image_geometry(adorned_image))
+    assert geometry_matches(geometry, image_geometry(adorned_image),
+                            position_tolerance=1e-4)
+
+
+def test_save_load_transform(tmpdir, example_affine_matrix,
+                             matched_points_dict, adorned_image):
+    output_filename = os.path.join(tmpdir, "overlay.tiff")
+    geometry = image_geometry(adorned_image)
+    filename = save_transform(output_filename, example_affine_matrix,
+                              matched_points_dict, geometry)
+    assert filename == os.path.join(tmpdir, "overlay.json")
+    contents = load_transform(filename)
+    assert np.allclose(contents['transformation'], example_affine_matrix)
+    assert contents['control_points'] == matched_points_dict
+    assert contents['geometry'] == geometry
+    assert contents['method'] == 'affine'
+
+
+def test_find_cached_transform(tmpdir, example_affine_matrix,
+                               matched_points_dict, adorned_image):
+    geometry = image_geometry(adorned_image)
+    assert find_cached_transform(str(tmpdir), geometry) is None
+    with open(os.path.join(tmpdir, "unrelated.json"), 'w') as f:
+        f.write('[1, 2, 3]')
+    save_transform(os.path.join(tmpdir, "old.tiff"), np.eye(3),
+                   matched_points_dict, geometry)
+    newest = save_transform(os.path.join(tmpdir, "new.tiff"),
+                            example_affine_matrix, matched_points_dict,
+                            geometry)
+    os.utime(newest, (time.time() + 10, time.time() + 10))
+    result = find_cached_transform(str(tmpdir), geometry)
+    assert result['filename'] == newest
+    assert np.allclose(result['transformation'], example_affine_matrix)
+    adorned_image.metadata.binary_result.pixel_size.x = 2e-8
+    assert find_cached_transform(str(tmpdir), image_geometry(adorned_image)) is None
+
+
+def test_correlation_session_derives_images_lazily(adorned_image):
+    fluorescence_image = np.random.random((512, 768, 3))
+    adorned_image.data = np.zeros((512, 768), dtype=np.uint8)
+    session = CorrelationSession(fluorescence_image, adorned_image, "")
+    assert session._fibsem_rgb is None
+    assert session._fluorescence_rgb is None
+    assert session.fibsem_rgb.shape == (512, 768, 3)
+    # inputs are used by reference when no conversion is needed
+    assert session.fluorescence_rgb is fluorescence_image
+    assert session.geometry['fluorescence_shape'] == [512, 768]
+
+
+def test_correlation_session_resizes_fluorescence_image():
+    fluorescence_image = np.ones((100, 150), dtype=np.uint16)
+    fibsem_image = np.zeros((200, 300), dtype=np.uint8)
+    session = CorrelationSession(fluorescence_image, fibsem_image, "")
+    assert session.fluorescence_rgb.shape == (200, 300, 3)
+    assert session.geometry is None  # no metadata available
+
+
+def test_correlation_session_close(example_affine_matrix):
+    session = CorrelationSession(np.ones((10, 10)), np.ones((10, 10)), "")
+    assert session.fibsem_rgb is not None
+    assert not session.closed
+    clear_warp_map_cache()
+    other_session_map = get_warp_map(np.eye(3), (10, 10))
+    warp_map = get_warp_map(example_affine_matrix, (10, 10))
+    session.warp_maps.append(warp_map)
+    session.close()
+    assert session.closed
+    assert session._fibsem_rgb is None
+    assert session.fluorescence_image is None
+    assert get_warp_map(example_affine_matrix, (10, 10)) is not warp_map
+    assert get_warp_map(np.eye(3), (10, 10)) is other_session_map
+
+
+@pytest.mark.parametrize("image", [
+    skimage.img_as_float(skimage.data.camera()),
+    skimage.img_as_float(skimage.data.astronaut()),
+])
+def test_warp_image(image, example_affine_matrix):
+    output = warp_image(image, example_affine_matrix)
+    matrix = np.linalg.inv(example_affine_matrix)
+    if image.ndim == 2:
+        expected = ndi.affine_transform(image, matrix, order=1)
+    else:
+        expected = np.dstack([ndi.affine_transform(channel, matrix, order=1)
+                              for channel in np.moveaxis(image, -1, 0)])
+    assert output.shape == image.shape
+    assert output.dtype == image.dtype
+    # compare away from the image edges, where boundary handling differs
+    interior = (slice(100, -100), slice(100, -100))
+    assert np.allclose(output[interior], expected[interior], atol=1e-5)
+
+
+def test_warp_image_integer_dtype(example_affine_matrix):
+    image = skimage.data.camera()
+    output = warp_image(image, example_affine_matrix, output_shape=(300, 400))
+    assert output.shape == (300, 400)
+    assert output.dtype == np.uint8
+    expected = warp_image(skimage.img_as_float(image), example_affine_matrix,
+                          output_shape=(300, 400))
+    assert np.abs(skimage.img_as_float(output) - expected).max() <= 1 / 255
+
+
+def test_get_warp_map_cache(example_affine_matrix):
+    clear_warp_map_cache()
+    warp_map = get_warp_map(example_affine_matrix, (64, 64, 3))
+    assert get_warp_map(example_affine_matrix, (64, 64)) is warp_map
+    assert get_warp_map(example_affine_matrix, (64, 64), inverse=False) is not warp_map
+    assert get_warp_map(np.eye(3), (64, 64)) is not warp_map
+    # least recently used map is evicted
+    assert get_warp_map(example_affine_matrix, (64, 64)) is not warp_map
+    with pytest.raises(ValueError):
+        warp_map.warp(np.zeros((32, 32)))
+
+
+def distorted_points():
+    rows, cols = np.meshgrid(np.linspace(10, 190, 5), np.linspace(20, 280, 5),
+                             indexing='ij')
+    src = np.column_stack([rows.ravel(), cols.ravel()])
+    # smooth barrel-like distortion on top of a shift
+    dst = src + [5, -3] + 1e-4 * (src - [100, 150]) ** 2
+    return src, dst
+
+
+def test_thin_plate_spline_interpolates_control_points():
+    src, dst = distorted_points()
+    model = ThinPlateSplineTransform()
+    assert model.estimate(src, dst)
+    assert np.allclose(model(src), dst)
+    # a purely affine relation is reproduced everywhere
+    matrix = np.array([[1.1, 0.2], [-0.1, 0.9]])
+    model.estimate(src, src @ matrix.T + [3, 4])
+    points = np.array([[0., 0.], [57.5, 123.4], [250., 350.]])
+    assert np.allclose(model(points), points @ matrix.T + [3, 4])
+
+
+@pytest.mark.parametrize("method", ['affine', 'polynomial', 'tps'])
+def test_estimate_mapping_direction(method):
+    src, dst = distorted_points()
+    mapping = estimate_mapping(src, dst, method=method)
+    tolerance = 2 if method == 'affine' else 0.05
+    assert np.allclose(mapping(dst), src, atol=tolerance)
+
+
+def test_estimate_mapping_needs_enough_points(source_coords, destination_coords):
+    with pytest.raises(ValueError):
+        estimate_mapping(source_coords[:5], destination_coords[:5],
+                         method='polynomial')
+    with pytest.raises(ValueError):
+        estimate_mapping(source_coords, destination_coords, method='unknown')
+
+
+@pytest.mark.parametrize("method", ['affine', 'polynomial', 'tps'])
+def test_estimate_mapping_degenerate_points(method):
+    collinear = np.array([[i, 2. * i] for i in range(10)])
+    with pytest.raises(ValueError):
+        estimate_mapping(collinear, collinear + 5, method=method)
+
+
+def test_mapping_coords_coarse_grid():
+    src, dst = distorted_points()
+    mapping = estimate_mapping(src, dst, method='tps')
+    exact = mapping_coords(mapping, (200, 300), grid_step=1)
+    coarse = mapping_coords(mapping, (200, 300), grid_step=16)
+    assert exact.shape == coarse.shape == (2, 200, 300)
+    assert np.abs(exact - coarse).max() < 0.05
+
+
+def test_warp_image_points_affine_matches_warp_image(source_coords,
+                                                     destination_coords):
+    # three points define an affine transform exactly, in both directions
+    src, dst = source_coords[:3], destination_coords[:3]
+    image = skimage.img_as_float(skimage.data.camera())
+    expected = warp_image(image, calculate_transform(src, dst))
+    output = warp_image_points(image, src, dst, method='affine', grid_step=32)
+    assert np.allclose(output, expected, atol=1e-3)
+
+
+def test_warp_image_points_tps():
+    src, dst = distorted_points()
+    image = np.zeros((200, 300))
+    for row, col in src.astype(int):
+        image[row - 1:row + 2, col - 1:col + 2] = 1
+    output = warp_image_points(image, src, dst, method='tps')
+    for row, col in np.round(dst).astype(int):
+        assert output[row, col] > 0.5
+    assert get_point_warp_map(src, dst, image.shape, method='tps') is \
+        get_point_warp_map(src, dst, image.shape, method='tps')
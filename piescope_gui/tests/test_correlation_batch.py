@@ -0,0 +1,174 @@
+import json
+import os
+import subprocess
+import sys
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import skimage.data
+import skimage.io
+
+from piescope_gui import cli
+from piescope_gui.correlation.batch import (as_rgb,
+                                            correlate_batch,
+                                            correlate_file,
+                                            find_images,
+                                            output_filenames,
+                                            pair_images,
+                                            read_transformation,
+                                            read_warp,
+                                            )
+from piescope_gui.correlation.transform import (overlay_images,
+                                                save_transform,
+                                                warp_image,
+                                                )
+
+
+@pytest.fixture
+def batch_input(tmpdir, example_affine_matrix):
+    fluorescence_directory = os.path.join(tmpdir, "fluorescence")
+    os.makedirs(fluorescence_directory)
+    image = skimage.data.camera()[::4, ::4]
+    for i in range(3):
+        skimage.io.imsave(os.path.join(fluorescence_directory,
+                                       "F_{}.tif".format(i)),
+                          np.roll(image, 5 * i, axis=1))
+    fibsem_filename = os.path.join(tmpdir, "I_image.tif")
+    skimage.io.imsave(fibsem_filename, image)
+    transform_filename = save_transform(
+        os.path.join(tmpdir, "correlated_image.tiff"), example_affine_matrix,
+        [])
+    return transform_filename, fluorescence_directory, fibsem_filename
+
+
+def test_find_images(tmpdir):
+    for filename in ["b.tif", "a.png", "notes.txt"]:
+        open(os.path.join(tmpdir, filename), "w").close()
+    result = find_images(str(tmpdir))
+    assert result == [os.path.join(tmpdir, "a.png"),
+                      os.path.join(tmpdir, "b.tif")]
+    assert find_images(result[0]) == [result[0]]
+    with pytest.raises(ValueError):
+        find_images(os.path.join(tmpdir, "missing"))
+
+
+def test_pair_images():
+    assert pair_images(["f1", "f2"], ["i1"]) == [("f1", "i1"), ("f2", "i1")]
+    assert pair_images(["f1", "f2"], ["i1", "i2"]) == [("f1", "i1"),
+                                                       ("f2", "i2")]
+    with pytest.raises(ValueError):
+        pair_images(["f1", "f2", "f3"], ["i1", "i2"])
+
+
+def test_output_filenames():
+    names = output_filenames(["in/a.tif", "in/a.png", "in/b.tif"], "out")
+    assert names == [os.path.join("out", "correlated_a_tif.tiff"),
+                     os.path.join("out", "correlated_a_png.tiff"),
+                     os.path.join("out", "correlated_b.tiff")]
+    with pytest.raises(ValueError):
+        output_filenames(["in/a.tif", "in/a.png", "in/a_png.tif"], "out")
+
+
+def test_read_transformation_from_control_points(tmpdir):
+    points = [{'point_id': i, 'img1_x': x, 'img1_y': y,
+               'img2_x': x + 10, 'img2_y': y - 5}
+              for i, (x, y) in enumerate([(0, 0), (100, 0), (0, 100)])]
+    filename = save_transform(os.path.join(tmpdir, "out.tiff"), [], points)
+    output = read_transformation(filename)
+    expected = np.array([[1, 0, -5],
+                         [0, 1, 10],
+                         [0, 0, 1]])
+    assert np.allclose(output, expected)
+
+
+def test_read_warp(tmpdir, example_affine_matrix):
+    affine = save_transform(os.path.join(tmpdir, "affine.tiff"),
+                            example_affine_matrix, [])
+    method, transformation = read_warp(affine)
+    assert method == 'affine'
+    assert np.allclose(transformation, example_affine_matrix)
+    points = [{'point_id': i, 'img1_x': x, 'img1_y': y,
+               'img2_x': x + 10, 'img2_y': y - 5}
+              for i, (x, y) in enumerate([(0, 0), (100, 0), (0, 100)])]
+    tps = save_transform(os.path.join(tmpdir, "tps.tiff"), np.eye(3), points,
+                         method='tps')
+    method, (src, dst) = read_warp(tps)
+    assert method == 'tps'
+    assert np.allclose(dst - src, [-5, 10])
+
+
+@pytest.mark.parametrize("shape", [
+    (10, 12),
+    (10, 12, 3),
+    (3, 10, 12),
+    (2, 10, 12),
+    (10, 12, 4),
+])
+def test_as_rgb(shape):
+    output = as_rgb(np.ones(shape))
+    assert output.shape == (10, 12, 3)
+
+
+def test_correlate_batch(tmpdir, batch_input, example_affine_matrix):
+    transform_filename, fluorescence_directory, fibsem_filename = batch_input
+    output_directory = os.path.join(tmpdir, "output")
+    results = correlate_batch(transform_filename, fluorescence_directory,
+                              fibsem_filename, output_directory,
+                              workers=2, max_pending=2)
+    assert len(results) == 3
+    assert all(result['error'] is None for result in results)
+    # Check against the interactive correlation functions
+    fluorescence = skimage.io.imread(results[1]['fluorescence'])
+    fibsem = skimage.io.imread(fibsem_filename)
+    aligned = warp_image(as_rgb(fluorescence), example_affine_matrix)
+    expected = skimage.img_as_ubyte(overlay_images(aligned, as_rgb(fibsem)))
+    output = skimage.io.imread(results[1]['output'])
+    assert np.allclose(output, expected, atol=1)
+    with open(os.path.join(output_directory, "summary.json")) as f:
+        summary = json.load(f)
+    assert summary['succeeded'] == 3
+    assert summary['failed'] == 0
+
+
+def test_correlate_file(tmpdir, batch_input):
+    transform_filename, fluorescence_directory, fibsem_filename = batch_input
+    fluorescence_filename = os.path.join(fluorescence_directory, "F_0.tif")
+    output_filename = os.path.join(tmpdir, "overlay.tif")
+    result = correlate_file(fluorescence_filename, fibsem_filename,
+                            output_filename, read_warp(transform_filename))
+    assert result['error'] is None
+    assert result['output'] == output_filename
+    assert os.path.isfile(output_filename)
+    result = correlate_file(os.path.join(tmpdir, "missing.tif"),
+                            fibsem_filename, output_filename,
+                            read_warp(transform_filename))
+    assert result['error'] is not None
+
+
+def test_correlate_batch_reports_failures(tmpdir, batch_input):
+    transform_filename, fluorescence_directory, fibsem_filename = batch_input
+    open(os.path.join(fluorescence_directory, "F_broken.tif"), "w").close()
+    results = correlate_batch(transform_filename, fluorescence_directory,
+                              fibsem_filename, str(tmpdir), workers=1)
+    assert [result['error'] is None for result in results] == [
+        True, True, True, False]
+
+
+def test_cli_correlate(tmpdir, batch_input):
+    transform_filename, fluorescence_directory, fibsem_filename = batch_input
+    output_directory = os.path.join(tmpdir, "output")
+    runner = CliRunner()
+    result = runner.invoke(cli.main, [
+        "correlate", transform_filename, fluorescence_directory,
+        fibsem_filename, "--output", output_directory, "--workers", "1"])
+    assert result.exit_code == 0
+    assert "Correlated 3 of 3 images" in result.output
+    assert len(os.listdir(output_directory)) == 4
+
+
+def test_cli_does_not_import_qt():
+    code = ("import sys; import piescope_gui.cli; "
+            "import piescope_gui.correlation.batch; "
+            "assert 'PyQt5' not in sys.modules")
+    subprocess.check_call([sys.executable, "-c", code])
@@ -31,3 +31,14 @@ def test_open_correlation_window(qtbot, main_window, tmpdir):
     window = piescope_gui.correlation.main.open_correlation_window(
         main_window, fluorescence_image, fibsem_image, tmpdir)
     qtbot.add_widget(window)
+
+
+def test_preview_placeholder_names_minimum_points(qtbot, main_window, tmpdir):
+    fluorescence_image = skimage.data.astronaut()
+    fibsem_image = MockAdornedImage(skimage.data.camera())
+    window = piescope_gui.correlation.main.open_correlation_window(
+        main_window, fluorescence_image, fibsem_image, tmpdir)
+    qtbot.add_widget(window)
+    assert "at least 3 point" in window.preview.ax.texts[0].get_text()
+    window.methodCombo.setCurrentIndex(window.methodCombo.findData('polynomial'))
+    assert "at least 6 point" in window.preview.ax.texts[0].get_text()
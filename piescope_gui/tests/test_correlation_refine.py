@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+import skimage.color
+import skimage.data
+
+from piescope_gui.correlation.refine import (ellipse_parameters,
+                                             predict_point,
+                                             refine_centroid,
+                                             refine_cross_correlation,
+                                             refine_gaussian,
+                                             refine_point,
+                                             )
+
+
+def gaussian_spot(x, y, shape=(64, 80), sigma=2.0):
+    rows, cols = np.indices(shape)
+    return 100 * np.exp(-((rows - y) ** 2 + (cols - x) ** 2) / (2 * sigma ** 2)) + 10
+
+
+def test_refine_centroid():
+    image = gaussian_spot(30.3, 20.6)
+    x, y = refine_centroid(image, 28, 22, window=7)
+    assert np.allclose((x, y), (30.3, 20.6), atol=0.1)
+
+
+def test_refine_centroid_flat_image():
+    image = np.ones((20, 20))
+    assert refine_centroid(image, 5.4, 6.2) == (5.4, 6.2)
+
+
+def test_refine_gaussian():
+    image = gaussian_spot(30.3, 20.6)
+    x, y = refine_gaussian(image, 28, 22, window=7)
+    assert np.allclose((x, y), (30.3, 20.6), atol=0.01)
+
+
+def test_refine_gaussian_rgb():
+    image = skimage.color.gray2rgb(gaussian_spot(30.3, 20.6) / 110)
+    x, y = refine_gaussian(image, 31, 19, window=7)
+    assert np.allclose((x, y), (30.3, 20.6), atol=0.01)
+
+
+def test_refine_point_unknown_method():
+    with pytest.raises(ValueError):
+        refine_point(np.zeros((10, 10)), 5, 5, method='unknown')
+
+
+def test_refine_cross_correlation():
+    reference = skimage.img_as_float(skimage.data.camera())
+    shift = (3.4, -2.3)  # rows, columns
+    image = ndi.shift(reference, shift)
+    x_reference, y_reference = 250, 200
+    # a click a few pixels from where the point really is
+    x_true, y_true = x_reference + shift[1], y_reference + shift[0]
+    x, y = refine_cross_correlation(reference, x_reference, y_reference,
+                                    image, x_true + 4, y_true - 3)
+    assert np.allclose((x, y), (x_true, y_true), atol=0.25)
+
+
+def test_refine_cross_correlation_at_edge():
+    reference = skimage.img_as_float(skimage.data.camera())
+    output = refine_cross_correlation(reference, 2, 2, reference, 5, 5)
+    assert output == (5, 5)
+
+
+def test_predict_point():
+    points_from = np.array([[10, 10], [200, 15], [30, 180], [150, 160]])
+    matrix = np.array([[0.9, -0.2], [0.2, 0.9]])
+    points_to = points_from @ matrix.T + [40, -12]
+    x, y, covariance = predict_point(points_from, points_to, 100, 100)
+    assert np.allclose((x, y), np.array([100, 100]) @ matrix.T + [40, -12])
+    # exact fit: only the minimum uncertainty is left
+    assert np.allclose(covariance, 4 * np.eye(2))
+
+
+def test_predict_point_uncertainty_grows_with_residuals():
+    rng = np.random.RandomState(0)
+    points_from = rng.uniform(0, 500, size=(8, 2))
+    exact = predict_point(points_from, points_from + 5, 250, 250)[2]
+    noisy = predict_point(points_from, points_from + 5 +
+                          rng.normal(0, 3, size=(8, 2)), 250, 250)[2]
+    far = predict_point(points_from, points_from + 5 +
+                        rng.normal(0, 3, size=(8, 2)), 5000, 5000)[2]
+    assert np.trace(noisy) > np.trace(exact)
+    assert np.trace(far) > np.trace(noisy)
+    with pytest.raises(ValueError):
+        predict_point(points_from[:2], points_from[:2], 0, 0)
+
+
+def test_ellipse_parameters():
+    width, height, angle = ellipse_parameters(np.diag([1., 9.]), n_sigma=2)
+    assert np.allclose((width, height), (12, 4))
+    assert np.isclose(abs(angle), 90)
@@ -0,0 +1,109 @@
+import os
+
+from click.testing import CliRunner
+import numpy as np
+import pytest
+import skimage.data
+import skimage.transform
+import tifffile
+
+from piescope_gui import cli
+from piescope_gui.correlation.transform import save_transform, warp_image
+from piescope_gui.correlation.volume import (correlate_volume,
+                                             resize_matrix,
+                                             warp_planes,
+                                             )
+
+
+@pytest.fixture
+def volume_input(tmpdir, example_affine_matrix):
+    image = skimage.data.camera()[::8, ::8]  # 64 x 64
+    volume = np.stack([np.stack([np.roll(image, z, axis=0), image // 2])
+                       for z in range(3)])  # slices, channels, rows, columns
+    volume_filename = os.path.join(tmpdir, "Volume_test.tif")
+    tifffile.imwrite(volume_filename, volume)
+    geometry = {'resolution': [96, 128]}  # columns, rows
+    transform_filename = save_transform(
+        os.path.join(tmpdir, "correlated_image.tiff"), example_affine_matrix,
+        [], geometry=geometry)
+    return volume, volume_filename, transform_filename
+
+
+def test_resize_matrix():
+    image = skimage.data.camera()[::4, ::4].astype(float)
+    output_shape = (96, 160)
+    resized = skimage.transform.resize(image, output_shape, order=1)
+    warped = warp_image(image, resize_matrix(image.shape, output_shape),
+                        output_shape=output_shape)
+    assert np.allclose(warped[2:-2, 2:-2], resized[2:-2, 2:-2], atol=1e-6)
+
+
+def test_warp_planes_keeps_order(example_affine_matrix):
+    planes = [np.full((20, 30), i, dtype=float) for i in range(7)]
+    output = list(warp_planes(iter(planes), ("affine", np.eye(3)), (20, 30),
+                              workers=3, max_pending=2))
+    assert [plane[5, 5] for plane in output] == list(range(7))
+
+
+def test_correlate_volume(tmpdir, volume_input, example_affine_matrix):
+    volume, volume_filename, transform_filename = volume_input
+    output_filename = os.path.join(tmpdir, "aligned.tif")
+    shape = correlate_volume(volume_filename, transform_filename,
+                             output_filename, workers=2, max_pending=2)
+    assert shape == (3, 2, 128, 96)
+    output = tifffile.imread(output_filename)
+    assert output.shape == shape
+    assert output.dtype == volume.dtype
+    # compare with resizing then warping, as the correlation window does
+    resized = skimage.transform.resize(volume[1, 0].astype(float), (128, 96),
+                                       order=1, preserve_range=True)
+    expected = warp_image(resized, example_affine_matrix)
+    inside = warp_image(np.ones((128, 96)), example_affine_matrix) == 1
+    difference = np.abs(output[1, 0].astype(float) - expected)[inside]
+    assert np.median(difference) <= 1
+
+
+def test_correlate_volume_needs_fibsem_shape(tmpdir, example_affine_matrix):
+    volume_filename = os.path.join(tmpdir, "Volume_test.tif")
+    tifffile.imwrite(volume_filename, np.zeros((2, 16, 16), dtype=np.uint16))
+    transform_filename = save_transform(
+        os.path.join(tmpdir, "out.tiff"), example_affine_matrix, [])
+    output_filename = os.path.join(tmpdir, "aligned.tif")
+    with pytest.raises(ValueError):
+        correlate_volume(volume_filename, transform_filename, output_filename)
+    shape = correlate_volume(volume_filename, transform_filename,
+                             output_filename, fibsem_shape=(20, 24))
+    assert tifffile.imread(output_filename).shape == shape == (2, 20, 24)
+
+
+def test_cli_correlate_volume(tmpdir, volume_input):
+    _, volume_filename, transform_filename = volume_input
+    output_filename = os.path.join(tmpdir, "aligned.tif")
+    runner = CliRunner()
+    result = runner.invoke(cli.main, [
+        "correlate-volume", transform_filename, volume_filename,
+        "--output", output_filename, "--workers", "1"])
+    assert result.exit_code == 0, result.output
+    assert tifffile.imread(output_filename).shape == (3, 2, 128, 96)
+
+
+def test_correlate_volume_thin_plate_spline(tmpdir, volume_input,
+                                            example_affine_matrix):
+    volume, volume_filename, affine_filename = volume_input
+    # control points related by the example affine transform exactly,
+    # so the spline reduces to the same affine transform
+    src = np.array([[10., 10.], [10., 80.], [120., 20.], [100., 90.], [60., 50.]])
+    dst = src @ example_affine_matrix[:2, :2].T + example_affine_matrix[:2, 2]
+    points = [{'point_id': i, 'img1_x': s[1], 'img1_y': s[0],
+               'img2_x': d[1], 'img2_y': d[0]}
+              for i, (s, d) in enumerate(zip(src, dst))]
+    tps_filename = save_transform(
+        os.path.join(tmpdir, "tps.tiff"), example_affine_matrix, points,
+        geometry={'resolution': [96, 128]}, method='tps')
+    affine_output = os.path.join(tmpdir, "affine.tif")
+    tps_output = os.path.join(tmpdir, "tps.tif")
+    correlate_volume(volume_filename, affine_filename, affine_output)
+    correlate_volume(volume_filename, tps_filename, tps_output)
+    difference = np.abs(tifffile.imread(affine_output).astype(float) -
+                        tifffile.imread(tps_output))
+    assert difference.max() <= 1
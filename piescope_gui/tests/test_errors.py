@@ -0,0 +1,58 @@
+import threading
+
+import mock
+import pytest
+
+import piescope_gui.utils
+from piescope_gui import errors
+
+
+@pytest.fixture
+def panel(qtbot):
+    panel = errors.ErrorPanel(errors.ErrorBus())
+    qtbot.add_widget(panel)
+    return panel
+
+
+def _in_thread(function):
+    thread = threading.Thread(target=function)
+    thread.start()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_errors_from_worker_threads(qtbot, panel):
+    assert errors.in_gui_thread()
+    with qtbot.waitSignal(panel.bus.errorReported, timeout=1000) as blocker:
+        _in_thread(lambda: panel.bus.report("Camera timeout", "Live imaging"))
+    assert blocker.args[:2] == ["Camera timeout", "Live imaging"]
+    assert panel.count("Camera timeout", "Live imaging") == 1
+    assert panel.isVisible()
+    assert panel.details.toPlainText() == "Camera timeout"
+
+
+def test_repeated_errors_are_merged(panel):
+    for _ in range(3):
+        panel.add_error("Camera timeout", "Live imaging")
+    panel.add_error("Laser not found")
+    assert panel.error_list.count() == 2
+    assert panel.count("Camera timeout", "Live imaging") == 3
+    assert panel.error_list.item(1).text().endswith("Camera timeout (x3)")
+    panel.add_error("Camera timeout", "Live imaging")
+    assert panel.error_list.item(0).text().endswith("(x4)")  # moved to the top
+    panel.clear()
+    assert panel.error_list.count() == 0
+
+
+def test_display_error_message_off_gui_thread(qtbot):
+    bus = errors.ErrorBus()
+    results = []
+    with mock.patch.object(errors, 'error_bus', return_value=bus), \
+            mock.patch.object(piescope_gui.utils.QtWidgets.QErrorMessage,
+                              'exec_') as exec_:
+        with qtbot.waitSignal(bus.errorReported, timeout=1000) as blocker:
+            _in_thread(lambda: results.append(
+                piescope_gui.utils.display_error_message("Stage error")))
+    assert results == [None]
+    assert blocker.args[0] == "Stage error"
+    exec_.assert_not_called()
@@ -95,6 +95,16 @@ def test_get_last_FIB_image(window, tmpdir):
     return fig
 
 
+def test_submit_FIB_image(qtbot, window, tmpdir):
+    window.save_destination_FIBSEM = str(tmpdir)
+    job = window.submit_FIB_image()
+    qtbot.waitUntil(lambda: job.ended and window.image_ion is not None,
+                    timeout=30000)
+    assert job.status == 'done'
+    assert window.fibsem_image is job.result
+    assert window.string_list_FIBSEM == [str(tmpdir.join('I_Image.tif'))]
+
+
 @pytest.mark.mpl_image_compare
 def test_get_SEM_image(window):
     image = window.get_SEM_image()
@@ -0,0 +1,141 @@
+import threading
+import time
+
+import mock
+import pytest
+
+from piescope_gui import errors
+from piescope_gui.lasers import LaserController
+
+
+class RecordingLaser:
+    """Records every laser power written, and the thread writing it."""
+    def __init__(self, name, fail=False):
+        self.NAME = name
+        self.fail = fail
+        self.writes = []
+        self.emission = False
+        self.write_started = threading.Event()
+        self.finish_write = threading.Event()
+        self.finish_write.set()
+        self._power = 0.
+
+    def emission_on(self):
+        self.emission = True
+
+    def emission_off(self):
+        self.emission = False
+
+    @property
+    def laser_power(self):
+        return self._power
+
+    @laser_power.setter
+    def laser_power(self, power):
+        self.write_started.set()
+        self.finish_write.wait(5)
+        if self.fail:
+            raise IOError("Serial port write timeout")
+        self.writes.append((power, threading.current_thread().name))
+        self._power = power
+
+
+@pytest.fixture
+def lasers():
+    return {name: RecordingLaser(name) for name in ("laser640", "laser488")}
+
+
+@pytest.fixture
+def controller(lasers):
+    controller = LaserController(lasers, debounce=0.05, max_delay=1)
+    yield controller
+    controller.stop(timeout=5)
+
+
+def test_slider_drag_is_coalesced(lasers, controller):
+    for power in range(1, 51):  # dragging the slider
+        controller.set_power("laser640", power)
+    assert controller.power("laser640") == 50
+    assert lasers["laser640"].writes == []  # still moving
+    assert controller.flush(timeout=5)
+    assert lasers["laser640"].writes == [(50., 'Laser commands')]
+    assert lasers["laser488"].writes == []
+
+
+def test_debounce_and_max_delay(lasers):
+    controller = LaserController(lasers, debounce=0.05, max_delay=0.2)
+    try:
+        start = time.monotonic()
+        while time.monotonic() - start < 0.5:  # never stops moving
+            controller.set_power("laser488", time.monotonic() - start)
+            time.sleep(0.01)
+        assert 1 <= len(lasers["laser488"].writes) <= 4
+        time.sleep(0.2)  # stopped moving
+        assert controller.pending() == {}
+    finally:
+        controller.stop(timeout=5)
+
+
+def test_unchanged_powers_are_not_sent(lasers, controller):
+    assert controller.apply_power("laser640", 5, timeout=5)
+    controller.set_power("laser640", 7)
+    controller.set_power("laser640", 5)  # back where it was
+    assert controller.pending() == {}
+    assert controller.apply_power("laser640", 5, timeout=5)
+    assert controller.commands_sent == 1
+    controller.invalidate()  # e.g. after piescope's volume acquisition
+    assert controller.apply_power("laser640", 5, timeout=5)
+    assert [power for power, _ in lasers["laser640"].writes] == [5., 5.]
+
+
+def test_apply_powers(lasers, controller):
+    assert controller.apply_powers({"laser640": 3, "laser488": 4}, timeout=5)
+    assert lasers["laser640"].laser_power == 3
+    assert lasers["laser488"].laser_power == 4
+    assert controller.commands_sent == 2
+
+
+def test_failed_commands_are_reported(qtbot):
+    controller = LaserController({"laser561": RecordingLaser("laser561", fail=True)})
+    bus = errors.ErrorBus()
+    try:
+        with mock.patch.object(errors, 'error_bus', return_value=bus):
+            with qtbot.waitSignal(bus.errorReported, timeout=5000) as blocker:
+                assert not controller.apply_power("laser561", 3, timeout=5)
+        assert blocker.args[1] == "Laser laser561"
+        assert "Serial port write timeout" in blocker.args[0]
+        assert controller.pending() == {}  # not retried
+    finally:
+        controller.stop(timeout=5)
+
+
+def test_stop_sends_pending_powers(lasers):
+    controller = LaserController(lasers, debounce=10, max_delay=10)
+    controller.set_power("laser640", 2)
+    controller.stop(timeout=5)
+    assert lasers["laser640"].laser_power == 2
+    with pytest.raises(RuntimeError):
+        controller.set_power("laser640", 3)
+
+    controller = LaserController(lasers)
+    with pytest.raises(KeyError):
+        controller.set_power("laser405", 1)
+    controller.stop(timeout=5)
+
+
+def test_emission_waits_for_power_commands(lasers, controller):
+    laser = lasers["laser640"]
+    laser.finish_write.clear()  # a slow serial port
+    controller.set_power("laser640", 3)
+    assert controller.flush(timeout=0) is False
+    assert laser.write_started.wait(5)
+    emission = threading.Thread(target=controller.emission_on,
+                                args=("laser640",))
+    emission.start()
+    emission.join(0.1)
+    assert emission.is_alive() and not laser.emission
+    laser.finish_write.set()
+    emission.join(5)
+    assert laser.emission
+    controller.emission_off("laser640")
+    assert not laser.emission
@@ -1,9 +1,10 @@
 import os
 import mock
 
+import numpy as np
 import pytest
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QDialog
+from PyQt5.QtCore import Qt, QThread
+from PyQt5.QtWidgets import QApplication, QDialog
 
 from piescope_gui import main
 
@@ -61,6 +62,20 @@ def test_open_images_FIBSEM(window, qtbot):
         mock_open.assert_called_with('FIBSEM')
 
 
+def test_open_images_FIBSEM_replaces_acquired_image(window, tmpdir):
+    """The last acquired image must not describe an opened image."""
+    import skimage.io
+    filename = str(tmpdir.join('opened.tif'))
+    skimage.io.imsave(filename, np.zeros((20, 30), dtype=np.uint8))
+    window.fibsem_image = mock.Mock(data=np.zeros((40, 60)))
+    with mock.patch.object(main.QtWidgets.QFileDialog, 'getOpenFileNames',
+                           return_value=([filename], '')):
+        window.open_images('FIBSEM')
+    assert window.array_list_FIBSEM.shape == (20, 30)
+    assert not hasattr(window.fibsem_image, 'data') or \
+        window.fibsem_image.data.shape == (20, 30)
+
+
 def test_about_dialog(window, qtbot, mocker):
     """Test the About item of the Help submenu.
 
@@ -94,3 +109,20 @@ def test_fill_destination(window, tmpdir, modality):
             assert window.correlation_output_path.text() == expected
         else:
             assert False  # should never reach this case, fail test if so.
+
+
+def test_live_imaging_frames_shown_in_gui_thread(window, qtbot):
+    """Check the live imaging worker thread leaves the widgets to the GUI."""
+    shown_in = []
+    window.liveFrameReady.connect(
+        lambda image, metadata: shown_in.append(QThread.currentThread()))
+    frame = np.zeros((1200, 1920), dtype=np.uint8)
+    with mock.patch.object(window.detector, 'camera_grab', return_value=frame):
+        with qtbot.waitSignal(window.liveFrameReady, timeout=5000):
+            window.fluorescence_live_imaging("640nm", 1, 1)
+        assert window.liveCheck is False
+        with qtbot.waitSignal(window.liveImagingStopped, timeout=5000):
+            window.fluorescence_live_imaging("640nm", 1, 1)  # stop
+    qtbot.waitUntil(lambda: window.liveCheck is True)
+    assert shown_in[0] is QApplication.instance().thread()
+    assert window.array_list_FM.shape[:2] == frame.shape
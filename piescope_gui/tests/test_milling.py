@@ -0,0 +1,430 @@
+import itertools
+import time
+from types import SimpleNamespace
+
+import mock
+import numpy as np
+import pytest
+from PyQt5.QtWidgets import QMainWindow
+import scipy.ndimage as ndi
+import skimage.data
+
+from piescope_gui import milling, resources
+
+
+@pytest.fixture
+def adorned_image():
+    metadata = SimpleNamespace(
+        binary_result=SimpleNamespace(
+            pixel_size=SimpleNamespace(x=1e-8, y=1e-8)))
+    return SimpleNamespace(data=np.zeros((400, 600)), metadata=metadata)
+
+
+class FakePatterning:
+    def __init__(self):
+        self.state = "Idle"
+        self.patterns = []
+        self.batches = []
+
+    def clear_patterns(self):
+        self.patterns = []
+
+    def create_rectangle(self, center_x, center_y, width, height, depth):
+        pattern = SimpleNamespace(center_x=center_x, center_y=center_y,
+                                  width=width, height=height, depth=depth,
+                                  time=10.)
+        self.patterns.append(pattern)
+        return pattern
+
+    def start(self):
+        self.batches.append(list(self.patterns))
+        self.state = "Running"
+
+    def pause(self):
+        self.state = "Paused"
+
+    def resume(self):
+        self.state = "Running"
+
+
+@pytest.fixture
+def microscope():
+    beam_current = SimpleNamespace(value=1e-9)
+    return SimpleNamespace(
+        patterning=FakePatterning(),
+        beams=SimpleNamespace(ion_beam=SimpleNamespace(beam_current=beam_current)))
+
+
+def test_pattern_from_pixels(adorned_image):
+    pattern = milling.pattern_from_pixels(adorned_image, 350, 250, 100, 150,
+                                          depth=2e-6)
+    assert np.isclose(pattern.center_x, 0)
+    assert np.isclose(pattern.center_y, 75 * 1e-8)  # above the image centre
+    assert np.isclose(pattern.width, 100 * 1e-8)
+    assert np.isclose(pattern.height, 50 * 1e-8)
+    assert pattern.depth == 2e-6
+    x, y, width, height = milling.pattern_to_pixels(pattern, adorned_image)
+    assert np.allclose((x, y, width, height), (250, 100, 100, 50))
+
+
+def test_create_patterns(microscope):
+    patterns = [milling.MillingPattern(0, 0, 1e-6, 2e-6, depth=3e-6),
+                milling.MillingPattern(1e-6, 0, 1e-6, 1e-6)]
+    microscope.patterning.patterns = ['old pattern']
+    created = milling.create_patterns(microscope, patterns)
+    assert microscope.patterning.patterns == created
+    assert [p.depth for p in created] == [3e-6, 1e-6]
+
+
+def test_lamella_template(adorned_image):
+    patterns = milling.template_patterns(
+        'lamella', adorned_image, 300, 100, width=10e-6, thickness=1e-6,
+        trench_height=4e-6, polishing_passes=2, polishing_step=0.25e-6)
+    assert len(patterns) == 6
+    upper, lower = patterns[:2]
+    assert np.allclose((upper.center_x, upper.center_y), (0, 1e-6 + 3e-6))
+    assert np.allclose((lower.center_x, lower.center_y), (0, 1e-6 - 3e-6))
+    assert (upper.scan_direction, lower.scan_direction) == (
+        'TopToBottom', 'BottomToTop')
+    # polishing passes fill the gap between the trenches and the lamella
+    polish = patterns[2:]
+    assert np.allclose([p.center_y - 1e-6 for p in polish],
+                       [0.875e-6, -0.875e-6, 0.625e-6, -0.625e-6])
+    assert all(np.isclose(p.height, 0.25e-6) for p in polish)
+    top = upper.center_y - upper.height / 2 - 1e-6
+    assert np.isclose(top, max(p.center_y + p.height / 2 for p in polish) - 1e-6)
+
+
+def test_undercut_template(adorned_image):
+    bottom, left, right = milling.template_patterns(
+        'undercut', adorned_image, 300, 200, width=10e-6, thickness=1e-6,
+        line_width=0.5e-6)
+    assert np.isclose(bottom.center_y + bottom.height / 2, -0.5e-6)
+    assert np.isclose(left.center_x + left.width / 2, -5e-6)
+    assert np.isclose(right.center_x - right.width / 2, 5e-6)
+    with pytest.raises(ValueError):
+        milling.template_patterns('trench', adorned_image, 0, 0)
+
+
+def test_template_created_in_one_batch(qtbot, adorned_image, microscope):
+    parent = QMainWindow()
+    parent.microscope = microscope
+    qtbot.add_widget(parent)
+    window = milling.open_milling_window(parent, adorned_image.data,
+                                         adorned_image)
+    window.template_combobox.setCurrentIndex(1)  # lamella
+    window.on_click(SimpleNamespace(button=1, inaxes=True, xdata=300, ydata=200))
+    window.on_release(SimpleNamespace(button=1))
+    assert len(window._template_patches) == 6
+    assert window.estimate_label.text() != "Estimated time: -"
+    window.add_milling_pattern()
+    assert len(window.queue) == 6
+    assert window.queue[0].name == "Lamella 1 upper trench"
+    with mock.patch.object(milling, 'PATTERNING_POLL_INTERVAL', 0.01):
+        window.start_patterning()
+    assert len(microscope.patterning.batches) == 1
+    created = microscope.patterning.batches[0]
+    assert len(created) == 6
+    assert created[0].scan_direction == 'TopToBottom'
+    window.close()
+
+
+def test_group_by_current():
+    patterns = [milling.MillingPattern(0, 0, 1, 1, current=current)
+                for current in [1e-9, 1e-9, None, 1e-9]]
+    groups = milling.group_by_current(patterns)
+    assert [(current, len(group)) for current, group in groups] == [
+        (1e-9, 2), (None, 1), (1e-9, 1)]
+
+
+def test_estimate_milling_time():
+    # 10 x 10 x 2.7 µm of silicon at 1 nA: 270 µm^3 / 0.27 µm^3/nC = 1000 nC
+    pattern = milling.MillingPattern(0, 0, 10e-6, 10e-6, depth=2.7e-6)
+    assert np.isclose(milling.estimate_milling_time(pattern, current=1e-9), 1000)
+    assert np.isclose(milling.estimate_milling_time(
+        pattern, current=1e-9, material='Au'), 1000 * 0.27 / 1.5)
+    # the pattern's own current takes precedence
+    pattern.current = 2e-9
+    assert np.isclose(milling.estimate_milling_time(pattern, current=1e-9), 500)
+    assert np.isclose(milling.estimate_queue_time([pattern, pattern]), 1000)
+    with pytest.raises(ValueError):
+        milling.estimate_milling_time(pattern, material='unobtainium')
+    pattern.current = None
+    with pytest.raises(ValueError):
+        milling.estimate_milling_time(pattern)
+
+
+@pytest.mark.parametrize("seconds, expected", [
+    (5.4, "5 s"), (125, "2 min 05 s"), (7260, "2 h 01 min")])
+def test_format_duration(seconds, expected):
+    assert milling.format_duration(seconds) == expected
+
+
+def test_milling_queue(qtbot, adorned_image, microscope):
+    parent = QMainWindow()
+    parent.microscope = microscope
+    qtbot.add_widget(parent)
+    window = milling.open_milling_window(parent, adorned_image.data,
+                                         adorned_image)
+    for current in [0.1, 0.1, 0.03]:
+        window.current_spinbox.setValue(current)
+        window.xclick, window.yclick, window.x1, window.y1 = 10, 10, 50, 30
+        window.add_milling_pattern()
+    assert window.queue_table.rowCount() == 3
+    window.queue_table.item(1, 3).setText("2.5")
+    assert np.isclose(window.queue[1].depth, 2.5e-6)
+    assert window.queue_table.item(1, 5).text() != '?'
+
+    with mock.patch.object(milling, 'PATTERNING_POLL_INTERVAL', 0.01):
+        window.start_patterning()
+        # the first batch mills both 0.1 nA patterns together
+        assert len(microscope.patterning.batches) == 1
+        assert len(microscope.patterning.batches[0]) == 2
+        assert np.isclose(microscope.beams.ion_beam.beam_current.value, 0.1e-9)
+        qtbot.waitUntil(lambda: "remaining" in window.progress_label.text())
+        microscope.patterning.state = "Idle"
+        qtbot.waitUntil(lambda: len(microscope.patterning.batches) == 2)
+        assert np.isclose(microscope.beams.ion_beam.beam_current.value, 0.03e-9)
+        qtbot.waitUntil(lambda: "remaining" in window.progress_label.text())
+        microscope.patterning.state = "Idle"
+        qtbot.waitUntil(lambda: window._poller is None)
+    window.close()
+
+
+def test_patterning_poller_waits_for_start(qtbot):
+    patterning = SimpleNamespace(state="Idle")  # start() not yet effective
+    microscope = SimpleNamespace(patterning=patterning)
+    poller = milling._PatterningPoller(microscope, interval=0.01,
+                                       start_timeout=5)
+    states = []
+    poller.polled.connect(lambda state, running_time: states.append(state))
+    poller.start()
+    qtbot.waitUntil(lambda: len(states) >= 3)
+    patterning.state = "Running"
+    qtbot.waitUntil(lambda: "Running" in states)
+    patterning.state = "Idle"
+    qtbot.waitUntil(lambda: "Idle" in states)
+    poller.stop()
+    poller.wait()
+    assert set(states[:states.index("Running")]) == {"Starting"}
+
+    # patterns too short to be seen running
+    poller = milling._PatterningPoller(microscope, interval=0.01,
+                                       start_timeout=0.05)
+    states = []
+    poller.polled.connect(lambda state, running_time: states.append(state))
+    poller.start()
+    qtbot.waitUntil(lambda: "Idle" in states)
+    poller.stop()
+    poller.wait()
+    assert states[0] == "Starting"
+
+
+def test_milling_estimate_updates_while_dragging(qtbot, adorned_image,
+                                                 microscope):
+    parent = QMainWindow()
+    parent.microscope = microscope
+    qtbot.add_widget(parent)
+    window = milling.open_milling_window(parent, adorned_image.data,
+                                         adorned_image)
+    assert window.beam_current == 1e-9
+    window.xclick, window.yclick = 100, 100
+    event = SimpleNamespace(button=1, xdata=200, ydata=150)
+    window.on_motion(event)
+    # 1 x 0.5 x 1 µm of silicon at the beam's 1 nA
+    assert window.estimate_label.text() == "Estimated time: 2 s"
+    window.on_motion(SimpleNamespace(button=1, xdata=400, ydata=350))
+    assert window.estimate_label.text() == "Estimated time: 28 s"
+    window.close()
+
+
+def test_milling_drift_compensation(qtbot, adorned_image, microscope):
+    parent = QMainWindow()
+    parent.microscope = microscope
+    qtbot.add_widget(parent)
+    window = milling.open_milling_window(parent, adorned_image.data,
+                                         adorned_image)
+    window.xclick, window.yclick, window.x1, window.y1 = 10, 10, 50, 30
+    window.add_milling_pattern()
+    center_x = window.queue[0].center_x
+    window.drift_checkbox.setChecked(True)
+    window.drift_combobox.setCurrentIndex(1)  # shift patterns
+    reference = skimage.data.camera()[::2, ::2].astype(float)
+    images = iter([reference, ndi.shift(reference, (0, 4))])
+    metadata = adorned_image.metadata
+
+    def acquire():
+        return SimpleNamespace(data=next(images), metadata=metadata)
+
+    with mock.patch.object(milling.monitoring, 'ion_image_acquisition',
+                           return_value=acquire), \
+            mock.patch.object(milling.monitoring, 'DRIFT_INTERVAL', 0.01):
+        window.start_patterning()
+        qtbot.waitUntil(lambda: window.drift_label.text() != "")
+    assert np.isclose(window.queue[0].center_x - center_x, 4e-8, atol=5e-9)
+    assert np.isclose(window._created[0].center_x - center_x, 4e-8, atol=5e-9)
+    window.close()
+
+
+def test_milling_endpoint_pauses(qtbot, adorned_image, microscope):
+    parent = QMainWindow()
+    parent.microscope = microscope
+    qtbot.add_widget(parent)
+    window = milling.open_milling_window(parent, adorned_image.data,
+                                         adorned_image)
+    window.xclick, window.yclick, window.x1, window.y1 = 250, 150, 350, 250
+    window.add_milling_pattern()
+    window.current_spinbox.setValue(0.03)
+    window.add_milling_pattern()  # a second batch, which must not start
+    window.endpoint_checkbox.setChecked(True)
+    window.endpoint_threshold_spinbox.setValue(-30)
+    image = np.full((400, 600), 100.)
+    milled = image.copy()
+    milled[150:250, 250:350] = 50.
+    images = iter([image, image, milled])
+    metadata = adorned_image.metadata
+
+    def acquire():
+        return SimpleNamespace(data=next(images), metadata=metadata)
+
+    with mock.patch.object(milling.monitoring, 'electron_image_acquisition',
+                           return_value=acquire), \
+            mock.patch.object(milling.monitoring, 'ENDPOINT_INTERVAL', 0.01):
+        window.start_patterning()
+        qtbot.waitUntil(lambda: microscope.patterning.state == "Paused")
+        qtbot.waitUntil(lambda: "endpoint reached" in
+                        window.endpoint_label.text())
+    assert "-50.0 %" in window.endpoint_label.text()
+    assert window._stages == []
+    assert len(microscope.patterning.batches) == 1
+    window.close()
+
+
+def test_milling_endpoint_between_batches(qtbot, adorned_image, microscope):
+    parent = QMainWindow()
+    parent.microscope = microscope
+    qtbot.add_widget(parent)
+    window = milling.open_milling_window(parent, adorned_image.data,
+                                         adorned_image)
+    window.xclick, window.yclick, window.x1, window.y1 = 250, 150, 350, 250
+    window.add_milling_pattern()
+    window.current_spinbox.setValue(0.03)
+    window.add_milling_pattern()  # a second batch, which must not start
+    window.endpoint_checkbox.setChecked(True)
+    window.endpoint_threshold_spinbox.setValue(-30)
+    image = np.full((400, 600), 100.)
+    milled = image.copy()
+    milled[150:250, 250:350] = 50.
+    images = itertools.chain([image, image], itertools.repeat(milled))
+    metadata = adorned_image.metadata
+
+    def acquire():
+        data = next(images)
+        if data is milled:
+            microscope.patterning.state = "Idle"  # the first batch finished
+        return SimpleNamespace(data=data, metadata=metadata)
+
+    manager = resources.resource_manager()
+    with mock.patch.object(milling.monitoring, 'electron_image_acquisition',
+                           return_value=acquire), \
+            mock.patch.object(milling.monitoring, 'ENDPOINT_INTERVAL', 0.01):
+        window.start_patterning()
+        control = window.patterning_control()
+        deadline = time.monotonic() + 5
+        while not control.pause_requested and time.monotonic() < deadline:
+            time.sleep(0.01)  # endpointMeasured stays queued
+        assert control.pause_requested
+        # the Idle poll is handled before the endpoint measurement
+        with mock.patch.object(window, 'sender', return_value=window._poller):
+            window.patterning_polled("Idle", 1.)
+        qtbot.wait(100)
+    assert window._stages == []
+    assert len(microscope.patterning.batches) == 1
+    assert resources.ION_BEAM not in manager.holders()
+    window.close()
+
+
+def test_no_batch_starts_after_pause(qtbot, adorned_image, microscope):
+    parent = QMainWindow()
+    parent.microscope = microscope
+    qtbot.add_widget(parent)
+    window = milling.open_milling_window(parent, adorned_image.data,
+                                         adorned_image)
+    window.xclick, window.yclick, window.x1, window.y1 = 10, 10, 50, 30
+    window.add_milling_pattern()
+    window.current_spinbox.setValue(0.03)
+    window.add_milling_pattern()
+    window.start_patterning()
+    window.stop_poller()
+    microscope.patterning.state = "Idle"  # between batches
+    window.patterning_control().pause()  # the user clicks Pause
+    window.start_next_batch()
+    assert len(microscope.patterning.batches) == 1
+    assert window._stages == []
+    assert resources.ION_BEAM not in resources.resource_manager().holders()
+    assert "cancelled" in window.progress_label.text()
+    window.close()
+
+
+def test_milling_monitors_share_pauses(qtbot, adorned_image, microscope):
+    parent = QMainWindow()
+    parent.microscope = microscope
+    qtbot.add_widget(parent)
+    window = milling.open_milling_window(parent, adorned_image.data,
+                                         adorned_image)
+    window.xclick, window.yclick, window.x1, window.y1 = 250, 150, 350, 250
+    window.add_milling_pattern()
+    window.drift_checkbox.setChecked(True)
+    window.endpoint_checkbox.setChecked(True)
+    window.endpoint_beam_combobox.setCurrentIndex(1)  # ion beam images
+    window.endpoint_threshold_spinbox.setValue(-30)
+    reference = skimage.data.camera()[::2, ::2].astype(float)
+    image = np.full((400, 600), 100.)
+    milled = image.copy()
+    milled[150:250, 250:350] = 50.
+    streams = [itertools.repeat(reference),  # drift tracking
+               itertools.chain([image, image], itertools.repeat(milled))]
+    metadata = adorned_image.metadata
+    controls = []
+
+    def ion_image_acquisition(microscope, control=None):
+        images = streams[len(controls)]
+        controls.append(control)
+
+        def acquire():
+            with control.paused():
+                return SimpleNamespace(data=next(images), metadata=metadata)
+        return acquire
+
+    with mock.patch.object(milling.monitoring, 'ion_image_acquisition',
+                           ion_image_acquisition), \
+            mock.patch.object(milling.monitoring, 'DRIFT_INTERVAL', 0.01), \
+            mock.patch.object(milling.monitoring, 'ENDPOINT_INTERVAL', 0.01):
+        window.start_patterning()
+        qtbot.waitUntil(lambda: "endpoint reached" in
+                        window.endpoint_label.text())
+        qtbot.wait(200)  # drift images keep coming
+        assert microscope.patterning.state == "Paused"
+    assert controls[0] is controls[1]
+    window.close()
+
+
+def test_milling_leases_ion_beam(qtbot, adorned_image, microscope):
+    parent = QMainWindow()
+    parent.microscope = microscope
+    qtbot.add_widget(parent)
+    window = milling.open_milling_window(parent, adorned_image.data,
+                                         adorned_image)
+    manager = resources.resource_manager()
+    with mock.patch.object(milling, 'PATTERNING_POLL_INTERVAL', 0.01):
+        with manager.lease(resources.ION_BEAM, owner="Ion beam image"):
+            with mock.patch.object(milling, 'display_error_message') as error:
+                window.start_patterning()
+            error.assert_called_once()
+            assert microscope.patterning.batches == []
+        window.start_patterning()
+        assert manager.holders()[resources.ION_BEAM] == "Milling"
+        qtbot.waitUntil(lambda: "Running" in window.progress_label.text())
+        microscope.patterning.state = "Idle"
+        qtbot.waitUntil(lambda: resources.ION_BEAM not in manager.holders())
+    window.close()
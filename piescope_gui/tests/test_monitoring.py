@@ -0,0 +1,229 @@
+import csv
+import os
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import scipy.ndimage as ndi
+import skimage.data
+
+from piescope_gui import monitoring
+
+
+@pytest.fixture
+def reference():
+    return skimage.img_as_float(skimage.data.camera()[::2, ::2])
+
+
+def adorned(data, pixel_size=1e-8):
+    metadata = SimpleNamespace(binary_result=SimpleNamespace(
+        pixel_size=SimpleNamespace(x=pixel_size, y=pixel_size)))
+    return SimpleNamespace(data=data, metadata=metadata)
+
+
+@pytest.mark.parametrize("shift", [(0, 0), (3, -7), (-2.4, 5.6)])
+def test_phase_correlation(reference, shift):
+    image = ndi.shift(reference, shift, mode='nearest')
+    rows, columns, peak = monitoring.phase_correlation(reference, image)
+    assert np.allclose((rows, columns), shift, atol=0.3)
+    assert peak > 0.1
+
+
+def test_phase_correlation_shape_mismatch(reference):
+    with pytest.raises(ValueError):
+        monitoring.phase_correlation(reference, reference[:-1])
+
+
+def test_drift_tracker_shift_patterns(reference):
+    tracker = monitoring.DriftTracker(compensation='patterns')
+    assert tracker.update(adorned(reference), timestamp=0) is None
+    first = tracker.update(adorned(ndi.shift(reference, (2, 3))), timestamp=1)
+    assert np.allclose((first['drift_rows'], first['drift_columns']), (2, 3),
+                       atol=0.3)
+    assert np.isclose(first['drift_x'], first['drift_columns'] * 1e-8)
+    assert np.isclose(first['drift_y'], -first['drift_rows'] * 1e-8)
+    assert np.allclose((first['correction_rows'], first['correction_columns']),
+                       (first['drift_rows'], first['drift_columns']))
+    # the images are not re-centred, so only the change is corrected
+    second = tracker.update(adorned(ndi.shift(reference, (2, 5))), timestamp=2)
+    assert np.isclose(second['correction_columns'], 2, atol=0.3)
+    assert np.isclose(second['correction_rows'], 0, atol=0.3)
+    assert len(tracker.history) == 2
+
+
+def test_drift_tracker_shift_beam(reference):
+    tracker = monitoring.DriftTracker(reference, compensation='beam')
+    tracker.update(ndi.shift(reference, (0, 4)))
+    # after the beam shift, only residual drift is left in the image
+    measurement = tracker.update(ndi.shift(reference, (0, 1)))
+    assert np.isclose(measurement['drift_columns'], 5, atol=0.3)
+    assert np.isclose(measurement['correction_columns'], 1, atol=0.3)
+    assert measurement['drift_x'] is None  # no pixel size metadata
+
+
+def test_drift_tracker_ignores_small_shifts(reference):
+    tracker = monitoring.DriftTracker(reference, compensation='patterns',
+                                      minimum_shift=1)
+    measurement = tracker.update(ndi.shift(reference, (0.3, 0.2)))
+    assert measurement['correction_rows'] == measurement['correction_columns'] == 0
+    with pytest.raises(ValueError):
+        monitoring.DriftTracker(compensation='unknown')
+
+
+def test_drift_tracker_save_history(tmpdir, reference):
+    tracker = monitoring.DriftTracker(reference)
+    tracker.update(reference, timestamp=5)
+    filename = tracker.save_history(os.path.join(tmpdir, "drift.csv"))
+    with open(filename) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 1
+    assert float(rows[0]['time']) == 5
+
+
+def test_shift_patterns():
+    patterns = [SimpleNamespace(center_x=0., center_y=1e-6)]
+    monitoring.shift_patterns(patterns, 1e-7, -2e-7)
+    assert np.allclose((patterns[0].center_x, patterns[0].center_y),
+                       (1e-7, 8e-7))
+
+
+def test_footprint():
+    pattern = SimpleNamespace(center_x=1e-6, center_y=5e-7,
+                              width=4e-7, height=2e-7)
+    rows, columns = monitoring.footprint(pattern, (400, 600), 1e-8)
+    assert (rows.start, rows.stop) == (140, 160)
+    assert (columns.start, columns.stop) == (380, 420)
+    large = SimpleNamespace(center_x=0, center_y=0, width=1e-5, height=1e-5)
+    rows, columns = monitoring.footprint(large, (400, 600), 1e-8)
+    assert (rows.start, rows.stop, columns.start, columns.stop) == (
+        0, 400, 0, 600)
+    assert len(range(400)[rows]) <= monitoring.ENDPOINT_MAX_SIZE
+
+
+def test_endpoint_metric():
+    baseline = np.full((10, 10), 100.)
+    darker = baseline - 20
+    assert np.isclose(monitoring.endpoint_metric(darker, baseline), -0.2)
+    assert np.isclose(
+        monitoring.endpoint_metric(darker, baseline, 'change'), 0.2)
+    with pytest.raises(ValueError):
+        monitoring.endpoint_metric(darker, baseline, 'unknown')
+
+
+@pytest.mark.parametrize("threshold, value", [(-0.3, 60.), (0.3, 140.)])
+def test_endpoint_monitor(threshold, value):
+    pattern = SimpleNamespace(center_x=0, center_y=0, width=2e-7, height=2e-7)
+    paused = []
+    monitor = monitoring.EndpointMonitor([pattern], threshold,
+                                         pause=lambda: paused.append(True))
+    image = np.full((100, 100), 100.)
+    assert monitor.update(adorned(image)) is None
+    assert monitor.update(adorned(image))['triggered'] is False
+    milled = image.copy()
+    milled[40:60, 40:60] = value
+    milled[:10] = 0  # outside the pattern
+    measurement = monitor.update(adorned(milled))
+    assert measurement['triggered']
+    assert np.isclose(measurement['value'], value / 100 - 1)
+    # only the first crossing triggers, and pauses once
+    assert monitor.update(adorned(milled))['triggered'] is False
+    assert paused == [True]
+    assert len(monitor.history) == 3
+    with pytest.raises(ValueError):
+        monitoring.EndpointMonitor([pattern], 0.1, metric='unknown')
+
+
+def test_periodic_acquisition():
+    images = []
+    done = threading.Event()
+
+    def process(image):
+        images.append(image)
+        if len(images) == 3:
+            done.set()
+
+    counter = iter(range(100))
+    acquisition = monitoring.PeriodicAcquisition(lambda: next(counter),
+                                                 process, interval=0.01)
+    acquisition.start()
+    assert done.wait(5)
+    acquisition.stop()
+    assert not acquisition.running
+    assert images[:3] == [0, 1, 2]
+
+
+def test_periodic_acquisition_survives_errors():
+    done = threading.Event()
+
+    def acquire():
+        if done.is_set():
+            return None
+        done.set()
+        raise RuntimeError("microscope disconnected")
+
+    processed = threading.Event()
+    acquisition = monitoring.PeriodicAcquisition(
+        acquire, lambda image: processed.set(), interval=0.01)
+    acquisition.start()
+    assert processed.wait(5)
+    acquisition.stop()
+    assert acquisition.errors == 1
+
+
+class FakePatterning:
+    def __init__(self):
+        self.state = "Running"
+
+    def pause(self):
+        self.state = "Paused"
+
+    def resume(self):
+        self.state = "Running"
+
+
+def test_patterning_control_keeps_requested_pause():
+    microscope = SimpleNamespace(patterning=FakePatterning())
+    control = monitoring.PatterningControl(microscope)
+    with control.paused():
+        assert microscope.patterning.state == "Paused"
+    assert microscope.patterning.state == "Running"
+    with control.paused():
+        control.pause()  # by the user, while a monitoring image is taken
+    assert microscope.patterning.state == "Paused"
+    with control.paused():
+        pass
+    assert microscope.patterning.state == "Paused"
+    control.resume()
+    assert microscope.patterning.state == "Running"
+
+
+def test_patterning_control_serializes_monitors():
+    microscope = SimpleNamespace(patterning=FakePatterning())
+    control = monitoring.PatterningControl(microscope)
+    imaging = threading.Event()
+    finish = threading.Event()
+    states = []
+
+    def drift_image():
+        with control.paused():
+            states.append(microscope.patterning.state)
+            imaging.set()
+            finish.wait(5)
+
+    def endpoint_image():
+        with control.paused():
+            states.append(microscope.patterning.state)
+
+    drift = threading.Thread(target=drift_image)
+    drift.start()
+    assert imaging.wait(5)
+    endpoint = threading.Thread(target=endpoint_image)
+    endpoint.start()
+    endpoint.join(0.1)
+    assert endpoint.is_alive()  # waits for the drift image
+    finish.set()
+    drift.join(5)
+    endpoint.join(5)
+    assert states == ["Paused", "Paused"]
+    assert microscope.patterning.state == "Running"
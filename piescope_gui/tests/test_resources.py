@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+from piescope_gui import resources
+from piescope_gui.resources import (CAMERA, ELECTRON_BEAM, LASERS,
+                                    OBJECTIVE_STAGE, ResourceBusyError,
+                                    ResourceManager)
+
+
+@pytest.fixture
+def manager():
+    return ResourceManager()
+
+
+def test_independent_leases(manager):
+    with manager.lease(CAMERA, LASERS, owner="Live imaging"):
+        with manager.lease(ELECTRON_BEAM, owner="Electron beam image"):
+            assert manager.holders() == {CAMERA: "Live imaging",
+                                         LASERS: "Live imaging",
+                                         ELECTRON_BEAM: "Electron beam image"}
+    assert manager.holders() == {}
+
+
+def test_busy_without_waiting(manager):
+    with manager.lease(CAMERA, LASERS, owner="Live imaging"):
+        assert not manager.available(CAMERA)
+        with pytest.raises(ResourceBusyError) as error:
+            manager.lease(CAMERA, LASERS, OBJECTIVE_STAGE,
+                          owner="Volume acquisition", blocking=False)
+        assert str(error.value) == ("Volume acquisition can't start: the "
+                                    "camera and lasers are in use by Live imaging")
+        assert manager.available(OBJECTIVE_STAGE)  # not partly leased
+    assert manager.available(CAMERA, LASERS, OBJECTIVE_STAGE)
+
+
+def test_conflicting_leases_wait_in_order(manager):
+    first = manager.lease(CAMERA, owner="first")
+    order = []
+
+    def worker(name, delay):
+        time.sleep(delay)
+        with manager.lease(CAMERA, owner=name):
+            order.append(name)
+
+    threads = [threading.Thread(target=worker, args=(name, delay))
+               for name, delay in [("second", 0), ("third", 0.05)]]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    assert order == []
+    first.release()
+    first.release()  # releasing twice does nothing
+    for thread in threads:
+        thread.join(timeout=5)
+    assert order == ["second", "third"]
+
+
+def test_timeout_and_cancel(manager):
+    manager.lease(CAMERA)
+    with pytest.raises(ResourceBusyError):
+        manager.lease(CAMERA, timeout=0.05)
+    cancel = threading.Event()
+    threading.Timer(0.05, cancel.set).start()
+    start = time.time()
+    with pytest.raises(ResourceBusyError):
+        manager.lease(CAMERA, cancel=cancel)
+    assert time.time() - start < 2
+
+
+def test_unknown_resource(manager):
+    with pytest.raises(ValueError):
+        manager.lease("shutter")
+
+
+def test_leased_decorator(monkeypatch, manager):
+    monkeypatch.setattr(resources, '_resource_manager', manager)
+    busy = []
+
+    @resources.leased(CAMERA, owner="Fluorescence image", on_busy=busy.append)
+    def acquire():
+        return manager.holders()
+
+    assert acquire() == {CAMERA: "Fluorescence image"}
+    with manager.lease(CAMERA, owner="Live imaging"):
+        assert acquire() is None
+    assert busy == ["Fluorescence image can't start: "
+                    "the camera is in use by Live imaging"]
@@ -0,0 +1,126 @@
+import threading
+
+import mock
+import pytest
+
+from piescope_gui import errors, scheduler
+from piescope_gui.resources import (CAMERA, ELECTRON_BEAM, LASERS,
+                                    ResourceManager)
+
+
+@pytest.fixture
+def manager():
+    return ResourceManager()
+
+
+@pytest.fixture
+def jobs(qtbot, manager):
+    jobs = scheduler.JobScheduler(manager=manager)
+    yield jobs
+    jobs.shutdown()
+    assert jobs.wait(timeout=5)
+
+
+def _wait_until_ended(qtbot, *submitted):
+    qtbot.waitUntil(lambda: all(job.ended for job in submitted), timeout=5000)
+
+
+def test_priorities_once_resources_are_free(qtbot, manager, jobs):
+    order = []
+    live_imaging = manager.lease(CAMERA, LASERS, owner="Live imaging")
+    low = jobs.submit("Save", lambda job: order.append('low'),
+                      resources=(CAMERA,), priority=scheduler.PRIORITY_LOW)
+    normal = jobs.submit("Image", lambda job: order.append('normal'),
+                         resources=(CAMERA, LASERS))
+    high = jobs.submit("Volume", lambda job: order.append('high'),
+                       resources=(CAMERA,), priority=scheduler.PRIORITY_HIGH)
+    independent = jobs.submit("SEM", lambda job: order.append('independent'),
+                              resources=(ELECTRON_BEAM,))
+    _wait_until_ended(qtbot, independent)
+    assert order == ['independent']
+    assert [job.status for job in (low, normal, high)] == ['queued'] * 3
+    assert jobs.jobs()[:3] == [high, normal, low]
+    live_imaging.release()
+    _wait_until_ended(qtbot, low, normal, high)
+    assert order == ['independent', 'high', 'normal', 'low']
+
+
+def test_lower_priority_jobs_wait_for_shared_resources(qtbot, manager, jobs):
+    started = threading.Event()
+    lease = manager.lease(CAMERA, owner="Live imaging")
+    volume = jobs.submit("Volume", lambda job: None, resources=(CAMERA, LASERS),
+                         priority=scheduler.PRIORITY_HIGH)
+    lasers_only = jobs.submit("Lasers", lambda job: started.set(),
+                              resources=(LASERS,))
+    assert not started.wait(0.2)  # would delay the volume
+    lease.release()
+    _wait_until_ended(qtbot, volume, lasers_only)
+    assert volume.finished <= lasers_only.started
+
+
+def test_on_done_in_gui_thread(qtbot, jobs):
+    results = []
+
+    def on_done(result):
+        results.append((result, errors.in_gui_thread()))
+
+    job = jobs.submit("Ion beam image", lambda job: 42,
+                      resources=(CAMERA,), on_done=on_done)
+    qtbot.waitUntil(lambda: bool(results), timeout=5000)
+    assert results == [(42, True)]
+    assert job.status == 'done'
+
+
+def test_cancel(qtbot, manager, jobs):
+    running = threading.Event()
+    done = []
+
+    def wait_for_cancel(job):
+        running.set()
+        job.report_progress(0.5, 'acquiring')
+        job.cancel_event.wait(5)
+
+    first = jobs.submit("Volume", wait_for_cancel, resources=(CAMERA,),
+                        on_done=done.append)
+    second = jobs.submit("Image", lambda job: done.append('ran'),
+                         resources=(CAMERA,))
+    assert running.wait(5)
+    assert first.progress == 0.5
+    jobs.cancel(second)
+    assert second.status == 'cancelled'
+    jobs.cancel(first)
+    _wait_until_ended(qtbot, first)
+    assert first.status == 'cancelled'
+    assert manager.available(CAMERA)
+    assert done == []
+
+
+def test_failures_are_reported(qtbot, jobs):
+    bus = errors.ErrorBus()
+
+    def fail(job):
+        raise RuntimeError("Stage not initialized")
+
+    with mock.patch.object(errors, 'error_bus', return_value=bus):
+        with qtbot.waitSignal(bus.errorReported, timeout=5000) as blocker:
+            job = jobs.submit("Move to light microscope", fail)
+    assert job.status == 'failed'
+    assert blocker.args[1] == "Move to light microscope"
+    assert "Stage not initialized" in blocker.args[0]
+
+
+def test_queue_panel(qtbot, manager, jobs):
+    panel = scheduler.JobQueuePanel(jobs)
+    qtbot.add_widget(panel)
+    lease = manager.lease(CAMERA, owner="Live imaging")
+    job = jobs.submit("Fluorescence image", lambda job: None, resources=(CAMERA,))
+    item = panel.job_list.topLevelItem(0)
+    assert [item.text(column) for column in range(3)] == [
+        "Fluorescence image", "0", "queued"]
+    item.setSelected(True)
+    panel.cancel_button.click()
+    assert job.status == 'cancelled'
+    assert item.text(2) == 'cancelled'
+    panel.clear_button.click()
+    assert panel.job_list.topLevelItemCount() == 0
+    lease.release()
@@ -0,0 +1,141 @@
+import time
+
+import numpy as np
+import pytest
+
+from piescope_gui import monitoring, simulation
+from piescope_gui.simulation import (GrabFrameSettings,
+                                     SimulatedHardware,
+                                     SimulatedSample,
+                                     SimulationSettings,
+                                     StagePosition,
+                                     )
+
+
+@pytest.fixture
+def hardware():
+    settings = SimulationSettings(time_scale=0, noise=0, seed=0)
+    return SimulatedHardware(settings, SimulatedSample(size=512, seed=0))
+
+
+def test_stage_moves(hardware):
+    stage = hardware.microscope.specimen.stage
+    simulation.move_to_light_microscope(hardware.microscope)
+    stage.relative_move(StagePosition(z=1e-3))
+    position = stage.current_position
+    assert np.allclose((position.x, position.y, position.z),
+                       (49.952e-3, -0.1911e-3, 5e-3))
+    stage.absolute_move(StagePosition(x=1e-3))
+    assert np.isclose(stage.current_position.x, 1e-3)
+    assert np.isclose(stage.current_position.y, -0.1911e-3)
+
+
+def test_fibsem_images_follow_the_stage(hardware):
+    microscope = hardware.microscope
+    settings = simulation.update_camera_settings(1e-6, '768x512')
+    image = simulation.new_ion_image(microscope, settings)
+    assert image.data.shape == (512, 768)
+    assert image.data.dtype == np.uint8
+    pixel_size = image.metadata.binary_result.pixel_size.x
+    assert np.isclose(pixel_size, 100e-6 / 768)
+    assert simulation.last_ion_image(microscope) is image
+    microscope.specimen.stage.relative_move(StagePosition(x=10 * pixel_size))
+    moved = simulation.new_ion_image(microscope, settings)
+    rows, columns, _ = monitoring.phase_correlation(image.data, moved.data)
+    assert np.allclose((rows, columns), (0, -10), atol=0.5)
+
+
+def test_drift(hardware):
+    hardware.settings.time_scale = 1
+    hardware.settings.imaging_latency = 0
+    hardware.settings.drift = (1e-6, 0.)  # a pixel every 0.13 s
+    microscope = hardware.microscope
+    settings = GrabFrameSettings('768x512', 1e-9)
+    first = simulation.new_electron_image(microscope, settings)
+    time.sleep(0.5)
+    second = simulation.new_electron_image(microscope, settings)
+    _, columns, _ = monitoring.phase_correlation(first.data, second.data)
+    assert -6 < columns < -2
+
+
+def test_patterning_mills_the_sample(hardware):
+    microscope = hardware.microscope
+    settings = GrabFrameSettings('768x512', 1e-6)
+    before = simulation.new_ion_image(microscope, settings).data
+    pattern = microscope.patterning.create_rectangle(0, 0, 10e-6, 5e-6, 1e-6)
+    assert pattern.time > 0
+    microscope.patterning.run()
+    assert microscope.patterning.state == "Idle"
+    after = simulation.new_ion_image(microscope, settings).data
+    milled = (slice(256 - 10, 256 + 10), slice(384 - 30, 384 + 30))
+    assert after[milled].mean() < 0.5 * before[milled].mean()
+    assert np.array_equal(after[:100], before[:100])
+
+
+def test_patterning_pause(hardware):
+    hardware.settings.time_scale = 1
+    patterning = hardware.microscope.patterning
+    patterning.create_rectangle(0, 0, 10e-6, 10e-6, 1e-6)  # 370 s
+    patterning.start()
+    assert patterning.state == "Running"
+    patterning.pause()
+    assert patterning.state == "Paused"
+    patterning.resume()
+    patterning.stop()
+    assert patterning.state == "Idle"
+
+
+def test_basler_image(hardware):
+    detector = hardware.detector
+    laser = hardware.lasers['laser640']
+    assert detector.camera_grab(1e5).max() == 0  # no laser on
+    laser.laser_power = 10
+    laser.emission_on()
+    image = detector.camera_grab(1e5)
+    assert image.shape == simulation.BASLER_SHAPE
+    assert image.max() > 200
+    hardware.objective_stage.move_relative(5000)
+    assert hardware.objective_stage.current_position() == 5000
+    blurred = detector.camera_grab(1e5)
+    assert blurred.std() < image.std()
+    detector.camera.Close()
+    laser.emission_off()
+
+
+def test_latency():
+    settings = SimulationSettings(time_scale=1, objective_latency=0.1,
+                                  objective_speed=1e4)
+    stage = simulation.SimulatedObjectiveStage(settings)
+    start = time.time()
+    stage.move_absolute(1000)
+    assert time.time() - start >= 0.2
+    settings.time_scale = 0
+    start = time.time()
+    stage.move_absolute(0)
+    assert time.time() - start < 0.1
+
+
+def test_adorned_image_round_trip(tmpdir):
+    image = simulation.AdornedImage(np.arange(12, dtype=np.uint8).reshape(3, 4),
+                                    pixel_size=2e-8)
+    filename = str(tmpdir.join("image.tif"))
+    image.save(filename)
+    loaded = simulation.AdornedImage().load(filename)
+    assert np.array_equal(loaded.data, image.data)
+    assert loaded.metadata.binary_result.pixel_size.x == 2e-8
+
+
+def test_simulated_backend():
+    pytest.importorskip("piescope")
+    import piescope.fibsem
+    import piescope.lm
+
+    settings = SimulationSettings(time_scale=0)
+    with simulation.simulated_backend(settings) as hardware:
+        assert simulation.active()
+        assert piescope.fibsem.initialize("localhost") is hardware.microscope
+        assert piescope.lm.laser.initialize_lasers() is hardware.lasers
+        assert piescope.lm.detector.Basler() is hardware.detector
+        from autoscript_sdb_microscope_client.structures import StagePosition
+        assert StagePosition is not None
+    assert not simulation.active()
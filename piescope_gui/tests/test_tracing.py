@@ -0,0 +1,94 @@
+import json
+import threading
+
+import pytest
+
+from piescope_gui import tracing
+
+
+@pytest.fixture
+def tracer():
+    return tracing.Tracer(capacity=5)
+
+
+def test_nested_spans(tracer):
+    with tracer.span('outer', 'acquisition', laser='laser640') as outer:
+        with tracer.span('inner', 'save') as inner:
+            inner.set(filename='image.tif')
+        outer.set(frames=2)
+    inner, outer = tracer.spans()  # recorded as they finish
+    assert inner.parent is outer
+    assert (outer.depth, inner.depth) == (0, 1)
+    assert outer.attributes == {'laser': 'laser640', 'frames': 2}
+    assert inner.attributes == {'filename': 'image.tif'}
+    assert outer.start <= inner.start
+    assert outer.duration >= inner.duration >= 0
+
+
+def test_ring_buffer(tracer):
+    for i in range(8):
+        tracer.event(str(i))
+    assert [span.name for span in tracer.spans()] == ['3', '4', '5', '6', '7']
+    tracer.clear()
+    assert tracer.spans() == []
+
+
+def test_span_records_errors(tracer):
+    with pytest.raises(ValueError):
+        with tracer.span('failing'):
+            raise ValueError("no image")
+    span, = tracer.spans()
+    assert span.error == "ValueError: no image"
+    assert span.duration is not None
+
+
+def test_threads_nest_separately(tracer):
+    def worker():
+        with tracer.span('worker'):
+            pass
+
+    with tracer.span('main'):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+    worker_span = [span for span in tracer.spans() if span.name == 'worker'][0]
+    assert worker_span.parent is None
+    assert worker_span.thread_id != threading.get_ident()
+
+
+def test_traced_arguments(monkeypatch, tracer):
+    monkeypatch.setattr(tracing, 'TRACER', tracer)
+
+    @tracing.traced('display', arguments=('modality',))
+    def update_display(modality, scale=1):
+        return modality
+
+    assert update_display('FM') == 'FM'
+    span, = tracer.spans()
+    assert span.name.endswith('update_display')
+    assert span.category == 'display'
+    assert span.attributes == {'modality': 'FM'}
+
+
+def test_disabled(tracer):
+    tracer.enabled = False
+    with tracer.span('ignored') as span:
+        span.set(value=1)
+    tracer.event('ignored')
+    assert tracer.spans() == []
+
+
+def test_export_chrome_trace(tmpdir, tracer):
+    with tracer.span('acquire_volume', 'acquisition', lasers=('laser640',)):
+        tracer.event('milling_endpoint', 'milling', value=0.2)
+    filename = tracer.export_chrome_trace(str(tmpdir.join('trace.json')))
+    with open(filename) as f:
+        trace = json.load(f)
+    events = {event['name']: event for event in trace['traceEvents']}
+    assert events['thread_name']['ph'] == 'M'
+    assert events['acquire_volume']['ph'] == 'X'
+    assert events['acquire_volume']['cat'] == 'acquisition'
+    assert events['acquire_volume']['dur'] >= 0
+    assert events['acquire_volume']['args'] == {'lasers': ['laser640']}
+    assert events['milling_endpoint']['ph'] == 'i'
+    assert events['milling_endpoint']['args'] == {'value': 0.2}
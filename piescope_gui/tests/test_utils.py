@@ -1,5 +1,7 @@
 
+import logging
 import mock
+import threading
 import time
 
 import pytest
@@ -23,3 +25,48 @@ def test_timestamp():
         expected = '02-Dec-2019_11-06AM'
         result = piescope_gui.utils.timestamp()
         assert result == expected
+
+
+def test_rate_limit_filter():
+    rate_limit = piescope_gui.utils.RateLimitFilter(interval=10, burst=2)
+
+    def record(created, msg="Laser %s"):
+        record = logging.LogRecord('piescope_gui', logging.DEBUG, 'main.py',
+                                   10, msg, ('laser640',), None)
+        record.created = created
+        return record
+
+    assert [rate_limit.filter(record(t)) for t in (0, 1, 2, 3)] == \
+        [True, True, False, False]
+    assert rate_limit.filter(record(2, msg="Other %s"))  # counted separately
+    later = record(11)
+    assert rate_limit.filter(later)
+    assert later.getMessage() == "Laser laser640 (2 similar messages suppressed)"
+
+
+def test_setup_logging(tmpdir, monkeypatch):
+    monkeypatch.delenv('PIESCOPE_LOG_LEVEL', raising=False)
+    root = logging.getLogger()
+    monkeypatch.setattr(root, 'level', root.level)
+    formatted_in = []
+
+    class Value:
+        def __str__(self):
+            formatted_in.append(threading.current_thread())
+            return 'value'
+
+    piescope_gui.utils.setup_logging(level=logging.DEBUG, directory=str(tmpdir),
+                                     console_level=logging.CRITICAL)
+    try:
+        log = logging.getLogger('piescope_gui.tests')
+        log.debug("Debug %s", Value())
+        for i in range(20):
+            log.info("Repeated message %d", i)
+    finally:
+        piescope_gui.utils.shutdown_logging()
+    text = tmpdir.join(piescope_gui.utils.LOG_FILENAME).read()
+    assert "DEBUG" in text and "Debug value" in text
+    # formatted by the listener thread (pytest's own log capture handler
+    # formats it in this thread too)
+    assert any(thread is not threading.current_thread() for thread in formatted_in)
+    assert text.count("Repeated message") == piescope_gui.utils.RATE_LIMIT_BURST
@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from piescope_gui.milling import MillingPattern
+from piescope_gui.workflow import (DONE,
+                                   FAILED,
+                                   Step,
+                                   Workflow,
+                                   load_sites,
+                                   mill_patterns,
+                                   save_sites,
+                                   )
+
+
+@pytest.fixture
+def sites():
+    return [{'name': 'site_{}'.format(i), 'position': {'x': i * 1e-3}}
+            for i in range(3)]
+
+
+def recording_steps(calls, fail=None):
+    """Steps appending (step, site) to calls, failing once at `fail`."""
+    failures = set() if fail is None else {fail}
+
+    def make(name):
+        def function(site):
+            calls.append((name, site['name']))
+            if (name, site['name']) in failures:
+                failures.discard((name, site['name']))
+                raise RuntimeError("stage error")
+            return '{}/{}.tif'.format(site['name'], name)
+        return function
+
+    return [Step('move', make('move'), always=True),
+            Step('acquire', make('acquire')),
+            Step('image', make('image')),
+            Step('correlate', make('correlate'), background=True)]
+
+
+def test_sites_round_trip(tmpdir, sites):
+    filename = save_sites(os.path.join(tmpdir, "sites.json"), sites)
+    assert load_sites(filename) == sites
+    with open(filename, 'w') as f:
+        json.dump(sites + sites[:1], f)
+    with pytest.raises(ValueError):
+        load_sites(filename)
+
+
+def test_workflow_runs_every_site(tmpdir, sites):
+    calls = []
+    checkpoint = os.path.join(tmpdir, "checkpoint.json")
+    results = Workflow(sites, recording_steps(calls), checkpoint).run()
+    assert [site['status'] for site in results] == [DONE] * 3
+    assert results[1]['results']['image'] == 'site_1/image.tif'
+    hardware = [call for call in calls if call[0] != 'correlate']
+    assert hardware == [(step, site['name']) for site in sites
+                        for step in ['move', 'acquire', 'image']]
+    with open(checkpoint) as f:
+        saved = json.load(f)
+    assert saved['sites'] == results
+    # everything is done, so running again does nothing
+    calls.clear()
+    Workflow(sites, recording_steps(calls), checkpoint).run()
+    assert calls == []
+
+
+def test_workflow_resumes_after_failure(tmpdir, sites):
+    calls = []
+    checkpoint = os.path.join(tmpdir, "checkpoint.json")
+    results = Workflow(sites, recording_steps(calls, fail=('image', 'site_1')),
+                       checkpoint).run()
+    assert [site['status'] for site in results] == [DONE, FAILED, DONE]
+    assert results[1]['failed_step'] == 'image'
+    assert 'stage error' in results[1]['error']
+    assert ('correlate', 'site_1') not in calls
+
+    calls.clear()
+    results = Workflow(sites, recording_steps(calls), checkpoint).run()
+    assert [site['status'] for site in results] == [DONE] * 3
+    # the stage moves back to the site, and the volume isn't acquired again
+    assert calls == [('move', 'site_1'), ('image', 'site_1'),
+                     ('correlate', 'site_1')]
+
+
+def test_workflow_resumes_with_required_moves(tmpdir, sites):
+    calls = []
+    steps = recording_steps(calls, fail=('image', 'site_0'))
+    steps.insert(2, Step('move_back', steps[0].function, always=True))
+    steps[3].requires = ['move']  # image doesn't need move_back
+    checkpoint = os.path.join(tmpdir, "checkpoint.json")
+    Workflow(sites[:1], steps, checkpoint).run()
+    calls.clear()
+    results = Workflow(sites[:1], steps, checkpoint).run()
+    assert results[0]['status'] == DONE
+    assert calls == [('move', 'site_0'), ('image', 'site_0'),
+                     ('correlate', 'site_0')]
+
+
+def test_workflow_retries(tmpdir, sites):
+    calls = []
+    steps = recording_steps(calls, fail=('acquire', 'site_0'))
+    steps[1].retries = 1
+    results = Workflow(sites[:1], steps,
+                       os.path.join(tmpdir, "checkpoint.json")).run()
+    assert results[0]['status'] == DONE
+    assert calls.count(('acquire', 'site_0')) == 2
+
+
+def test_workflow_pipelines_background_steps(tmpdir, sites):
+    # site_0 correlation can only finish once site_1 imaging has started
+    next_site_started = threading.Event()
+
+    def correlate(site):
+        if site['name'] == 'site_0':
+            assert next_site_started.wait(5)
+        return None
+
+    def image(site):
+        if site['name'] == 'site_1':
+            next_site_started.set()
+        return None
+
+    steps = [Step('image', image),
+             Step('correlate', correlate, background=True)]
+    results = Workflow(sites, steps, os.path.join(tmpdir, "checkpoint.json"),
+                       workers=2).run()
+    assert [site['status'] for site in results] == [DONE] * 3
+
+
+def test_workflow_rejects_other_checkpoint(tmpdir, sites):
+    checkpoint = os.path.join(tmpdir, "checkpoint.json")
+    Workflow(sites, recording_steps([]), checkpoint).run()
+    with pytest.raises(ValueError):
+        Workflow(sites[:2], recording_steps([]), checkpoint).run()
+    results = Workflow(sites[:2], recording_steps([]), checkpoint).run(
+        resume=False)
+    assert len(results) == 2
+
+
+def test_workflow_stop(tmpdir, sites):
+    calls = []
+    workflow = None
+
+    def acquire(site):
+        calls.append(site['name'])
+        workflow.stop()
+
+    checkpoint = os.path.join(tmpdir, "checkpoint.json")
+    workflow = Workflow(sites, [Step('acquire', acquire),
+                                Step('image', lambda site: None)], checkpoint)
+    results = workflow.run()
+    assert calls == ['site_0']
+    assert [site['status'] for site in results] == ['pending'] * 3
+    assert workflow.run()[0]['results'] == {'acquire': None, 'image': None}
+
+
+class FakePatterning:
+    def __init__(self, microscope, fail_at=None):
+        self.microscope = microscope
+        self.fail_at = fail_at
+        self.patterns = []
+        self.milled = []
+
+    def clear_patterns(self):
+        self.patterns = []
+
+    def create_rectangle(self, *args):
+        self.patterns.append(args)
+        return SimpleNamespace()
+
+    def run(self):
+        if len(self.milled) == self.fail_at:
+            raise RuntimeError("patterning stopped")
+        self.milled.append(
+            (self.microscope.beams.ion_beam.beam_current.value,
+             len(self.patterns)))
+
+
+def fake_microscope(fail_at=None):
+    ion_beam = SimpleNamespace(beam_current=SimpleNamespace(value=1e-9))
+    microscope = SimpleNamespace(beams=SimpleNamespace(ion_beam=ion_beam))
+    microscope.patterning = FakePatterning(microscope, fail_at)
+    return microscope
+
+
+def test_mill_patterns(tmpdir):
+    patterns = [MillingPattern(0, 0, 1e-6, 1e-6, current=3e-9),
+                MillingPattern(0, 2e-6, 1e-6, 1e-6, current=3e-9),
+                MillingPattern(0, 4e-6, 1e-6, 1e-6, current=0.3e-9)]
+    progress = os.path.join(tmpdir, "milling.json")
+    microscope = fake_microscope(fail_at=1)
+    with pytest.raises(RuntimeError, match="patterning stopped"):
+        mill_patterns(microscope, patterns, progress)
+    assert microscope.patterning.milled == [(3e-9, 2)]
+    # the second batch may be partly milled, so it isn't milled again
+    microscope = fake_microscope()
+    with pytest.raises(RuntimeError, match="batch 2 was interrupted"):
+        mill_patterns(microscope, patterns, progress)
+    assert microscope.patterning.milled == []
+
+    with open(progress, 'w') as f:
+        json.dump({'milled': 1, 'milling': None}, f)  # stopped between batches
+    assert mill_patterns(microscope, patterns, progress) == 3
+    assert microscope.patterning.milled == [(0.3e-9, 1)]
+    assert mill_patterns(microscope, patterns, progress) == 3
+    assert len(microscope.patterning.milled) == 1
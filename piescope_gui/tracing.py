@@ -0,0 +1,250 @@
+"""Lightweight tracing of acquisition, saving, display and milling.
+
+Code is traced with nested spans, each with a name, a category, a duration
+and any attributes, e.g.:
+
+    with tracing.span('camera_grab', 'acquisition', exposure_time=200):
+        image = detector.camera_grab(200000)
+
+or by decorating a function with `traced`. Finished spans are kept in a
+fixed size ring buffer in memory, so tracing is always on, and the most
+recent spans can be exported to Chrome trace event JSON at any time with
+`export_chrome_trace`. Open the file in chrome://tracing or
+https://ui.perfetto.dev to inspect a slow session.
+"""
+import collections
+import contextlib
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+__all__ = [
+    'Span',
+    'Tracer',
+    'TRACER',
+    'span',
+    'event',
+    'traced',
+    'spans',
+    'clear',
+    'chrome_trace',
+    'export_chrome_trace',
+    ]
+
+DEFAULT_CAPACITY = 10000  # spans kept in memory
+DEFAULT_CATEGORY = 'piescope'
+
+_EPOCH = time.perf_counter()
+
+
+def _now():
+    """Microseconds since this module was imported."""
+    return (time.perf_counter() - _EPOCH) * 1e6
+
+
+class Span:
+    """A named, timed section of code.
+
+    Parameters
+    ----------
+    name : str
+    category : str
+        Kind of work, e.g. 'acquisition', 'save', 'display', 'stage',
+        'laser', 'correlation' or 'milling'.
+    attributes : dict
+    parent : Span or None
+        The enclosing span in the same thread.
+    """
+    def __init__(self, name, category, attributes, parent=None):
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        thread = threading.current_thread()
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.start = _now()
+        self.duration = None  # microseconds, None for an instant event
+        self.error = None
+
+    def __repr__(self):
+        return "<Span {!r} {} us>".format(self.name, self.duration)
+
+    def set(self, **attributes):
+        """Add attributes, e.g. results only known at the end of the span."""
+        self.attributes.update(attributes)
+
+    def to_event(self, pid=None):
+        """Chrome trace event dictionary."""
+        args = dict(self.attributes)
+        if self.error is not None:
+            args['error'] = self.error
+        event = {
+            'name': self.name,
+            'cat': self.category,
+            'ts': self.start,
+            'pid': os.getpid() if pid is None else pid,
+            'tid': self.thread_id,
+            'args': args,
+        }
+        if self.duration is None:
+            event.update(ph='i', s='t')
+        else:
+            event.update(ph='X', dur=self.duration)
+        return event
+
+
+class _NullSpan:
+    """Stands in for a span while tracing is disabled."""
+    def set(self, **attributes):
+        pass
+
+
+class Tracer:
+    """Records spans into a ring buffer of the most recent spans.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        Number of finished spans kept, by default DEFAULT_CAPACITY.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.enabled = True
+        self._spans = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, category=DEFAULT_CATEGORY, **attributes):
+        """Context manager timing the code inside it as a span.
+
+        Spans opened inside it in the same thread are nested below it.
+        Exceptions are recorded in the span and raised again.
+        """
+        if not self.enabled:
+            yield _NullSpan()
+            return
+        stack = self._stack()
+        current = Span(name, category, attributes,
+                       parent=stack[-1] if stack else None)
+        stack.append(current)
+        try:
+            yield current
+        except BaseException as e:
+            current.error = '{}: {}'.format(type(e).__name__, e)
+            raise
+        finally:
+            current.duration = _now() - current.start
+            stack.pop()
+            self._record(current)
+
+    def event(self, name, category=DEFAULT_CATEGORY, **attributes):
+        """Record an instant event, a span with no duration."""
+        if not self.enabled:
+            return
+        stack = self._stack()
+        self._record(Span(name, category, attributes,
+                          parent=stack[-1] if stack else None))
+
+    def _record(self, finished):
+        with self._lock:
+            self._spans.append(finished)
+
+    def spans(self):
+        """Recorded spans, oldest first."""
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+    def chrome_trace(self):
+        """Recorded spans as a Chrome trace event format dictionary."""
+        recorded = self.spans()
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                   'args': {'name': name}}
+                  for tid, name in sorted({(s.thread_id, s.thread_name)
+                                           for s in recorded})]
+        events.extend(s.to_event(pid) for s in recorded)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, filename):
+        """Save recorded spans as a Chrome trace event JSON file.
+
+        Attribute values that are not JSON types are saved as strings.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.chrome_trace(), f, default=str)
+        return filename
+
+
+TRACER = Tracer()
+
+
+def span(name, category=DEFAULT_CATEGORY, **attributes):
+    """Time a block of code as a span of the default tracer."""
+    return TRACER.span(name, category, **attributes)
+
+
+def event(name, category=DEFAULT_CATEGORY, **attributes):
+    """Record an instant event with the default tracer."""
+    TRACER.event(name, category, **attributes)
+
+
+def traced(category=DEFAULT_CATEGORY, name=None, arguments=()):
+    """Decorator tracing every call of a function as a span.
+
+    Parameters
+    ----------
+    category : str, optional
+    name : str, optional
+        Span name, by default the function's qualified name.
+    arguments : tuple of str, optional
+        Names of function arguments recorded as span attributes.
+    """
+    def decorator(function):
+        span_name = name or function.__qualname__
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            attributes = {}
+            if arguments:
+                bound = signature.bind_partial(*args, **kwargs).arguments
+                attributes = {key: bound[key] for key in arguments
+                              if key in bound}
+            with TRACER.span(span_name, category, **attributes):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def spans():
+    """Spans recorded by the default tracer, oldest first."""
+    return TRACER.spans()
+
+
+def clear():
+    TRACER.clear()
+
+
+def chrome_trace():
+    return TRACER.chrome_trace()
+
+
+def export_chrome_trace(filename):
+    """Save the spans of the default tracer as Chrome trace event JSON."""
+    return TRACER.export_chrome_trace(filename)
@@ -1,19 +1,50 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import threading
 import time
 import traceback
 
 from PyQt5 import QtWidgets
 
+from piescope_gui import errors
+
 __all__ = [
     'display_error_message',
     'timestamp',
+    'setup_logging',
+    'shutdown_logging',
+    'RateLimitFilter',
     ]
 
+logger = logging.getLogger(__name__)
+
+LOG_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+LOG_FILENAME = 'piescope.log'
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(threadName)s] %(name)s: %(message)s'
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+RATE_LIMIT_INTERVAL = 10.  # seconds
+RATE_LIMIT_BURST = 5  # messages from one line of code in each interval
+
+_listener = None
+_queue_handler = None
+
 
 def display_error_message(message):
-    """PyQt dialog box displaying an error message."""
+    """PyQt dialog box displaying an error message.
+
+    Outside the GUI thread, the message is reported to the error bus instead
+    (see `piescope_gui.errors`), so the calling thread never waits for a
+    dialog to be closed, and None is returned.
+    """
+    if not errors.in_gui_thread():
+        errors.error_bus().report(message)
+        return None
     print('display_error_message')
-    logging.exception(message)
+    logger.error(message)
     error_dialog = QtWidgets.QErrorMessage()
     error_dialog.showMessage(message)
     error_dialog.exec_()
@@ -30,3 +61,147 @@ def timestamp():
     """
     timestamp = time.strftime('%d-%b-%Y_%H-%M%p', time.localtime())
     return timestamp
+
+
+class RateLimitFilter(logging.Filter):
+    """Suppress messages repeated too often, e.g. from a slider callback.
+
+    Messages are counted by the line of code logging them and their
+    unformatted message, so the filter is cheap and never formats a message.
+    After `burst` messages within `interval` seconds, the rest are dropped
+    until the interval ends, and the next message says how many were dropped.
+
+    Parameters
+    ----------
+    interval : float, optional
+        Seconds, by default RATE_LIMIT_INTERVAL.
+    burst : int, optional
+        Messages allowed in each interval, by default RATE_LIMIT_BURST.
+    """
+    MAX_KEYS = 1000
+
+    def __init__(self, interval=RATE_LIMIT_INTERVAL, burst=RATE_LIMIT_BURST):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._counts = {}  # key: [interval start, count, suppressed count]
+
+    def filter(self, record):
+        msg = record.msg if isinstance(record.msg, str) else None
+        key = (record.pathname, record.lineno, record.levelno, msg)
+        now = record.created
+        with self._lock:
+            count = self._counts.get(key)
+            if count is None or now - count[0] >= self.interval:
+                suppressed = count[2] if count is not None else 0
+                if len(self._counts) >= self.MAX_KEYS:
+                    self._forget(now)
+                self._counts[key] = [now, 1, 0]
+            elif count[1] < self.burst:
+                count[1] += 1
+                suppressed = 0
+            else:
+                count[2] += 1
+                return False
+        if suppressed and msg is not None:
+            record.msg = msg + ' ({} similar messages suppressed)'.format(
+                suppressed)
+        return True
+
+    def _forget(self, now):
+        for key, count in list(self._counts.items()):
+            if now - count[0] >= self.interval:
+                del self._counts[key]
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queue log records without formatting them in the logging thread.
+
+    The queue is only read by the listener thread in this process, so records
+    are put on it unchanged and formatted by the listener's handlers.
+    Message arguments are formatted when the listener gets to them, so log
+    values rather than mutable objects that may change before then.
+    """
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=logging.INFO, directory=LOG_DIRECTORY,
+                  filename=LOG_FILENAME, console_level=logging.WARNING,
+                  max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT,
+                  rate_limit=True):
+    """Log to rotating files and the console from a background thread.
+
+    Log calls only put the record on a queue. A `QueueListener` thread
+    formats records and writes them to `filename` in `directory`, which is
+    rotated when it reaches `max_bytes`, and to the console. Calling
+    `setup_logging` again replaces the previous setup.
+
+    Parameters
+    ----------
+    level : int or str, optional
+        Log file level, by default logging.INFO. The PIESCOPE_LOG_LEVEL
+        environment variable overrides it, e.g. PIESCOPE_LOG_LEVEL=DEBUG.
+    directory : str, optional
+        By default, the `logs` directory of the piescope_gui package.
+    filename : str, optional
+    console_level : int or str, optional
+        By default logging.WARNING.
+    max_bytes : int, optional
+        Log file size before it is rotated.
+    backup_count : int, optional
+        Number of rotated log files kept.
+    rate_limit : bool, optional
+        Whether to suppress frequently repeated messages (see
+        `RateLimitFilter`), by default True.
+
+    Returns
+    -------
+    logging.handlers.QueueListener
+    """
+    global _listener, _queue_handler
+    shutdown_logging()
+    level = os.environ.get('PIESCOPE_LOG_LEVEL', level)
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    if isinstance(console_level, str):
+        console_level = logging.getLevelName(console_level.upper())
+    os.makedirs(directory, exist_ok=True)
+    formatter = logging.Formatter(LOG_FORMAT)
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(directory, filename), maxBytes=max_bytes,
+        backupCount=backup_count, encoding='utf-8')
+    file_handler.setLevel(level)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    _queue_handler = _QueueHandler(log_queue)
+    if rate_limit:
+        _queue_handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(min(level, console_level))
+    _listener = logging.handlers.QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging():
+    """Write any queued log records and stop the `setup_logging` thread."""
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
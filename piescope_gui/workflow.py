@@ -0,0 +1,522 @@
+"""Run the imaging, correlation and milling sequence at many sites unattended.
+
+A site is a stored sample stage position. `Workflow` runs a list of steps
+at each site in turn. Steps which drive the hardware run one at a time, in
+order, while steps which only process data (marked `background`) run in
+worker threads, so that warping and saving the images of one site overlaps
+with moving to and imaging the next.
+
+Progress is saved to a JSON checkpoint file after every step. If the run
+fails or is stopped, running it again with the same checkpoint file resumes
+where it left off. Nothing in this module imports Qt, see the
+`piescope run-sites` command line interface.
+"""
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+import traceback
+
+from piescope_gui.utils import timestamp
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+
+# Site states saved in the checkpoint file.
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Step:
+    """One step of the sequence run at every site.
+
+    Parameters
+    ----------
+    name : str
+        Unique step name, used as the key of its result.
+    function : callable
+        Called with the site dictionary, which holds the site definition
+        (see `load_sites`) and a 'results' dictionary of the results of the
+        steps already run there. Its return value is saved in the
+        checkpoint file, so it must be serializable as JSON: save images
+        to disk and return their filenames.
+    background : bool, optional
+        If True, the step only processes data and runs in a worker thread,
+        while the hardware steps carry on. Background steps of one site run
+        in order, after the hardware steps before them. Hardware steps must
+        not use the results of earlier background steps. By default False.
+    retries : int, optional
+        Number of times to retry the step if it raises an exception,
+        by default 0.
+    always : bool, optional
+        Run the step again when resuming a site part way through, even if
+        it completed before, e.g. to move the stage back to the site.
+        By default False.
+    requires : list of str, optional
+        Names of the `always` steps run again before this step when a site
+        is resumed at it, e.g. only the stage moves it needs. By default,
+        every `always` step before it.
+    """
+    def __init__(self, name, function, background=False, retries=0,
+                 always=False, requires=None):
+        self.name = name
+        self.function = function
+        self.background = background
+        self.retries = retries
+        self.always = always
+        self.requires = requires
+
+    def __repr__(self):
+        return 'Step({!r}, background={})'.format(self.name, self.background)
+
+    def run(self, site):
+        """Run the step at a site, retrying if it fails."""
+        for attempt in range(self.retries + 1):
+            try:
+                return self.function(site)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                logger.warning("Step %s failed at site %s, retrying:\n%s",
+                               self.name, site['name'], traceback.format_exc())
+
+
+def load_sites(filename):
+    """Read a list of sites from a JSON file.
+
+    The file holds a list of sites, each with a unique 'name' and a stage
+    'position' dictionary with keys 'x', 'y', 'z' (metres), 'r' and 't'
+    (radians). Sites may hold other keys used by the steps, such as milling
+    'patterns' (see `piescope_steps`).
+
+    Returns
+    -------
+    list of dict
+    """
+    with open(filename) as f:
+        sites = json.load(f)
+    if isinstance(sites, dict):
+        sites = sites['sites']
+    names = [site['name'] for site in sites]
+    if len(set(names)) != len(names):
+        raise ValueError("Site names must be unique, got {}".format(names))
+    return sites
+
+
+def save_sites(filename, sites):
+    """Save a list of sites to a JSON file, see `load_sites`."""
+    with open(filename, 'w') as f:
+        json.dump({'sites': sites}, f, indent=2)
+    return filename
+
+
+class Workflow:
+    """Run a sequence of steps at each of a list of sites.
+
+    Parameters
+    ----------
+    sites : list of dict
+        Sites to visit in order, see `load_sites`.
+    steps : list of Step
+        Steps to run at every site, in order.
+    checkpoint_filename : str
+        JSON file recording the progress, used to resume.
+    workers : int, optional
+        Number of threads for background steps, by default 1.
+    max_pending : int, optional
+        Maximum number of background steps queued or running at once,
+        which bounds the memory used. By default, twice the workers.
+    stop_on_error : bool, optional
+        Stop the whole run when a site fails. By default False, moving on
+        to the next site.
+    """
+    def __init__(self, sites, steps, checkpoint_filename, workers=1,
+                 max_pending=None, stop_on_error=False):
+        names = [step.name for step in steps]
+        if len(set(names)) != len(names):
+            raise ValueError("Step names must be unique, got {}".format(names))
+        self.sites = [dict(site) for site in sites]
+        self.steps = list(steps)
+        self.checkpoint_filename = checkpoint_filename
+        self.workers = workers
+        self.max_pending = max_pending or 2 * workers
+        self.stop_on_error = stop_on_error
+        self.state = None
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+
+    def new_state(self):
+        """Checkpoint contents for a run that has not started."""
+        return {
+            'version': CHECKPOINT_VERSION,
+            'steps': [step.name for step in self.steps],
+            'sites': [{'name': site['name'], 'status': PENDING, 'results': {},
+                       'error': None, 'failed_step': None}
+                      for site in self.sites],
+            'updated': timestamp(),
+        }
+
+    def load_checkpoint(self):
+        """Read the checkpoint file, or None if there is none.
+
+        Raises ValueError if it records a different list of sites or steps.
+        """
+        if not os.path.isfile(self.checkpoint_filename):
+            return None
+        with open(self.checkpoint_filename) as f:
+            state = json.load(f)
+        if (state.get('version') != CHECKPOINT_VERSION or
+                state['steps'] != [step.name for step in self.steps] or
+                [site['name'] for site in state['sites']] !=
+                [site['name'] for site in self.sites]):
+            raise ValueError(
+                "The checkpoint file {} is for a different workflow. Delete "
+                "it or restart to begin again.".format(self.checkpoint_filename))
+        return state
+
+    def save_checkpoint(self):
+        """Write the progress to the checkpoint file, atomically."""
+        with self._lock:
+            self.state['updated'] = timestamp()
+            directory = os.path.dirname(os.path.abspath(self.checkpoint_filename))
+            os.makedirs(directory, exist_ok=True)
+            _save_json(self.checkpoint_filename, self.state)
+
+    def stop(self):
+        """Stop after the hardware step currently running.
+
+        Background steps already started are finished and checkpointed,
+        so the run can be resumed.
+        """
+        self._stop_event.set()
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def run(self, resume=True):
+        """Run the workflow, blocking until every site is done or failed.
+
+        Parameters
+        ----------
+        resume : bool, optional
+            Continue from the checkpoint file if it exists. By default True.
+            If False, start again from the first site.
+
+        Returns
+        -------
+        list of dict
+            State of each site, with its 'status', step 'results', and the
+            'error' and 'failed_step' if it failed.
+        """
+        self._stop_event.clear()
+        self.state = (self.load_checkpoint() if resume else None) or self.new_state()
+        for site_state in self.state['sites']:
+            if site_state['status'] != DONE:
+                site_state.update(status=PENDING, error=None, failed_step=None)
+        self.save_checkpoint()
+
+        pending = {}  # future: site name
+        # the last background future of each site, background steps are chained
+        chains = {}
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as executor:
+            for site, site_state in zip(self.sites, self.state['sites']):
+                if self.stopped:
+                    break
+                if site_state['status'] == DONE:
+                    continue
+                self._run_site(site, site_state, executor, pending, chains)
+                if site_state['status'] == FAILED and self.stop_on_error:
+                    self.stop()
+            concurrent.futures.wait(list(pending))
+        names = {step.name for step in self.steps}
+        with self._lock:
+            for site_state in self.state['sites']:
+                if site_state['status'] == RUNNING:
+                    finished = names.issubset(site_state['results'])
+                    site_state['status'] = DONE if finished else PENDING
+            self.save_checkpoint()
+        return self.state['sites']
+
+    def steps_to_run(self, site_state):
+        """Steps not yet completed at a site, and the `always` steps they need.
+
+        The `always` steps run again are those before the first hardware
+        step left to run, or only those it `requires`.
+        """
+        results = site_state['results']
+        remaining = [i for i, step in enumerate(self.steps)
+                     if step.name not in results and not step.background]
+        first = remaining[0] if remaining else 0
+        required = self.steps[first].requires if remaining else None
+        return [step for i, step in enumerate(self.steps)
+                if step.name not in results or (
+                    step.always and i < first and
+                    (required is None or step.name in required))]
+
+    def _run_site(self, site, site_state, executor, pending, chains):
+        steps = self.steps_to_run(site_state)
+        site = dict(site)
+        site['results'] = site_state['results']
+        with self._lock:
+            site_state['status'] = RUNNING
+        logger.info("Starting site %s", site['name'])
+        for step in steps:
+            if self.stopped or site_state['status'] == FAILED:
+                break
+            if not step.background:
+                try:
+                    self._run_step(step, site, site_state)
+                except Exception:
+                    break
+                continue
+            while len(pending) >= self.max_pending:
+                done, _ = concurrent.futures.wait(
+                    list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    pending.pop(future)
+            future = executor.submit(self._run_background, step, site,
+                                     site_state, chains.get(site['name']))
+            chains[site['name']] = future
+            pending[future] = site['name']
+
+    def _run_step(self, step, site, site_state):
+        logger.info("Running step %s at site %s", step.name, site['name'])
+        try:
+            result = step.run(site)
+            json.dumps(result)
+        except Exception:
+            with self._lock:
+                site_state.update(status=FAILED, failed_step=step.name,
+                                  error=traceback.format_exc())
+                self.save_checkpoint()
+            logger.error("Step %s failed at site %s:\n%s", step.name,
+                         site['name'], site_state['error'])
+            raise
+        with self._lock:
+            site_state['results'][step.name] = result
+            self.save_checkpoint()
+        return result
+
+    def _run_background(self, step, site, site_state, previous):
+        if previous is not None:
+            concurrent.futures.wait([previous])
+        if site_state['status'] == FAILED:
+            return None
+        try:
+            return self._run_step(step, site, site_state)
+        except Exception:
+            return None
+
+
+def _save_json(filename, data):
+    """Write a JSON file atomically."""
+    temporary = filename + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(temporary, filename)
+
+
+def mill_patterns(microscope, patterns, progress_filename):
+    """Mill patterns one batch per ion beam current, recording the progress.
+
+    Milling can't be repeated, so each batch is recorded in the progress
+    file before it starts and once it is finished. Called again after an
+    interruption, batches already milled are skipped, and a batch that was
+    interrupted part way through raises RuntimeError instead of milling it
+    again.
+
+    Parameters
+    ----------
+    microscope : Autoscript microscope object.
+    patterns : list of MillingPattern
+    progress_filename : str
+        JSON file recording the batches milled.
+
+    Returns
+    -------
+    int
+        Number of patterns milled.
+    """
+    from piescope_gui.milling import create_patterns, group_by_current
+
+    progress = {'milled': 0, 'milling': None}
+    if os.path.isfile(progress_filename):
+        with open(progress_filename) as f:
+            progress = json.load(f)
+    if progress['milling'] is not None:
+        raise RuntimeError(
+            "Milling batch {} was interrupted. Inspect the site, then delete "
+            "{} to mill every batch again.".format(progress['milling'] + 1,
+                                                   progress_filename))
+    batches = group_by_current(patterns)
+    for index, (current, batch) in enumerate(batches):
+        if index < progress['milled']:
+            continue
+        progress['milling'] = index
+        _save_json(progress_filename, progress)
+        if current is not None:
+            microscope.beams.ion_beam.beam_current.value = current
+        create_patterns(microscope, batch)
+        microscope.patterning.run()  # blocks until milling is finished
+        progress.update(milled=index + 1, milling=None)
+        _save_json(progress_filename, progress)
+    return len(patterns)
+
+
+def move_to_site(microscope, position):
+    """Move the sample stage to a stored position.
+
+    Parameters
+    ----------
+    microscope : Autoscript microscope object.
+    position : dict
+        Stage coordinates 'x', 'y', 'z' in metres and 'r', 't' in radians.
+        Missing coordinates are left unchanged.
+    """
+    from autoscript_sdb_microscope_client.structures import StagePosition
+
+    microscope.specimen.stage.absolute_move(StagePosition(**position))
+
+
+def stage_position(microscope):
+    """Current sample stage position, as stored for a site."""
+    position = microscope.specimen.stage.current_position
+    return {axis: float(getattr(position, axis)) for axis in 'xyzrt'}
+
+
+def piescope_steps(microscope, lasers, detector, objective_stage, laser_dict,
+                   num_z_slices, z_slice_distance, camera_settings,
+                   output_directory, transform_filename=None):
+    """The sequence of steps run by hand at each site in the main window.
+
+    At each site, the stage is moved to the site and across to the light
+    microscope, a fluorescence volume is acquired, the stage is moved back
+    to the electron microscope and an ion beam image taken. Milling
+    patterns stored with the site (a list of `MillingPattern` keyword
+    arguments, in metres) are milled, see `mill_patterns`. Finally, and in
+    the background, the fluorescence volume and its maximum intensity
+    projection are warped with the saved correlation transform.
+
+    Parameters
+    ----------
+    microscope : Autoscript microscope object.
+    lasers, detector, objective_stage
+        Fluorescence microscope hardware, see `GUIMainWindow`.
+    laser_dict : dict
+        {laser name: (power, exposure time in microseconds)}.
+    num_z_slices : int
+    z_slice_distance : int
+        Distance between slices in nanometres.
+    camera_settings
+        Ion beam imaging settings, from `piescope.fibsem.update_camera_settings`.
+    output_directory : str
+        Images are saved to a subdirectory for each site.
+    transform_filename : str, optional
+        JSON correlation transform file. By default, images aren't correlated.
+
+    Returns
+    -------
+    list of Step
+    """
+    import piescope.fibsem
+    import piescope.lm.volume
+    import piescope.utils
+
+    def site_directory(site):
+        directory = os.path.join(output_directory, site['name'])
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def acquire_volume(site):
+        volume = piescope.lm.volume.volume_acquisition(
+            laser_dict, num_z_slices, z_slice_distance, detector=detector,
+            lasers=lasers, objective_stage=objective_stage)
+        meta = {'z_slice_distance': str(z_slice_distance),
+                'num_z_slices': str(num_z_slices),
+                'laser_dict': str(laser_dict),
+                'site': site['name'],
+                }
+        directory = site_directory(site)
+        volume_filename = os.path.join(directory, 'Volume.tif')
+        piescope.utils.save_image(volume, volume_filename, metadata=meta)
+        mip_filename = os.path.join(directory, 'MIP.tif')
+        piescope.utils.save_image(piescope.utils.max_intensity_projection(volume),
+                                  mip_filename, metadata=meta)
+        return {'volume': volume_filename, 'mip': mip_filename}
+
+    def ion_image(site):
+        image = piescope.fibsem.new_ion_image(microscope, camera_settings)
+        filename = os.path.join(site_directory(site), 'I_image.tif')
+        piescope.utils.save_image(image, filename)
+        return filename
+
+    def mill(site):
+        from piescope_gui.milling import MillingPattern
+
+        patterns = [MillingPattern(**pattern)
+                    for pattern in site.get('patterns', [])]
+        if not patterns:
+            return None
+        progress_filename = os.path.join(site_directory(site), 'milling.json')
+        return mill_patterns(microscope, patterns, progress_filename)
+
+    # Sites are stored at the electron microscope, and the moves between
+    # the microscopes are relative, so a resumed step only needs these.
+    at_light_microscope = ['move_to_site', 'move_to_light_microscope']
+    at_electron_microscope = ['move_to_site']
+    steps = [
+        Step('move_to_site',
+             lambda site: move_to_site(microscope, site['position']),
+             always=True),
+        Step('move_to_light_microscope',
+             lambda site: piescope.fibsem.move_to_light_microscope(
+                 microscope, +49.952e-3, -0.1911e-3), always=True),
+        Step('acquire_volume', acquire_volume, requires=at_light_microscope),
+        Step('move_to_electron_microscope',
+             lambda site: piescope.fibsem.move_to_electron_microscope(
+                 microscope, -49.952e-3, +0.1911e-3), always=True,
+             requires=at_light_microscope),
+        Step('ion_image', ion_image, retries=1,
+             requires=at_electron_microscope),
+        Step('mill', mill, requires=at_electron_microscope),
+    ]
+    if transform_filename is not None:
+        steps += correlation_steps(transform_filename, output_directory)
+    return steps
+
+
+def correlation_steps(transform_filename, output_directory):
+    """Background steps warping the images of a site with a saved transform.
+
+    They use the 'acquire_volume' and 'ion_image' step results of
+    `piescope_steps`.
+    """
+    from piescope_gui.correlation.batch import correlate_file, read_warp
+    from piescope_gui.correlation.volume import correlate_volume
+
+    warp = read_warp(transform_filename)
+
+    def correlate_image(site):
+        filename = os.path.join(output_directory, site['name'],
+                                'correlated_image.tiff')
+        result = correlate_file(site['results']['acquire_volume']['mip'],
+                                site['results']['ion_image'], filename, warp)
+        if result['error'] is not None:
+            raise RuntimeError(result['error'])
+        return filename
+
+    def correlate_site_volume(site):
+        filename = os.path.join(output_directory, site['name'],
+                                'correlated_volume.tif')
+        correlate_volume(site['results']['acquire_volume']['volume'],
+                         transform_filename, filename, workers=1)
+        return filename
+
+    return [Step('correlate_image', correlate_image, background=True),
+            Step('correlate_volume', correlate_site_volume, background=True)]
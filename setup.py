@@ -23,7 +23,7 @@ setup(
     package_data={'piescope_gui.images': ['*.png']},
     entry_points={
         'console_scripts': [
-            'piescope=piescope_gui.main:main'
+            'piescope=piescope_gui.cli:main'
         ]
     },
     install_requires=INST_DEPENDENCIES,